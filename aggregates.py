@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  aggregates.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Fleet statistics kept up to date as reports come and go, so they never
+need a pass over the whole database"""
+from __future__ import print_function
+import sys
+import json
+from collections import Counter
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=sys.stderr, **kwargs)
+
+
+if sys.version_info[0] == 2:
+    eprint("Please run with Python 3 as Python 2 is End-of-Life.")
+    exit(2)
+
+
+# name -> (vendor, what it goes by in lspci output)
+GPU_VENDORS = (("AMD", ("advanced micro devices", "amd/ati", "radeon")),
+               ("Intel", ("intel",)),
+               ("NVIDIA", ("nvidia",)))
+
+
+def gpu_vendor(info):
+    """The GPU vendor(s) named in `info', like "Intel+NVIDIA" on hybrid
+    graphics laptops"""
+    if not isinstance(info, str):
+        return None
+    info = info.lower()
+    found = [vendor for vendor, names in GPU_VENDORS if any(each in info for each in names)]
+    if len(found) == 0:
+        return "Other"
+    return "+".join(found)
+
+
+def field(name):
+    """Pull field `name' out of a report, as something hashable"""
+    def value(report):
+        output = report.get(name)
+        if output is None or isinstance(output, str):
+            return output
+        return json.dumps(output, sort_keys=True)
+    return value
+
+
+# what reports can be grouped and filtered by, and how to get it out of one
+DIMENSIONS = {"OS": field("OS"),
+              "system-installer Version": field("system-installer Version"),
+              "GPU vendor": lambda report: gpu_vendor(report.get("PCIe / GPU INFO")),
+              "MODE": field("MODE")}
+
+
+class Aggregates:
+    """Report counts for every combination of `DIMENSIONS' values seen
+
+    There are only so many OS releases, installer versions, GPU vendors and
+    install modes, so there are few enough combinations that any grouping
+    or filter can be answered by walking them."""
+    def __init__(self):
+        self.names = tuple(DIMENSIONS)
+        self.getters = tuple(DIMENSIONS.values())
+        self.combinations = Counter()
+
+    def key(self, report):
+        """Which combination `report' belongs to"""
+        return tuple(each(report) for each in self.getters)
+
+    def add(self, report):
+        """Count `report'"""
+        self.combinations[self.key(report)] += 1
+
+    def remove(self, report):
+        """Stop counting `report'"""
+        key = self.key(report)
+        self.combinations[key] -= 1
+        if self.combinations[key] <= 0:
+            del self.combinations[key]
+
+    def rebuild(self, db):
+        """Throw away the counts and count everything in `db' again"""
+        self.combinations = Counter()
+        for each in db.values():
+            self.add(each)
+
+    def state(self):
+        """The counts as plain data, for restore() to pick back up"""
+        return {"names": self.names, "combinations": self.combinations}
+
+    def restore(self, state):
+        """Pick the counts back up from state(). Raises ValueError if they
+        were kept for different dimensions."""
+        if tuple(state["names"]) != self.names:
+            raise ValueError("Aggregates were saved for different dimensions")
+        self.combinations = Counter(state["combinations"])
+
+    def query(self, group_by=(), filters=None):
+        """Count reports matching `filters' (dimension -> value), grouped by
+        the dimensions in `group_by'
+
+        Returns {"total": count, "groups": [{dimension: value, ...,
+        "count": count}]}, biggest group first. Raises ValueError for
+        dimensions we don't have."""
+        if filters is None:
+            filters = {}
+        for each in list(group_by) + list(filters):
+            if each not in DIMENSIONS:
+                raise ValueError(f"can't group or filter by {each}")
+        wanted = [(self.names.index(name), value) for name, value in filters.items()]
+        positions = [self.names.index(each) for each in group_by]
+        groups = Counter()
+        for key, count in self.combinations.items():
+            if all(key[position] == value for position, value in wanted):
+                groups[tuple(key[each] for each in positions)] += count
+        output = []
+        for key, count in groups.most_common():
+            group = dict(zip(group_by, key))
+            group["count"] = count
+            output.append(group)
+        return {"total": sum(groups.values()), "groups": output}
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  archive.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Retention: moving cold reports out of the DB into a compressed archive
+
+Reports are archived once they have been in the DB longer than a set age,
+if they came from a system-installer older than a set version, or, if the
+DB holds more than a set number, oldest first. The archive is append-only
+segments (see segments.py) of zlib-compressed reports, so archived reports
+can still be looked up by code, just more slowly."""
+from __future__ import print_function
+import sys
+import os
+import re
+import json
+import time
+import zlib
+import segments
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=sys.stderr, **kwargs)
+
+
+if sys.version_info[0] == 2:
+    eprint("Please run with Python 3 as Python 2 is End-of-Life.")
+    exit(2)
+
+
+# the field installer versions are read from
+VERSION_FIELD = "system-installer Version"
+# how hard archived reports are compressed
+COMPRESSION_LEVEL = 9
+
+
+def version_key(version):
+    """`version' as something that sorts the way versions do, or None if it
+    doesn't look like one"""
+    if not isinstance(version, str):
+        return None
+    numbers = re.findall(r"\d+", version)
+    if len(numbers) == 0:
+        return None
+    return tuple(int(each) for each in numbers)
+
+
+class Arrivals:
+    """When each report first got to the DB, logged to `path'
+
+    Reports don't say when they were made, so we go by when we first saw
+    them. A "code time" line is appended for every new report and a
+    "code -" line when it leaves the DB. Reports that were already there
+    before anything was logged count as arriving when they are first seen.
+    Once most of the log is out of date, it is rewritten."""
+    def __init__(self, path):
+        self.path = path
+        self.times = {}
+        lines = 0
+        if os.path.isfile(path):
+            with open(path, "r") as file:
+                for line in file:
+                    fields = line.split()
+                    if len(fields) != 2:
+                        # cut short by a crash
+                        continue
+                    lines += 1
+                    if fields[1] == "-":
+                        self.times.pop(fields[0], None)
+                    else:
+                        self.times[fields[0]] = float(fields[1])
+        self.lines = lines
+        self.file = open(path, "a")
+
+    def stamp(self, codes, when=None):
+        """Note that `codes' have arrived, unless we already knew"""
+        if when is None:
+            when = time.time()
+        new = [each for each in codes if each not in self.times]
+        for each in new:
+            self.times[each] = when
+        self.write("".join(f"{each} {when}\n" for each in new), len(new))
+
+    def drop(self, codes):
+        """Forget `codes', which have left the DB"""
+        gone = [each for each in codes if self.times.pop(each, None) is not None]
+        self.write("".join(f"{each} -\n" for each in gone), len(gone))
+
+    def write(self, text, lines):
+        """Append `lines' lines of `text' to the log"""
+        if lines == 0:
+            return
+        self.file.write(text)
+        self.file.flush()
+        self.lines += lines
+        if self.lines > 2 * len(self.times) + 1000:
+            self.rewrite()
+
+    def rewrite(self):
+        """Write the log out again with only what is still true"""
+        self.file.close()
+        with open(f"{self.path}.tmp", "w") as file:
+            for code, when in self.times.items():
+                file.write(f"{code} {when}\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(f"{self.path}.tmp", self.path)
+        self.lines = len(self.times)
+        self.file = open(self.path, "a")
+
+    def oldest(self):
+        """Every code, longest here first"""
+        return sorted(self.times, key=self.times.get)
+
+    def older_than(self, cutoff):
+        """Codes that arrived before `cutoff'"""
+        return [code for code, when in self.times.items() if when < cutoff]
+
+    def close(self):
+        """Let go of the log"""
+        self.file.close()
+
+
+class Archive:
+    """Reports moved out of the DB, compressed, in append-only segments in
+    `path'
+
+    Only where each report is gets kept in RAM. Like the DB's own segments,
+    a checkpoint saves having to scan them all on start up."""
+    def __init__(self, path):
+        self.path = path
+        state = segments.load_checkpoint(path)
+        if state is not None:
+            state = state["store"]
+        self.store = segments.SegmentStore(path, state=state)
+        # whether it was opened from a checkpoint
+        self.resumed = self.store.resumed
+        self.store.replayed = []
+
+    def put(self, reports):
+        """Archive `reports' (plain dicts) and make sure they are on disk"""
+        for each in reports:
+            self.store.put_raw(each['Installation Report Code'],
+                               zlib.compress(json.dumps(each).encode(), COMPRESSION_LEVEL))
+        self.store.sync()
+
+    def get(self, code):
+        """Archived report `code', or None"""
+        if code not in self.store:
+            return None
+        return json.loads(zlib.decompress(self.store.raw(code)))
+
+    def discard(self, code):
+        """Drop `code' from the archive, if it's there. Returns whether it was."""
+        if code not in self.store:
+            return False
+        del self.store[code]
+        self.store.sync()
+        return True
+
+    def __contains__(self, code):
+        return code in self.store
+
+    def __len__(self):
+        return len(self.store)
+
+    def checkpoint(self):
+        """Save where everything is, so it doesn't have to be scanned for"""
+        self.store.sync()
+        segments.save_checkpoint(self.path, {"store": self.store.state()})
+
+    def backup(self):
+        """Back up what was archived since the last backup"""
+        segments.backup(self.path)
+
+    def close(self):
+        """Let go of all files"""
+        self.store.close()
+
+
+class Retention:
+    """Which reports are cold
+
+    Reports are cold once they have been in the DB more than `max_age'
+    seconds, if their installer version is older than `min_version', or,
+    past the newest `max_reports', oldest first. 0 and "" turn each off."""
+    def __init__(self, max_age=0, min_version="", max_reports=0):
+        self.max_age = max_age
+        self.min_version = version_key(min_version)
+        self.max_reports = max_reports
+        if min_version and self.min_version is None:
+            eprint(f"Retention: {min_version!r} is not a version. Not archiving by version.")
+
+    def enabled(self):
+        """Whether anything is ever cold"""
+        return bool(self.max_age > 0 or self.min_version or self.max_reports > 0)
+
+    def cold(self, db, arrivals, index, aggregates, now=None):
+        """Codes of every report in `db' that should be archived
+
+        Old versions are found through the index and aggregates rather than
+        by reading every report."""
+        if now is None:
+            now = time.time()
+        output = set()
+        if self.max_age > 0:
+            output.update(arrivals.older_than(now - self.max_age))
+        if self.min_version:
+            groups = aggregates.query((VERSION_FIELD,))["groups"]
+            for each in groups:
+                version = version_key(each[VERSION_FIELD])
+                if version is not None and version < self.min_version:
+                    output.update(index.search({VERSION_FIELD: each[VERSION_FIELD]}, db))
+        extra = len(db) - len(output) - self.max_reports
+        if self.max_reports > 0 and extra > 0:
+            for each in arrivals.oldest():
+                if extra == 0:
+                    break
+                if each not in output:
+                    output.add(each)
+                    extra -= 1
+        return output
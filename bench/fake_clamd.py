@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  fake_clamd.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""A stand-in for clamd, listening on a Unix socket, so the filter can be run
+without ClamAV. Anything containing the EICAR test string is a virus."""
+from __future__ import print_function
+import sys
+import os
+import time
+import struct
+import argparse
+import threading
+import socketserver
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=sys.stderr, **kwargs)
+
+
+if sys.version_info[0] == 2:
+    eprint("Please run with Python 3 as Python 2 is End-of-Life.")
+    exit(2)
+
+
+EICAR = b"X5O!P%@AP[4\\PZX54(P^)7CC)7}$EICAR-STANDARD-ANTIVIRUS-TEST-FILE!$H+H*"
+VERSION = "ClamAV 1.0.0/27000/Thu Jan  1 00:00:00 2026"
+
+
+class ClamdHandler(socketserver.StreamRequestHandler):
+    """Answer one clamd command per connection
+
+    Commands may be prefixed with "n" (newline terminated) or "z" (NUL
+    terminated), and are answered the same way."""
+    def read_command(self):
+        """Read the command, returning it and the terminator to answer with"""
+        first = self.rfile.read(1)
+        terminator = b"\n"
+        data = b""
+        if first == b"z":
+            terminator = b"\0"
+        elif first != b"n":
+            # no prefix at all
+            data = first
+        while True:
+            char = self.rfile.read(1)
+            if char in (b"", terminator, b"\n"):
+                break
+            data += char
+        return data.decode(), terminator
+
+    def answer(self, text, terminator):
+        """Send `text' back"""
+        self.wfile.write(text.encode() + terminator)
+
+    def scan_path(self, path):
+        """Scan a file, or every file in a directory"""
+        if os.path.isdir(path):
+            return [line for each in sorted(os.listdir(path))
+                    for line in self.scan_path(os.path.join(path, each))]
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+        except OSError as err:
+            return [f"{path}: {err.strerror}. ERROR"]
+        self.server.delay()
+        if EICAR in data:
+            return [f"{path}: Eicar-Test-Signature FOUND"]
+        return [f"{path}: OK"]
+
+    def handle(self):
+        command, terminator = self.read_command()
+        if command == "":
+            # just checking we're here
+            return
+        name, _, argument = command.partition(" ")
+        self.server.commands += 1
+        if name == "PING":
+            self.answer("PONG", terminator)
+        elif name == "VERSION":
+            self.answer(self.server.version, terminator)
+        elif name == "RELOAD":
+            self.answer("RELOADING", terminator)
+        elif name in ("SCAN", "CONTSCAN", "MULTISCAN", "ALLMATCHSCAN"):
+            for each in self.scan_path(argument):
+                self.answer(each, terminator)
+        elif name == "INSTREAM":
+            data = b""
+            while True:
+                size = struct.unpack("!L", self.rfile.read(4))[0]
+                if size == 0:
+                    break
+                data += self.rfile.read(size)
+            self.server.delay()
+            if EICAR in data:
+                self.answer("stream: Eicar-Test-Signature FOUND", terminator)
+            else:
+                self.answer("stream: OK", terminator)
+        else:
+            self.answer("UNKNOWN COMMAND", terminator)
+
+
+class FakeClamd(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """clamd on Unix socket `path', taking `scan_time' seconds per scan"""
+    daemon_threads = True
+
+    def __init__(self, path, scan_time=0.0, version=VERSION):
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, ClamdHandler)
+        self.path = path
+        self.scan_time = scan_time
+        self.version = version
+        self.commands = 0
+        self.thread = None
+
+    def delay(self):
+        """Pretend scanning takes a while"""
+        if self.scan_time > 0:
+            time.sleep(self.scan_time)
+
+    def start(self):
+        """Serve in a background thread"""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and remove the socket"""
+        self.shutdown()
+        self.server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def main():
+    """Run a fake clamd in the foreground"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("socket")
+    parser.add_argument("--scan-time", type=float, default=0.0)
+    args = parser.parse_args()
+    server = FakeClamd(args.socket, args.scan_time)
+    print(f"Fake clamd listening on {args.socket}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
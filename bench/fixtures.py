@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  fixtures.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""A throwaway GPG keyring and encrypted `.dosir' reports to go with it"""
+from __future__ import print_function
+import sys
+import os
+import json
+import shutil
+import tempfile
+import gnupg
+from fake_clamd import EICAR
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=sys.stderr, **kwargs)
+
+
+if sys.version_info[0] == 2:
+    eprint("Please run with Python 3 as Python 2 is End-of-Life.")
+    exit(2)
+
+
+PASSPHRASE = "benchmark"
+
+
+class Keyring:
+    """A temporary GPG home holding one key, protected by `PASSPHRASE'
+
+    `secrets_file' is in the same format filter.setup_gpg_home() reads."""
+    def __init__(self, path=None):
+        self.owned = path is None
+        if path is None:
+            path = tempfile.mkdtemp(prefix="bench-gpg-")
+        else:
+            os.makedirs(path, mode=0o700, exist_ok=True)
+        self.path = path
+        self.gpg = gnupg.GPG(gnupghome=path)
+        # elliptic curve keys, so we aren't sat waiting on entropy
+        key_input = self.gpg.gen_key_input(key_type="EDDSA", key_curve="ed25519",
+                                           subkey_type="ECDH", subkey_curve="cv25519",
+                                           name_real="Benchmark",
+                                           name_email="bench@localhost",
+                                           passphrase=PASSPHRASE)
+        self.fingerprint = self.gpg.gen_key(key_input).fingerprint
+        if not self.fingerprint:
+            raise RuntimeError(f"Could not make a GPG key in {path}")
+        self.secrets_file = os.path.join(path, "secrets")
+        with open(self.secrets_file, "w") as file:
+            file.write(PASSPHRASE + "\n")
+
+    def encrypt(self, report):
+        """`report' as the bytes of a `.dosir' file"""
+        output = self.gpg.encrypt(json.dumps(report), self.fingerprint, armor=False,
+                                  always_trust=True)
+        if not output.ok:
+            raise RuntimeError(f"Could not encrypt report: {output.status}")
+        return output.data
+
+    def close(self):
+        """Get rid of the keyring, if we made it"""
+        if self.owned:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+def report_name(report):
+    """The file name the installer would upload `report' as"""
+    return f"installation_report-{report['Installation Report Code']}.dosir"
+
+
+def write_reports(keyring, reports, directory, infected=0, garbage=0):
+    """Write `reports', encrypted, into `directory'
+
+    `infected' files containing the EICAR test string and `garbage' files
+    that are named right but won't decrypt are thrown in as well. Returns
+    the names written."""
+    os.makedirs(directory, exist_ok=True)
+    names = []
+    for each in reports:
+        names.append(report_name(each))
+        with open(os.path.join(directory, names[-1]), "wb") as file:
+            file.write(keyring.encrypt(each))
+    for each in range(infected):
+        names.append(f"installation_report-infected{each:08d}.dosir")
+        with open(os.path.join(directory, names[-1]), "wb") as file:
+            file.write(EICAR)
+    for each in range(garbage):
+        names.append(f"installation_report-garbage{each:08d}.dosir")
+        with open(os.path.join(directory, names[-1]), "wb") as file:
+            file.write(os.urandom(2048))
+    return names
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  generator.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Generate synthetic, but realistic looking, installation reports"""
+from __future__ import print_function
+import sys
+import json
+import random
+import argparse
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=sys.stderr, **kwargs)
+
+
+if sys.version_info[0] == 2:
+    eprint("Please run with Python 3 as Python 2 is End-of-Life.")
+    exit(2)
+
+
+# value -> relative weight, for each low-cardinality field
+DISTRIBUTIONS = {
+    "system-installer Version": {"2.4.0": 1, "2.4.1": 3, "2.5.0": 6},
+    "OS": {"Drauger OS 7.5.1": 2, "Drauger OS 7.6": 5, "Drauger OS 7.7": 3},
+    "CPU INFO": {"AMD Ryzen 5 3600": 3, "AMD Ryzen 7 5800X": 2, "Intel Core i5-8250U": 4,
+                 "Intel Core i7-10700K": 2, "Intel Celeron N4020": 1},
+    "PCIe / GPU INFO": {"NVIDIA Corporation GP106 [GeForce GTX 1060 6GB]": 3,
+                        "NVIDIA Corporation TU116 [GeForce GTX 1660 SUPER]": 2,
+                        "Advanced Micro Devices, Inc. [AMD/ATI] Ellesmere [Radeon RX 580]": 2,
+                        "Intel Corporation UHD Graphics 620": 4},
+    "RAM / SWAP INFO": {"4 GB / 1 GB": 1, "8 GB / 2 GB": 4, "16 GB / 4 GB": 3, "32 GB / 4 GB": 1},
+    "MODE": {"GUI": 8, "CLI": 1, "QUICK INSTALL": 2},
+}
+
+CUSTOM_MESSAGES = ["", "", "", "Worked great!", "Wi-Fi did not work after install",
+                   "Installer froze on the partitioning step", "Thanks!"]
+
+LOG_STEPS = ["Partitioning drive", "Formatting partitions", "Mounting filesystems",
+             "Extracting squashfs", "Setting locale", "Setting time zone",
+             "Creating user", "Installing kernel", "Installing bootloader",
+             "Configuring network", "Installing drivers", "Cleaning up"]
+LOG_RESULTS = ["done", "done", "done", "done", "skipped", "retrying"]
+LOG_ERRORS = ["E: Unable to locate package broadcom-sta-dkms",
+              "grub-install: error: cannot find EFI directory.",
+              "mount: /mnt: wrong fs type, bad option, bad superblock on /dev/sda2",
+              "ERROR: Failed to set time zone: Unknown time zone"]
+
+
+class ReportGenerator:
+    """Make reports with field values drawn from `distributions'
+
+    Logs are `log_lines' lines long, give or take 25%, and each line has an
+    `error_rate' chance of being one of a handful of known errors."""
+    def __init__(self, seed=0, log_lines=40, error_rate=0.01, distributions=None):
+        self.rand = random.Random(seed)
+        self.log_lines = log_lines
+        self.error_rate = error_rate
+        if distributions is None:
+            distributions = DISTRIBUTIONS
+        self.choices = {field: (list(values), list(values.values()))
+                        for field, values in distributions.items()}
+        self.count = 0
+
+    def pick(self, field):
+        """A value for `field', following its distribution"""
+        values, weights = self.choices[field]
+        return self.rand.choices(values, weights)[0]
+
+    def log(self):
+        """An installation log"""
+        lines = max(1, int(self.log_lines * self.rand.uniform(0.75, 1.25)))
+        output = []
+        for each in range(lines):
+            if self.rand.random() < self.error_rate:
+                output.append(self.rand.choice(LOG_ERRORS))
+            else:
+                output.append(f"[{each * 1.7:9.3f}] {self.rand.choice(LOG_STEPS)}... "
+                              f"{self.rand.choice(LOG_RESULTS)}")
+        return "\n".join(output)
+
+    def report(self):
+        """The next report"""
+        self.count += 1
+        output = {"Installation Report Code": f"{self.rand.getrandbits(64):016x}{self.count:08d}"}
+        for each in self.choices:
+            output[each] = self.pick(each)
+        output["DISK SETUP"] = {"ROOT": self.rand.choice(["/dev/sda", "/dev/nvme0n1"]),
+                                "EFI": self.rand.choice([True, False]),
+                                "HOME": self.rand.choice([None, "/dev/sdb1"])}
+        output["INSTALLATION LOG"] = self.log()
+        output["CUSTOM MESSAGE"] = self.rand.choice(CUSTOM_MESSAGES)
+        return output
+
+    def reports(self, count):
+        """`count' reports"""
+        return [self.report() for each in range(count)]
+
+
+def main():
+    """Print generated reports, one JSON object per line"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("count", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--log-lines", type=int, default=40)
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    args = parser.parse_args()
+    generator = ReportGenerator(args.seed, args.log_lines, args.error_rate)
+    for each in range(args.count):
+        print(json.dumps(generator.report()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  report_memory.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Compare the memory used by a dict of plain report dicts with a dict of
+report.Report, at different database sizes"""
+from __future__ import print_function
+import sys
+import os
+import json
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from report import Report
+from generator import ReportGenerator
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=sys.stderr, **kwargs)
+
+
+if sys.version_info[0] == 2:
+    eprint("Please run with Python 3 as Python 2 is End-of-Life.")
+    exit(2)
+
+
+def measure(count, log_lines, compact):
+    """Bytes allocated holding `count' reports"""
+    generator = ReportGenerator(count, log_lines)
+    # loaded from JSON so nothing is shared, same as reading it in
+    text = [json.dumps(generator.report()) for each in range(count)]
+    tracemalloc.start()
+    db = {}
+    for each in text:
+        report = json.loads(each)
+        if compact:
+            report = Report(report)
+        db[report['Installation Report Code']] = report
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return used
+
+
+def main():
+    """Run the comparison and print the results as JSON"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--counts", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--log-lines", type=int, default=40)
+    args = parser.parse_args()
+    results = []
+    for count in args.counts:
+        plain_bytes = measure(count, args.log_lines, False)
+        compact_bytes = measure(count, args.log_lines, True)
+        results.append({"reports": count, "log_lines": args.log_lines,
+                        "dict_bytes": plain_bytes, "report_bytes": compact_bytes,
+                        "ratio": compact_bytes / plain_bytes})
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
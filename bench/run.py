@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  run.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Run the benchmark scenarios and print the results as JSON
+
+Scenarios:
+ * filter: reports/second through filter.filter_reports(), with a fake
+   clamd and a throwaway GPG keyring, at different worker counts
+ * intake: time from a report landing in the accepted folder to the DB
+   announcing it has been added
+ * queries: round trip latency of the RECV commands behind
+   get_report_by_id and get_report_by_contents
+ * startup: time from starting the DB process to it being READY, for each
+   storage mode and database size"""
+from __future__ import print_function
+import sys
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import multiprocessing as multiproc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import db
+import router
+import intake_handler as ih
+from generator import ReportGenerator
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=sys.stderr, **kwargs)
+
+
+if sys.version_info[0] == 2:
+    eprint("Please run with Python 3 as Python 2 is End-of-Life.")
+    exit(2)
+
+
+SCENARIOS = ("filter", "intake", "queries", "startup")
+STORAGE_MODES = tuple(db.STORAGE)
+
+
+def quiet(target, *args):
+    """Run `target' with its chatter on stdout thrown away, so it doesn't get
+    mixed in with our results"""
+    sys.stdout = open(os.devnull, "w")
+    target(*args)
+
+
+def start(target, *args):
+    """Start `target' in its own process"""
+    process = multiproc.Process(target=quiet, args=(target,) + args, daemon=True)
+    process.start()
+    return process
+
+
+def latencies(samples):
+    """Summarize `samples', in seconds, as milliseconds"""
+    if len(samples) == 0:
+        return {"count": 0}
+    samples = sorted(samples)
+
+    def percentile(point):
+        return samples[min(len(samples) - 1, int(len(samples) * point / 100))] * 1000
+
+    return {"count": len(samples), "mean_ms": (sum(samples) / len(samples)) * 1000,
+            "p50_ms": percentile(50), "p90_ms": percentile(90),
+            "p99_ms": percentile(99), "max_ms": samples[-1] * 1000}
+
+
+def meta(args):
+    """What was run, where, so results can be compared"""
+    try:
+        commit = subprocess.run(["git", "-C", ROOT, "rev-parse", "HEAD"],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "commit": commit,
+            "python": platform.python_version(), "platform": platform.platform(),
+            "cpus": os.cpu_count(), "args": vars(args)}
+
+
+def populate(path, count, storage, log_lines):
+    """Make a database of `count' reports in `path', returning their codes"""
+    generator = ReportGenerator(count, log_lines)
+    reports = {}
+    for each in range(count):
+        report = generator.report()
+        reports[report["Installation Report Code"]] = report
+    name = os.path.join(path, "reports.json")
+    db.commit(reports, name)
+    # get the reports moved over and checkpointed before anything is timed,
+    # the way they would be on a DB that has run before
+    db_pipe, db_child = multiproc.Pipe()
+    process = start(db.main, db_child, 0.01, name, storage)
+    router.wait_for_ready(db_pipe)
+    db_pipe.send({"COMMIT": True})
+    db_pipe.recv()
+    process.terminate()
+    process.join()
+    return list(reports)
+
+
+def bench_filter(args, work):
+    """Filter throughput at each worker count"""
+    try:
+        import filter
+        from concurrent.futures import ThreadPoolExecutor
+        from fake_clamd import FakeClamd
+        from fixtures import Keyring, write_reports
+    except ImportError as err:
+        return {"skipped": f"could not import what the filter needs: {err}"}
+    clamd = FakeClamd(os.path.join(work, "clamd.sock"), args.scan_time).start()
+    keyring = Keyring(os.path.join(work, "gnupg"))
+    try:
+        fixtures = os.path.join(work, "fixtures")
+        generator = ReportGenerator(args.seed, args.log_lines)
+        names = write_reports(keyring, generator.reports(args.filter_reports), fixtures,
+                              args.infected, args.garbage)
+        gpg, pin = filter.setup_gpg_home(keyring.secrets_file, keyring.path)
+        output = []
+        for workers in args.workers:
+            inbound = os.path.join(work, f"inbound-{workers}")
+            shutil.copytree(fixtures, inbound)
+            with ThreadPoolExecutor(workers) as pool:
+                started = time.perf_counter()
+                outcomes = filter.filter_reports(names, inbound, os.path.join(work, f"ok-{workers}"),
+                                                 os.path.join(work, f"sus-{workers}"), gpg, pin,
+                                                 clamd.server_address, pool)
+                elapsed = time.perf_counter() - started
+            counts = {}
+            for each in outcomes.values():
+                counts[str(each)] = counts.get(str(each), 0) + 1
+            output.append({"workers": workers, "files": len(names), "seconds": elapsed,
+                           "per_second": len(names) / elapsed, "outcomes": counts})
+        return output
+    finally:
+        clamd.stop()
+        keyring.close()
+
+
+def bench_intake(args, work):
+    """Latency from a report being written to the accepted folder to CHANGED,
+    for each storage mode"""
+    return [intake_latency(args, os.path.join(work, storage), storage)
+            for storage in args.storage]
+
+
+def intake_latency(args, path, storage):
+    """Latency from a report being written to the accepted folder to CHANGED,
+    with the DB in `storage' mode"""
+    accepted = os.path.join(path, "accepted")
+    os.makedirs(accepted)
+    name = os.path.join(path, "reports.json")
+    db_pipe, db_child = multiproc.Pipe()
+    intake_pipe, intake_child = multiproc.Pipe()
+    request_pipe, request_child = multiproc.Pipe()
+    processes = [start(db.main, db_child, 0.01, name, storage),
+                 start(ih.main, intake_child, 10, accepted, args.batch_size, args.batch_time)]
+    router.wait_for_ready(db_pipe)
+    processes.append(start(router.route, db_pipe, intake_pipe, request_pipe))
+    generator = ReportGenerator(args.seed, args.log_lines)
+    reports = generator.reports(args.intake_reports)
+    written = {}
+
+    def writer():
+        for each in reports:
+            code = each["Installation Report Code"]
+            with open(os.path.join(accepted, f".{code}.json"), "w") as file:
+                json.dump(each, file)
+            written[code] = time.perf_counter()
+            os.replace(os.path.join(accepted, f".{code}.json"),
+                       os.path.join(accepted, f"{code}.json"))
+            if args.rate > 0:
+                time.sleep(1 / args.rate)
+
+    thread = threading.Thread(target=writer)
+    started = time.perf_counter()
+    thread.start()
+    samples = []
+    deadline = time.monotonic() + args.timeout
+    while len(samples) < len(reports) and time.monotonic() < deadline:
+        if not request_child.poll(0.1):
+            continue
+        data = request_child.recv()
+        arrived = time.perf_counter()
+        for code in data.get("CHANGED") or ():
+            if code in written:
+                samples.append(arrived - written.pop(code))
+    elapsed = time.perf_counter() - started
+    thread.join()
+    for each in processes:
+        each.terminate()
+    output = latencies(samples)
+    output.update({"reports": len(reports), "lost": len(reports) - len(samples),
+                   "per_second": len(samples) / elapsed, "storage": storage,
+                   "batch_size": args.batch_size, "batch_time": args.batch_time})
+    return output
+
+
+def bench_queries(args, work):
+    """Round trip latency of lookups by code and by contents, through the
+    router the same way the request handler makes them, for each storage
+    mode and database size. D-Bus itself isn't included."""
+    output = []
+    for storage, size in [(storage, size) for storage in args.storage for size in args.sizes]:
+        path = os.path.join(work, f"queries-{storage}-{size}")
+        os.makedirs(path)
+        codes = populate(path, size, storage, args.log_lines)
+        name = os.path.join(path, "reports.json")
+        db_pipe, db_child = multiproc.Pipe()
+        intake_pipe, intake_child = multiproc.Pipe()
+        request_pipe, request_child = multiproc.Pipe()
+        processes = [start(db.main, db_child, 0.01, name, storage)]
+        router.wait_for_ready(db_pipe)
+        processes.append(start(router.route, db_pipe, intake_pipe, request_pipe))
+        rand = random.Random(args.seed)
+        generator = ReportGenerator(args.seed + 1)
+        ident = 0
+
+        def call(cmd):
+            nonlocal ident
+            ident += 1
+            cmd["ID"] = ident
+            started = time.perf_counter()
+            request_child.send(cmd)
+            while True:
+                data = request_child.recv()
+                if data.get("ID") == ident:
+                    return time.perf_counter() - started, data
+
+        by_id = []
+        for each in range(args.queries):
+            by_id.append(call({"RECV": {"code": rand.choice(codes)}})[0])
+        by_contents = []
+        matches = 0
+        for each in range(args.queries):
+            # a few fields at once, the way someone narrowing down a bug would
+            term = {field: generator.pick(field)
+                    for field in ("OS", "CPU INFO", "PCIe / GPU INFO", "MODE")}
+            seconds, data = call({"RECV": {"in_report": term}})
+            by_contents.append(seconds)
+            matches += len(data["DATA"] or ())
+        for each in processes:
+            each.terminate()
+        output.append({"reports": size, "storage": storage,
+                       "get_report_by_id": latencies(by_id),
+                       "get_report_by_contents": latencies(by_contents),
+                       "average_matches": matches / max(args.queries, 1)})
+    return output
+
+
+def bench_startup(args, work):
+    """Time until READY for each storage mode and database size"""
+    output = []
+    for storage in args.storage_modes:
+        for size in args.sizes:
+            path = os.path.join(work, f"startup-{storage}-{size}")
+            os.makedirs(path)
+            populate(path, size, storage, args.log_lines)
+            name = os.path.join(path, "reports.json")
+            samples = []
+            for each in range(args.repeat):
+                db_pipe, db_child = multiproc.Pipe()
+                started = time.perf_counter()
+                process = start(db.main, db_child, 0.01, name, storage)
+                router.wait_for_ready(db_pipe)
+                samples.append(time.perf_counter() - started)
+                process.terminate()
+                process.join()
+            summary = latencies(samples)
+            output.append({"storage": storage, "reports": size,
+                           "ready_ms": summary["p50_ms"], "max_ms": summary["max_ms"],
+                           "runs": len(samples)})
+    return output
+
+
+def main():
+    """Run whichever scenarios were asked for"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenarios", nargs="*",
+                        help=f"scenarios to run, out of {', '.join(SCENARIOS)} (default: all of them)")
+    parser.add_argument("--output", help="write results here instead of stdout")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--log-lines", type=int, default=40,
+                        help="average length of generated installation logs")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000],
+                        help="database sizes for the queries and startup scenarios")
+    parser.add_argument("--storage", choices=STORAGE_MODES, nargs="+", default=["journal"],
+                        help="storage modes for the intake and queries scenarios")
+    parser.add_argument("--storage-modes", choices=STORAGE_MODES, nargs="+",
+                        default=list(STORAGE_MODES), help="storage modes to start up")
+    parser.add_argument("--repeat", type=int, default=3, help="startups per measurement")
+    parser.add_argument("--filter-reports", type=int, default=200)
+    parser.add_argument("--infected", type=int, default=2)
+    parser.add_argument("--garbage", type=int, default=2)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--scan-time", type=float, default=0.0,
+                        help="seconds the fake clamd takes per scan")
+    parser.add_argument("--intake-reports", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=200,
+                        help="reports written per second in the intake scenario (0: no limit)")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--batch-time", type=float, default=0.1)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--timeout", type=float, default=120,
+                        help="give up waiting on the intake scenario after this many seconds")
+    args = parser.parse_args()
+    for each in args.scenarios:
+        if each not in SCENARIOS:
+            parser.error(f"unknown scenario: {each}")
+    scenarios = args.scenarios
+    if len(scenarios) == 0:
+        scenarios = list(SCENARIOS)
+    benches = {"filter": bench_filter, "intake": bench_intake, "queries": bench_queries,
+               "startup": bench_startup}
+    results = {"meta": meta(args), "results": {}}
+    work = tempfile.mkdtemp(prefix="bench-")
+    try:
+        for each in scenarios:
+            eprint(f"Running {each}...")
+            os.makedirs(os.path.join(work, each))
+            results["results"][each] = benches[each](args, os.path.join(work, each))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
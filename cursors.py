@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  cursors.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Page through large result sets instead of sending them all at once"""
+from __future__ import print_function
+import sys
+import time
+from collections import OrderedDict
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=sys.stderr, **kwargs)
+
+
+if sys.version_info[0] == 2:
+    eprint("Please run with Python 3 as Python 2 is End-of-Life.")
+    exit(2)
+
+
+class Cursor:
+    """The report codes making up a result set, and how far into it we are"""
+    __slots__ = ("codes", "position", "page_size", "touched")
+
+    def __init__(self, codes, page_size):
+        self.codes = codes
+        self.position = 0
+        self.page_size = page_size
+        self.touched = time.monotonic()
+
+
+class CursorTable:
+    """Open cursors, by ID
+
+    Only report codes are held on to. Reports themselves are looked up a
+    page at a time, so reports deleted in the meantime are skipped. Cursors
+    left alone for `timeout' seconds are closed, and once `limit' are open
+    the least recently used one is closed to make room."""
+    def __init__(self, page_size=100, limit=64, timeout=600):
+        self.page_size = page_size
+        self.limit = limit
+        self.timeout = timeout
+        self.cursors = OrderedDict()
+        self.next_id = 0
+
+    def expire(self):
+        """Close cursors nobody has used in a while"""
+        now = time.monotonic()
+        for each in [key for key, value in self.cursors.items()
+                     if now - value.touched > self.timeout]:
+            del self.cursors[each]
+
+    def open(self, codes, page_size=None):
+        """Open a cursor over `codes'. Returns its ID."""
+        self.expire()
+        if ((page_size is None) or (page_size <= 0) or (page_size > self.page_size)):
+            page_size = self.page_size
+        while len(self.cursors) >= self.limit:
+            self.cursors.popitem(last=False)
+        self.next_id += 1
+        self.cursors[self.next_id] = Cursor(list(codes), page_size)
+        return self.next_id
+
+    def fetch(self, cursor_id, db):
+        """Get the next page of reports from cursor `cursor_id'
+
+        Returns the page and whether that was the last one. The cursor is
+        closed after its last page. Raises KeyError for unknown cursors."""
+        cursor = self.cursors[cursor_id]
+        self.cursors.move_to_end(cursor_id)
+        cursor.touched = time.monotonic()
+        page = []
+        while ((len(page) < cursor.page_size) and (cursor.position < len(cursor.codes))):
+            report = db.get(cursor.codes[cursor.position])
+            cursor.position += 1
+            if report is not None:
+                page.append(report)
+        done = cursor.position >= len(cursor.codes)
+        if done:
+            del self.cursors[cursor_id]
+        return page, done
+
+    def close(self, cursor_id):
+        """Close cursor `cursor_id'. Returns False if it wasn't open."""
+        return self.cursors.pop(cursor_id, None) is not None
@@ -27,8 +27,23 @@ from __future__ import print_function
 import sys
 import json
 import os
-import time
 import shutil
+import threading
+import time
+import pickle
+from abc import ABC, abstractmethod
+from index import ReportIndex
+from aggregates import Aggregates
+from fulltext import FullTextIndex
+from cursors import CursorTable
+import segments
+import sqlstore
+import queries
+from report import Report, plain
+from metrics import Metrics
+from sharedmem import publish
+from archive import Archive, Arrivals, Retention
+import profiling
 
 
 def eprint(*args, **kwargs):
@@ -41,128 +56,1126 @@ if sys.version_info[0] == 2:
     exit(2)
 
 
+# a full backup is made after this many incremental ones
+FULL_BACKUP_EVERY = 24
+# how many cold reports get archived at a time, while nothing else is going on
+ARCHIVE_CHUNK = 200
+
+
+def fsync_dir(name):
+    """Make sure a rename in the directory holding `name' is on disk"""
+    fd = os.open(os.path.dirname(os.path.abspath(name)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_dump(data, name, indent=2):
+    """Write `data' as JSON to `name' without ever exposing a partial file
+
+    It goes to a temporary file first, which is fsync'd and then renamed
+    over `name', so a crash leaves either the old file or the new one."""
+    with open(f"{name}.tmp", "w") as file:
+        json.dump(data, file, indent=indent, default=plain)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(f"{name}.tmp", name)
+    fsync_dir(name)
+
+
 def commit(db, name):
     """Commit DB to disk"""
-    with open(name, "w+") as file:
-        json.dump(db, file, indent=2)
+    atomic_dump(db, name)
+
+
+def replay(db, path, offset=0, changes=None, store=None):
+    """Apply the ADD/DEL records in journal `path', from byte `offset' on,
+    on top of `db'. Reports added go through `store' first, if given, and
+    if `changes' is a list, (old, new) is appended to it for each record.
+    Returns how many records there were and where the last whole one ends."""
+    count = 0
+    if not os.path.isfile(path):
+        return count, offset
+    with open(path, "rb") as file:
+        file.seek(offset)
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            if not (isinstance(record, dict) and line.endswith(b"\n")):
+                # a torn write can only ever be the last record
+                eprint(f"Ignoring incomplete journal record in {path}")
+                break
+            offset += len(line)
+            if "ADD" in record:
+                report = record["ADD"]
+                if store is not None:
+                    report = store(report)
+                code = report['Installation Report Code']
+                old = db.get(code)
+                db[code] = report
+            elif "DEL" in record:
+                report = None
+                old = db.pop(record["DEL"], None)
+            else:
+                continue
+            count += 1
+            if changes is not None:
+                changes.append((old, report))
+    return count, offset
 
 
 def read(name):
-    """Read DB into RAM"""
+    """Read DB into RAM
+
+    The snapshot in `name' is loaded first, then any journal records
+    written since the last compaction are replayed on top of it."""
     with open(name, "r") as file:
-        return json.load(file)
+        db = json.load(file)
+    replay(db, f"{name}.journal.compacting")
+    replay(db, f"{name}.journal")
+    return db
+
+
+def journal_name(path):
+    """What the journal `path' was named when it was started, or None"""
+    try:
+        with open(path, "rb") as file:
+            return json.loads(file.readline()).get("JOURNAL")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def open_journal(path):
+    """Open journal `path' for appending, starting it with a record naming
+    it if it is new, so checkpoints can tell which journal they were taken
+    against"""
+    journal = open(path, "a")
+    if journal.tell() == 0:
+        journal_append(journal, [{"JOURNAL": time.time_ns()}])
+    return journal
+
+
+def journal_append(journal, records):
+    """Append records to the journal and make sure they hit the disk"""
+    for each in records:
+        journal.write(json.dumps(each) + "\n")
+    journal.flush()
+    os.fsync(journal.fileno())
+
+
+def snapshot(db, name):
+    """Write a snapshot of `db' to `name'"""
+    # the compaction thread uses its own temporary file
+    with open(f"{name}.snapshot", "w") as file:
+        json.dump(db, file, indent=2, default=plain)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(f"{name}.snapshot", name)
+    fsync_dir(name)
+
+
+def fold(db, name):
+    """Write `db' out to `name' in the background, then remove the rotated
+    journal it takes in. Returns the thread doing it."""
+    def worker(data):
+        snapshot(data, name)
+        os.remove(f"{name}.journal.compacting")
+
+    # reports are never mutated in place, so a shallow copy is consistent
+    thread = threading.Thread(target=worker, args=(dict(db),), daemon=True)
+    thread.start()
+    return thread
+
+
+def compact(db, name, journal):
+    """Fold the journal into a new snapshot in the background
+
+    The live journal is rotated out of the way first, so new records can keep
+    being appended while the snapshot is written. Returns the new journal and
+    the thread doing the compaction."""
+    journal.close()
+    os.replace(f"{name}.journal", f"{name}.journal.compacting")
+    journal = open_journal(f"{name}.journal")
+    return journal, fold(db, name)
+
+
+def incremental_backups(name):
+    """Paths of the incremental backups made since the last full one, oldest first"""
+    if not os.path.isdir(f"{name}.bak.d"):
+        return []
+    return [os.path.join(f"{name}.bak.d", each)
+            for each in sorted(os.listdir(f"{name}.bak.d"))
+            if each[:4] == "inc-" and each[-5:] == ".json"]
+
+
+def restore(name):
+    """The database as of the last backup: the last full backup, with every
+    incremental backup made on top of it applied"""
+    with open(f"{name}.bak", "r") as file:
+        db = json.load(file)
+    # full backups from before they had generations are just the reports
+    generation = None
+    if set(db.keys()) == {"GENERATION", "REPORTS"}:
+        generation = db["GENERATION"]
+        db = db["REPORTS"]
+    for each in incremental_backups(name):
+        with open(each, "r") as file:
+            changes = json.load(file)
+        if changes.get("GENERATION") != generation:
+            # left over from before the full backup, which already has it
+            continue
+        db.update(changes["ADD"])
+        for code in changes["DEL"]:
+            db.pop(code, None)
+    return db
 
 
 def recover(name):
     """Recover DB from corruption"""
     if not os.path.isfile(f"{name}.bak"):
         raise FileNotFoundError(f"Cannot find recovery file: {name}.bak")
-    shutil.copy2(f"{name}.bak", name)
+    commit(restore(name), name)
+    # the backup is the whole story, so nothing may be replayed on top of it
+    for each in (f"{name}.journal", f"{name}.journal.compacting"):
+        if os.path.isfile(each):
+            os.remove(each)
 
 
-def backup(name):
-    """Make a backup of the database"""
-    if not os.path.isfile(name):
-        raise FileNotFoundError(f"Cannot find recovery file: {name}")
-    shutil.copy2(name, f"{name}.bak")
+def backup(name, db, dirty=None, generation=None):
+    """Make a backup of the database
 
+    If `dirty' (the codes of reports added or deleted since the last backup)
+    is given, only those reports are written, as an incremental backup on top
+    of the last full one, whose `generation' this was given. Otherwise, or
+    once FULL_BACKUP_EVERY incremental backups have piled up, all of `db'
+    is backed up again, under a new generation. Returns the generation of
+    the full backup now in place.
 
-def main(pipe, freq, db_name):
-    """DB management thread"""
-    print("DB Running!")
-    done = {"DONE": True}
-    if not os.path.isfile(db_name):
-        if not os.path.isfile(f"{db_name}.bak"):
-            commit({}, db_name)
+    Incremental backups are stamped with the generation they go on top of,
+    so any a crash left behind after a full backup are never applied on top
+    of it."""
+    incrementals = incremental_backups(name)
+    if ((dirty is None) or (generation is None) or (not os.path.isfile(f"{name}.bak")) or
+            (len(incrementals) >= FULL_BACKUP_EVERY)):
+        # only has to be different from every other full backup's
+        generation = time.time_ns()
+        atomic_dump({"GENERATION": generation, "REPORTS": db}, f"{name}.bak")
+        for each in incrementals:
+            os.remove(each)
+        return generation
+    changes = {"GENERATION": generation, "ADD": {}, "DEL": []}
+    for each in dirty:
+        if each in db:
+            changes["ADD"][each] = db[each]
         else:
-            recover(db_name)
-    db = read(db_name)
+            changes["DEL"].append(each)
+    number = 1
+    if len(incrementals) > 0:
+        number = int(os.path.basename(incrementals[-1])[4:-5]) + 1
+    os.makedirs(f"{name}.bak.d", exist_ok=True)
+    atomic_dump(changes, os.path.join(f"{name}.bak.d", f"inc-{number:06d}.json"), None)
+    return generation
+
+
+# reports per message when handing a replica everything
+SYNC_CHUNK = 1000
+
+
+def reply(data, cmd):
+    """Tag `data' with the ID of the command it answers, if it had one"""
+    if "ID" in cmd:
+        data["ID"] = cmd["ID"]
+    return data
+
+
+def migrate(db_name, path, factory):
+    """Open the store at `path' with `factory(path)', moving reports over
+    from the JSON database `db_name' the first time. The JSON database is
+    left as `{db_name}.migrated', so it never gets imported twice."""
+    db = factory(path)
+    if len(db) == 0 and os.path.isfile(db_name):
+        old = read(db_name)
+        if len(old) > 0:
+            print(f"Moving {len(old)} reports into {path}")
+            for code, report in old.items():
+                db[code] = report
+            db.sync()
+        os.replace(db_name, f"{db_name}.migrated")
+    return db
+
+
+class Storage(ABC):
+    """How the DB keeps reports on disk, picked by the `storage' setting
+
+    `open()' hands back the dict-like of report code -> report the DB works
+    on, and every ADD or DEL made to it is followed by `persist()'. The
+    rest map onto the COMMIT, BACKUP, RECOVER and READ commands. Those six
+    have to be implemented; everything else has a default."""
+    # whether all the reports are held in RAM, rather than read off disk
+    in_memory = True
+    # whether backups can be made of just the reports changed since the last
+    incremental = False
+    # whether read replicas read reports from our files themselves
+    shared = False
+
+    def __init__(self, name, compact_reports=False):
+        self.name = name
+        self.compact_reports = compact_reports and self.in_memory
+        self.db = None
+        # the database and its backup, which CHECK makes sure are there
+        self.files = (name, f"{name}.bak")
+
+    @abstractmethod
+    def open(self):
+        """Load the database, returning the reports"""
+
+    @abstractmethod
+    def persist(self, records):
+        """Get the ADD/DEL `records' just applied to the reports onto disk"""
+
+    @abstractmethod
+    def commit(self):
+        """Write everything out in full"""
+
+    @abstractmethod
+    def backup(self, dirty=None):
+        """Back up the database, only the codes in `dirty' if we can and it
+        isn't None. Returns what kind of backup was made, for metrics."""
+
+    @abstractmethod
+    def recover(self):
+        """Replace the database on disk with the backup, returning the
+        reports to use from now on"""
+
+    @abstractmethod
+    def reload(self):
+        """Read the database back in from disk, returning the reports"""
+
+    def maintain(self, idle=False):
+        """Start any housekeeping that is due. `idle' is set when there are no
+        commands waiting. Returns True if a compaction was started."""
+        return False
+
+    def make_index(self):
+        """Something to look up reports by their queryable fields"""
+        return ReportIndex()
+
+    def checkpoint(self, views):
+        """Save the `views' kept alongside the reports, if we can, so the next
+        open() doesn't have to rebuild them"""
+        return None
+
+    def restore_views(self, views):
+        """Pick `views' back up from the last checkpoint() and catch them up
+        with whatever has been written since. Returns False if they have to
+        be rebuilt from the reports instead."""
+        return False
+
+    def snapshot(self, views):
+        """Where read replicas can load the reports and `views' from as they
+        are now, if they can read them from our files"""
+        return None
+
+    def locations(self, codes):
+        """Where replicas reading our files will find reports `codes'"""
+        return None
+
+
+class JsonStorage(Storage):
+    """All reports in RAM, rewriting all of `name' on every change"""
+    incremental = True
+
+    def __init__(self, name, compact_reports=False):
+        super().__init__(name, compact_reports)
+        # of the last full backup we made, which incremental ones go on top of
+        self.generation = None
+
+    def load(self):
+        """Read `name' (and anything journaled on top of it)"""
+        self.db = read(self.name)
+        if self.compact_reports:
+            self.db = {code: Report(report) for code, report in self.db.items()}
+        return self.db
+
+    def ensure(self):
+        """Make sure there is a snapshot to load, from the backup if need be"""
+        if not os.path.isfile(self.name):
+            if not os.path.isfile(f"{self.name}.bak"):
+                commit({}, self.name)
+            else:
+                recover(self.name)
+
+    def open(self):
+        self.ensure()
+        self.load()
+        # start every run from a clean snapshot with an empty journal
+        if (os.path.isfile(f"{self.name}.journal") or
+                os.path.isfile(f"{self.name}.journal.compacting")):
+            snapshot(self.db, self.name)
+            for each in (f"{self.name}.journal", f"{self.name}.journal.compacting"):
+                if os.path.isfile(each):
+                    os.remove(each)
+        return self.db
+
+    def persist(self, records):
+        commit(self.db, self.name)
+
+    def commit(self):
+        commit(self.db, self.name)
+
+    def backup(self, dirty=None):
+        last = self.generation
+        self.generation = backup(self.name, self.db, dirty, last)
+        return "incremental" if self.generation == last else "full"
+
+    def recover(self):
+        # what's in RAM stays until the next READ
+        recover(self.name)
+        return self.db
+
+    def reload(self):
+        return self.load()
+
+
+class JournalStorage(JsonStorage):
+    """All reports in RAM, appending every change to `{name}.journal'. Once
+    `compact_threshold' records have been journaled they are folded into
+    `name' in the background.
+
+    Checkpoints pickle the reports and views to `{name}.checkpoint', noting
+    which journal they were taken against and how far into it. open() picks
+    up from there, replaying only what was journaled since, instead of
+    parsing `name' and rebuilding the views from every report."""
+    def __init__(self, name, compact_reports=False, compact_threshold=1000):
+        super().__init__(name, compact_reports)
+        self.compact_threshold = compact_threshold
+        self.journal = None
+        self.compaction = None
+        self.journaled = 0
+        self.saved_views = None
+        # (old, new) for each record replayed on top of the checkpoint
+        self.replayed = []
+
+    def settle(self):
+        """Wait for a running compaction so the files on disk are consistent"""
+        if self.compaction is not None:
+            self.compaction.join()
+
+    def resume(self):
+        """Load the reports from the last checkpoint and replay what was
+        journaled after it. Returns where the live journal's last whole
+        record ends, or None if there is no checkpoint we can use."""
+        state = segments.read_checkpoint(f"{self.name}.checkpoint")
+        if state is None or state["compact"] != self.compact_reports:
+            return None
+        name, offset = state["journal"]
+        live = f"{self.name}.journal"
+        rotated = f"{self.name}.journal.compacting"
+        if name is None:
+            return None
+        if journal_name(live) == name:
+            # records added before the checkpoint still count towards the
+            # next compaction
+            tail = [(live, offset)]
+            self.journaled = state["journaled"]
+        elif journal_name(rotated) == name:
+            # rotated out for a compaction that didn't get to finish
+            tail = [(rotated, offset), (live, 0)]
+            self.journaled = 0
+        else:
+            return None
+        if os.path.getsize(tail[0][0]) < offset:
+            return None
+        self.db = state["reports"]
+        self.saved_views = state["views"]
+        store = Report if self.compact_reports else None
+        for path, start in tail:
+            count, end = replay(self.db, path, start, self.replayed, store)
+        self.journaled += count
+        return end
+
+    def open(self):
+        self.ensure()
+        live = f"{self.name}.journal"
+        self.saved_views = None
+        self.replayed = []
+        end = self.resume()
+        if end is None:
+            with open(self.name, "r") as file:
+                self.db = json.load(file)
+            replay(self.db, f"{self.name}.journal.compacting")
+            self.journaled, end = replay(self.db, live)
+            if self.compact_reports:
+                self.db = {code: Report(report) for code, report in self.db.items()}
+        # nothing gets written before the DB is ready, past cutting off a
+        # record torn by a crash so new ones don't end up glued to it
+        if os.path.isfile(live) and os.path.getsize(live) > end:
+            os.truncate(live, end)
+        if os.path.isfile(f"{self.name}.journal.compacting"):
+            self.compaction = fold(self.db, self.name)
+        self.journal = open_journal(live)
+        return self.db
+
+    def checkpoint(self, views):
+        name = journal_name(f"{self.name}.journal")
+        if name is None:
+            # started by an older version; the next compaction replaces it
+            return
+        segments.write_checkpoint(f"{self.name}.checkpoint",
+                                  {"journal": (name, os.fstat(self.journal.fileno()).st_size),
+                                   "journaled": self.journaled,
+                                   "compact": self.compact_reports,
+                                   "reports": self.db,
+                                   "views": [each.state() for each in views]})
+
+    def restore_views(self, views):
+        saved, self.saved_views = self.saved_views, None
+        if saved is None or len(saved) != len(views):
+            return False
+        try:
+            for view, state in zip(views, saved):
+                view.restore(state)
+        except (ValueError, KeyError, TypeError):
+            return False
+        for old, new in self.replayed:
+            for each in views:
+                if old is not None:
+                    each.remove(old)
+                if new is not None:
+                    each.add(new)
+        self.replayed = []
+        return True
+
+    def persist(self, records):
+        journal_append(self.journal, records)
+        self.journaled += len(records)
+
+    def commit(self):
+        self.settle()
+        self.journal, self.compaction = compact(self.db, self.name, self.journal)
+        self.journaled = 0
+        self.settle()
+
+    def recover(self):
+        self.settle()
+        self.journal.close()
+        if os.path.isfile(f"{self.name}.checkpoint"):
+            os.remove(f"{self.name}.checkpoint")
+        super().recover()
+        self.journal = open_journal(f"{self.name}.journal")
+        return self.db
+
+    def maintain(self, idle=False):
+        if self.journaled < self.compact_threshold:
+            return False
+        if self.compaction is not None and self.compaction.is_alive():
+            return False
+        self.journal, self.compaction = compact(self.db, self.name, self.journal)
+        self.journaled = 0
+        return True
+
+
+class SegmentStorage(Storage):
+    """Reports in append-only segment files in `{name}.segments', with only
+    their locations in RAM
+
+    Checkpoints keep those locations and the views, so opening the store
+    again only has to read what was appended since. Report bodies are only
+    read when something asks for them. Read replicas start from a checkpoint
+    and read the segments themselves, rather than keeping their own copy."""
+    in_memory = False
+    shared = True
+
+    def __init__(self, name, compact_reports=False):
+        super().__init__(name, compact_reports)
+        self.files = (f"{name}.segments", f"{name}.segments.bak")
+        self.saved_views = None
+
+    def open(self):
+        segments.settle_compaction(self.files[0])
+        segments.settle_backup(self.files[0])
+        if ((not os.path.isdir(self.files[0])) and os.path.isdir(self.files[1])):
+            segments.recover(self.files[0])
+        state = segments.load_checkpoint(self.files[0])
+        self.saved_views = None
+        if state is not None:
+            self.saved_views = state["views"]
+            state = state["store"]
+        self.db = migrate(self.name, self.files[0],
+                          lambda path: segments.SegmentStore(path, state=state))
+        return self.db
+
+    def checkpoint(self, views):
+        self.db.sync()
+        segments.save_checkpoint(self.files[0],
+                                 {"store": self.db.state(),
+                                  "views": [each.state() for each in views]})
+
+    def restore_views(self, views):
+        saved, self.saved_views = self.saved_views, None
+        if saved is None or (not self.db.resumed) or len(saved) != len(views):
+            return False
+        try:
+            for view, state in zip(views, saved):
+                view.restore(state)
+        except (ValueError, KeyError, TypeError):
+            return False
+        # what was overwritten is still in its segment, so it can be taken
+        # back out of the views the same way it went in
+        for code, old, new in self.db.replayed:
+            if old is not None:
+                report = json.loads(self.db.read(old))
+                for each in views:
+                    each.remove(report)
+            if new is not None:
+                report = json.loads(self.db.read(new))
+                for each in views:
+                    each.add(report)
+        self.db.replayed = []
+        return True
+
+    def snapshot(self, views):
+        self.checkpoint(views)
+        return self.files[0]
+
+    def locations(self, codes):
+        return {each: self.db.offsets[each] for each in codes}
+
+    def persist(self, records):
+        self.db.sync()
+
+    def commit(self):
+        self.db.sync()
+
+    def backup(self, dirty=None):
+        segments.backup(self.files[0])
+        return "segments"
+
+    def recover(self):
+        # the store has the old files open, so it has to come along
+        self.db.close()
+        segments.recover(self.files[0])
+        return self.open()
+
+    def reload(self):
+        self.db.close()
+        return self.open()
+
+    def maintain(self, idle=False):
+        if not (idle and self.db.needs_compaction()):
+            return False
+        print("Compacting segments!")
+        self.db.compact()
+        return True
+
+
+class SqliteStorage(Storage):
+    """Reports in the SQLite database `{name}.sqlite' (see sqlstore.py),
+    backed up to `{name}.sqlite.bak' with SQLite's online backup"""
+    in_memory = False
+
+    def __init__(self, name, compact_reports=False):
+        super().__init__(name, compact_reports)
+        self.files = (f"{name}.sqlite", f"{name}.sqlite.bak")
+
+    def open(self):
+        if ((not os.path.isfile(self.files[0])) and os.path.isfile(self.files[1])):
+            shutil.copyfile(self.files[1], self.files[0])
+        self.db = migrate(self.name, self.files[0], sqlstore.SqliteStore)
+        return self.db
+
+    def persist(self, records):
+        self.db.sync()
+
+    def commit(self):
+        self.db.checkpoint()
+
+    def backup(self, dirty=None):
+        self.db.backup(self.files[1])
+        return "sqlite"
+
+    def recover(self):
+        self.db.recover(self.files[1])
+        return self.db
+
+    def reload(self):
+        self.db.close()
+        return self.open()
+
+    def make_index(self):
+        return sqlstore.FieldIndex()
+
+
+# the `storage' setting -> what it means
+STORAGE = {"json": JsonStorage, "journal": JournalStorage, "segments": SegmentStorage,
+           "sqlite": SqliteStorage}
+
+
+def main(pipe, freq, db_name, storage="journal", compact_threshold=1000, page_size=100,
+         compact_reports=True, metrics_interval=0, shm_threshold=0, replica_feeds=(),
+         heartbeat=1.0, retention_days=0, retention_min_version="", retention_max_reports=0,
+         retention_interval=3600, profile_dir="", profile_mode="sampling"):
+    """DB management thread
+
+    Whenever reports change, {"CHANGED": [codes], "VERSION": version} is sent
+    so anything caching reports can drop them. {"CHANGED": None} means
+    everything may have changed. The version goes up by one with every
+    change.
+
+    Every change is also sent down each of `replica_feeds' (see replica.py),
+    pickled just the once. Replicas start with a copy of everything, except
+    with "segments" storage, where they start from a checkpoint and read
+    the segments themselves. When
+    nothing has changed for `heartbeat' seconds they are told so, which is
+    how they know how far behind they could be.
+
+    Commands may carry an "ID", which is copied into whatever reply they
+    get, so callers with several requests in flight can match them up.
+
+    `storage' picks how reports are kept:
+     * "json": all in RAM, rewriting all of `db_name' on every ADD
+     * "journal": all in RAM, appending every ADD and DEL to
+       `{db_name}.journal'. Once `compact_threshold' records have been
+       journaled they are folded into `db_name' in the background.
+       Starts from a checkpoint in `{db_name}.checkpoint'.
+     * "segments": in append-only segment files in `{db_name}.segments',
+       with only their locations in RAM
+     * "sqlite": in the SQLite database `{db_name}.sqlite', with the
+       queryable fields indexed there rather than in RAM
+    See the Storage classes above.
+
+    With `compact_reports' set, reports held in RAM are stored as
+    report.Report instead of plain dicts.
+
+    Large results can be paged through with CURSOR commands, `page_size'
+    reports at a time. AGGREGATE commands get fleet statistics from counts
+    kept up to date on every ADD and DEL, without looking at any reports.
+    SEARCH commands find reports by the text of their logs and messages,
+    best match first.
+
+    Every `metrics_interval' seconds that anything happened, a
+    {"METRICS": snapshot} is sent along with everything else.
+
+    Replies that come to `shm_threshold' characters or more as JSON are
+    sent as {"SHM": handle} instead of {"DATA": ...}, with the JSON in
+    shared memory (see sharedmem.py), and smaller ones as {"REPLY": json}.
+    0 means never, and replies are sent as {"DATA": ...}.
+
+    Every `retention_interval' seconds, reports that have been in the DB
+    more than `retention_days' days, that came from a system-installer older
+    than `retention_min_version', or that are past the newest
+    `retention_max_reports', are moved to the archive in `{db_name}.archive'
+    (see archive.py) while nothing else is going on. Archived reports can
+    still be had with RECV "code", and deleted, but nothing else sees them.
+
+    SIGUSR1 and SIGUSR2 start and stop profiling into `profile_dir' (see
+    profiling.py)."""
+    print("DB Running!")
+    if storage == "journal":
+        storage = JournalStorage(db_name, compact_reports, compact_threshold)
+    else:
+        storage = STORAGE[storage](db_name, compact_reports)
+    db = storage.open()
+    compact_reports = storage.compact_reports
+    index = storage.make_index()
+    aggregates = Aggregates()
+    text_index = FullTextIndex()
+    # everything kept up to date as reports come and go
+    views = (index, aggregates, text_index)
+    restored = storage.restore_views(views)
+    if not restored:
+        for each in views:
+            each.rebuild(db)
+    retention = Retention(retention_days * 24 * 60 * 60, retention_min_version,
+                          retention_max_reports)
+    archive = None
+    arrivals = None
+    if retention.enabled() or os.path.isdir(f"{db_name}.archive"):
+        archive = Archive(f"{db_name}.archive")
+    if retention.enabled():
+        arrivals = Arrivals(f"{db_name}.arrivals")
+        arrivals.stamp(list(db.keys()))
+    # codes found to be cold, waiting to be archived, and codes added since
+    # they were found, which may not be cold any more
+    cold = []
+    fresh = set()
+    retention_due = time.monotonic()
+    cursors = CursorTable(page_size)
+    metrics = Metrics("db", metrics_interval)
+    profiling.setup("db", profile_dir, profile_mode, metrics)
+    metrics.gauge("db_reports", len(db))
+    if archive is not None:
+        metrics.gauge("db_archived_reports", len(archive))
+    # codes changed since the last backup. None means we don't know, so the
+    # next backup has to be a full one.
+    dirty = None
+
+    def store(report):
+        """What actually gets kept in `db' for `report'"""
+        if compact_reports:
+            return Report(report)
+        return report
+
+    def persist(records):
+        """Get the ADD/DEL `records' just applied to `db' onto disk"""
+        started = time.perf_counter()
+        storage.persist(records)
+        metrics.observe("db_persist_seconds", time.perf_counter() - started)
+        metrics.gauge("db_reports", len(db))
+
+    def make_backup():
+        """Back up the database, as incrementally as we can"""
+        nonlocal dirty
+        started = time.perf_counter()
+        metrics.count("db_backups_total", kind=storage.backup(dirty))
+        if storage.incremental:
+            dirty = set()
+        storage.checkpoint(views)
+        if archive is not None:
+            archive.backup()
+            archive.checkpoint()
+        metrics.observe("db_backup_seconds", time.perf_counter() - started)
+
+    def track(report):
+        """Add `report' to the indexes and aggregates"""
+        for each in views:
+            each.add(report)
+
+    def forget(report):
+        """Take `report' back out of the indexes and aggregates"""
+        for each in views:
+            each.remove(report)
+
+    def rebuild_views():
+        """Build the indexes and aggregates back up after `db' was replaced"""
+        if arrivals is not None:
+            arrivals.stamp(list(db.keys()))
+        if storage.restore_views(views):
+            return
+        for each in views:
+            each.rebuild(db)
+
+    def arrived(codes):
+        """Note reports `codes' coming in, taking any older copies out of
+        the archive"""
+        if arrivals is not None:
+            arrivals.stamp(codes)
+        if len(cold) > 0:
+            fresh.update(codes)
+        if archive is not None:
+            for each in codes:
+                archive.discard(each)
+
+    def retire(codes):
+        """Move reports `codes' out of `db' and into the archive, unless they
+        have gone or been added again since they were found to be cold"""
+        started = time.perf_counter()
+        reports = [(each, db[each]) for each in codes if each in db and each not in fresh]
+        if len(reports) == 0:
+            return
+        # archived first, so a crash can't lose them
+        archive.put([plain(report) for code, report in reports])
+        codes = [code for code, report in reports]
+        for code, report in reports:
+            forget(report)
+            del db[code]
+        persist([{"DEL": each} for each in codes])
+        arrivals.drop(codes)
+        touch(codes)
+        metrics.count("db_archived_total", len(codes))
+        metrics.gauge("db_archived_reports", len(archive))
+        metrics.observe("db_archive_seconds", time.perf_counter() - started)
+        print(f"ARCHIVED {len(codes)} REPORTS")
+        changed(codes, deleted=codes)
+
+    def reconcile():
+        """Take reports that are also in the archive back out of `db', after
+        it has been replaced with one from before they were archived. Adding
+        a report takes it out of the archive, so the archived copy is never
+        the older one."""
+        if archive is None:
+            return
+        codes = [each for each in db.keys() if each in archive]
+        if len(codes) == 0:
+            return
+        for each in codes:
+            forget(db[each])
+            del db[each]
+        persist([{"DEL": each} for each in codes])
+        if arrivals is not None:
+            arrivals.drop(codes)
+        print(f"{len(codes)} RECOVERED REPORTS WERE ALREADY ARCHIVED")
+
+    def answer(output, cmd):
+        """Send `output' back as the reply to `cmd'"""
+        if shm_threshold <= 0:
+            pipe.send(reply({"DATA": output}, cmd))
+            return
+        # we have to serialize it to know how big it is, so it goes on
+        # serialized either way rather than be done again at the other end
+        text = json.dumps({"DATA": output})
+        if len(text) < shm_threshold:
+            pipe.send(reply({"REPLY": text}, cmd))
+            return
+        metrics.count("db_shared_replies_total")
+        metrics.count("db_shared_reply_bytes_total", len(text))
+        pipe.send(reply({"SHM": publish(text)}, cmd))
+
+    def feed(message):
+        """Send `message' to every replica, stamped with the version and time"""
+        nonlocal fed
+        if len(replica_feeds) == 0:
+            return
+        message["version"] = version
+        message["time"] = time.time()
+        data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        for each in list(replica_feeds):
+            try:
+                each.send_bytes(data)
+            except OSError:
+                eprint("A read replica has gone away. No longer sending it changes.")
+                replica_feeds.remove(each)
+        fed = time.monotonic()
+
+    def sync_replicas():
+        """Give every replica a fresh copy of everything, or somewhere to
+        read it from"""
+        if len(replica_feeds) == 0:
+            return
+        snapshot = storage.snapshot(views)
+        if snapshot is not None:
+            feed({"RESET": True, "SNAPSHOT": snapshot, "SYNCED": True})
+            return
+        feed({"RESET": True})
+        chunk = []
+        for each in db.values():
+            chunk.append(each)
+            if len(chunk) >= SYNC_CHUNK:
+                feed({"ADD": chunk})
+                chunk = []
+        if len(chunk) > 0:
+            feed({"ADD": chunk})
+        feed({"SYNCED": True})
+
+    def changed(codes, added=(), deleted=()):
+        """Tell replicas about reports `added' and codes `deleted', and
+        everyone caching reports that `codes' (None for all) changed"""
+        nonlocal version
+        version += 1
+        if codes is None:
+            sync_replicas()
+        elif len(replica_feeds) > 0:
+            message = {"ADD": list(added), "DEL": list(deleted)}
+            if storage.shared:
+                message["WHERE"] = storage.locations(
+                    [each['Installation Report Code'] for each in added])
+            feed(message)
+        pipe.send({"CHANGED": codes, "VERSION": version})
+
+    def touch(codes):
+        """Note reports that changed since the last backup"""
+        if dirty is not None:
+            dirty.update(codes)
+
+    replica_feeds = list(replica_feeds)
     sleep_count = 0
+    version = 0
+    fed = time.monotonic()
     pipe.send({"STATUS": "READY"})
-    time.sleep(0.1)
+    # so next time we don't have to go through every report again, taken
+    # once nothing is waiting on us
+    checkpoint_due = not restored
+    if archive is not None and not archive.resumed:
+        archive.checkpoint()
+    sync_replicas()
     modified = False
     while True:
-        if not pipe.poll():
+        metrics.push(pipe)
+        if len(replica_feeds) > 0 and time.monotonic() - fed >= heartbeat:
+            feed({"BEAT": True})
+        if not pipe.poll(freq * 2):
             if ((sleep_count > 1000) and modified):
                 print("Backing up!")
-                backup(db_name)
+                make_backup()
                 sleep_count = 0
                 modified = False
+            elif len(cold) > 0:
+                retire(cold[:ARCHIVE_CHUNK])
+                del cold[:ARCHIVE_CHUNK]
+                modified = True
+            elif arrivals is not None and time.monotonic() >= retention_due:
+                fresh.clear()
+                cold = sorted(retention.cold(db, arrivals, index, aggregates))
+                retention_due = time.monotonic() + retention_interval
+            elif checkpoint_due:
+                storage.checkpoint(views)
+                checkpoint_due = False
+            elif storage.maintain(True):
+                metrics.count("db_compactions_total")
+                storage.checkpoint(views)
+                if storage.shared:
+                    # the segments replicas were reading have gone
+                    sync_replicas()
             else:
                 sleep_count += 1
-            time.sleep(freq * 2)
             continue
         cmd = pipe.recv()
+        started = time.perf_counter()
         sleep_count = 0
         if "ADD" in cmd.keys():
             # add new entry to DB
-            db[cmd["ADD"]['Installation Report Code']] = cmd["ADD"]
+            if cmd["ADD"]['Installation Report Code'] in db:
+                forget(db[cmd["ADD"]['Installation Report Code']])
+            db[cmd["ADD"]['Installation Report Code']] = store(cmd["ADD"])
+            track(cmd["ADD"])
             print(f"ADDED REPORT: {cmd['ADD']['Installation Report Code']}")
-            pipe.send(done)
-            commit(db, db_name)
+            persist([cmd])
+            touch([cmd["ADD"]['Installation Report Code']])
+            arrived([cmd["ADD"]['Installation Report Code']])
+            pipe.send(reply({"DONE": True}, cmd))
+            changed([cmd["ADD"]['Installation Report Code']],
+                    [db[cmd["ADD"]['Installation Report Code']]])
             modified = True
+        elif "ADD_BATCH" in cmd.keys():
+            # add many entries, but only go to disk once
+            results = []
+            added = []
+            for each in cmd["ADD_BATCH"]:
+                if not isinstance(each, dict):
+                    results.append("Report is not a JSON object")
+                    continue
+                if 'Installation Report Code' not in each:
+                    results.append("Report has no Installation Report Code")
+                    continue
+                if each['Installation Report Code'] in db:
+                    forget(db[each['Installation Report Code']])
+                db[each['Installation Report Code']] = store(each)
+                track(each)
+                added.append({"ADD": each})
+                results.append(True)
+            if len(added) > 0:
+                persist(added)
+                touch([each["ADD"]['Installation Report Code'] for each in added])
+                arrived([each["ADD"]['Installation Report Code'] for each in added])
+                modified = True
+            print(f"ADDED {len(added)} REPORTS IN BATCH")
+            pipe.send(reply({"DONE": True, "RESULTS": results}, cmd))
+            if len(added) > 0:
+                codes = [each["ADD"]['Installation Report Code'] for each in added]
+                changed(codes, [db[each] for each in codes])
         elif "RECV" in cmd.keys():
             # pull data from DB
+            answer(queries.recv(cmd["RECV"], db, index, archive), cmd)
+            modified = True
+        elif "CURSOR" in cmd.keys():
+            # page through results: open, then next until done, or close
             output = None
-            if "code" in cmd["RECV"]:
+            if "open" in cmd["CURSOR"]:
+                if "in_report" in cmd["CURSOR"]["open"]:
+                    codes = sorted(index.search(cmd["CURSOR"]["open"]["in_report"], db))
+                else:
+                    codes = sorted(db.keys())
+                cursor_id = cursors.open(codes, cmd["CURSOR"].get("page_size"))
+                output = {"cursor": cursor_id, "total": len(codes)}
+            elif "next" in cmd["CURSOR"]:
                 try:
-                    output = db[cmd["RECV"]["code"]]
+                    page, finished = cursors.fetch(cmd["CURSOR"]["next"], db)
+                    output = {"cursor": cmd["CURSOR"]["next"],
+                              "reports": [plain(each) for each in page],
+                              "done": finished}
                 except KeyError:
-                    eprint(f"Installation {cmd['RECV']['code']} requested but not found.")
-            elif "in_report" in cmd["RECV"]:
-                output = []
-                for each in db:
-                    if cmd["RECV"]["in_report"] in each.items():
-                        output.append(each)
-            elif "all" in cmd["RECV"]:
-                output = db
-            pipe.send({"DATA": output})
-            modified = True
+                    output = f"ERROR: cursor {cmd['CURSOR']['next']} is not open"
+            elif "close" in cmd["CURSOR"]:
+                output = {"cursor": cmd["CURSOR"]["close"],
+                          "closed": cursors.close(cmd["CURSOR"]["close"])}
+            answer(output, cmd)
+        elif "AGGREGATE" in cmd.keys():
+            answer(queries.aggregate(cmd["AGGREGATE"], aggregates), cmd)
+        elif "SEARCH" in cmd.keys():
+            answer(queries.search(cmd["SEARCH"], db, text_index, page_size), cmd)
         elif "DEL" in cmd.keys():
             # delete data from DB
             if cmd["DEL"] in db:
                 print(f"DELETED REPORT: {cmd['DEL']}")
+                forget(db[cmd["DEL"]])
                 del db[cmd["DEL"]]
-                pipe.send(done)
+                persist([cmd])
+                touch([cmd["DEL"]])
+                if arrivals is not None:
+                    arrivals.drop([cmd["DEL"]])
+                pipe.send(reply({"DONE": True}, cmd))
+                changed([cmd["DEL"]], deleted=[cmd["DEL"]])
                 modified = True
+            elif archive is not None and archive.discard(cmd["DEL"]):
+                print(f"DELETED ARCHIVED REPORT: {cmd['DEL']}")
+                metrics.gauge("db_archived_reports", len(archive))
+                pipe.send(reply({"DONE": True}, cmd))
+                changed([cmd["DEL"]], deleted=[cmd["DEL"]])
             else:
                 eprint(f"REPORT REQUESTED TO BE DELETED BUT NOT FOUND: {cmd['DEL']}")
-                pipe.send({"DONE": None})
+                pipe.send(reply({"DONE": None}, cmd))
         elif "CHECK" in cmd.keys():
             # check status of DB and DB thread
             score = 0
-            if os.path.isfile(f"{db_name}.bak"):
+            if os.path.exists(storage.files[1]):
                 score += 1
             else:
-                backup(db_name)
-            if os.path.isfile(db_name):
+                make_backup()
+            if os.path.exists(storage.files[0]):
                 score += 1
             else:
-                commit(db, db_name)
-                backup(db_name)
+                storage.commit()
+                make_backup()
             try:
                 if json.dumps(db_name):
                     score += 1
             except:
                 pass
+            # every command gets an answer, so the router can tell how far
+            # behind we are
             if score == 3:
-                pipe.send({"STATUS": "GOOD"})
+                pipe.send(reply({"STATUS": "GOOD"}, cmd))
+            else:
+                pipe.send(reply({"STATUS": "BAD"}, cmd))
         elif "COMMIT" in cmd.keys():
-            commit(db, db_name)
-            pipe.send(done)
+            storage.commit()
+            storage.checkpoint(views)
+            if archive is not None:
+                archive.checkpoint()
+            pipe.send(reply({"DONE": True}, cmd))
             modified = True
         elif "BACKUP" in cmd.keys():
-            backup(db_name)
-            pipe.send(done)
+            make_backup()
+            pipe.send(reply({"DONE": True}, cmd))
             modified = False
         elif "RECOVER" in cmd.keys():
-            recover(db_name)
-            pipe.send(done)
+            recovered = storage.recover()
+            if (recovered is not db) or (not storage.in_memory):
+                # what we're looking at has changed under the views
+                db = recovered
+                rebuild_views()
+            reconcile()
+            cold = []
+            dirty = None
+            pipe.send(reply({"DONE": True}, cmd))
+            changed(None)
             modified = False
         elif "READ" in cmd.keys():
-            db = read(db_name)
-            pipe.send(done)
+            db = storage.reload()
+            rebuild_views()
+            reconcile()
+            cold = []
+            dirty = None
+            pipe.send(reply({"DONE": True}, cmd))
+            changed(None)
         else:
-            pipe.send({"ERROR": "Command not understood"})
-        time.sleep(freq)
-
+            pipe.send(reply({"ERROR": "Command not understood"}, cmd))
+        # every command has one key, besides maybe an "ID"
+        metrics.observe("db_command_seconds", time.perf_counter() - started,
+                        command=next(iter(cmd.keys() - {"ID"}), "NONE"))
+        if storage.maintain():
+            metrics.count("db_compactions_total")
+            checkpoint_due = True
@@ -26,10 +26,16 @@ from __future__ import print_function
 import sys
 import gnupg
 import json
-import time
 import os
 import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import pyclamd as clamav
+from watcher import DirectoryWatcher
+from metrics import Metrics, SIZE_BUCKETS
+from verdicts import VerdictCache, digest
+import profiling
 
 
 def eprint(*args, **kwargs):
@@ -42,121 +48,304 @@ if sys.version_info[0] == 2:
     exit(2)
 
 
-def setup_gpg_home(secrets_file):
-    gpg = gnupg.GPG(gnupghome=os.getenv("HOME"))
+# anything bigger than this is not a real installation report
+MAX_SIZE = 5000000 # 5 MB
+
+# what can happen to a report
+ACCEPTED = "accepted"
+SUSPICIOUS = "suspicious"
+DELETED = "deleted"
+# a report we have already accepted, uploaded again
+DUPLICATE = "duplicate"
+# something went wrong (clamd being down, say), so it's left to try again
+ERROR = "error"
+
+# seconds before reports that ran into an ERROR are tried again
+RETRY_AFTER = 30
+
+# every worker thread gets its own connection to clamd
+CLAMD = threading.local()
+# but they all share the stream to intake
+STREAM_LOCK = threading.Lock()
+
+
+def setup_gpg_home(secrets_file, gpg_home=None):
+    """Get GPG ready to go, along with the passphrase for our key"""
+    if gpg_home is None:
+        gpg_home = os.getenv("HOME")
+    gpg = gnupg.GPG(gnupghome=gpg_home)
     with open(secrets_file, "r") as file:
        pin = file.read().split("\n")[0]
-    return gpg
+    return gpg, pin
 
 
-def main(inbound: str, checked: str, sus: str, freq: float, secrets_file: str):
-    """Filter inbound reports to ensure system security and report validity"""
-    gpg = setup_gpg_home(secrets_file)
-    av = clamav.ClamdAgnostic()
-    while True:
-        # STEP 1: Check for work
-        file_list = os.listdir(inbound)
-        if len(file_list) == 0:
-            eprint("Nothing to scan. Exiting...")
-            # sleep till next loop
-            time.sleep(freq)
-
-        # STEP 2: check file extension and name
-        # so we at least have something. Check to ensure the file extention is right.
-        first_step_file_list = []
-        move = []
-        for each in file_list:
-            if each.split(".")[-1] == "dosir":
-                if each.split("-")[0] == "installation_report":
-                    first_step_file_list.append(each)
-                    continue
-            move.append(each)
-
-        # STEP 3: virus scan
-        # scan EVERYTHING for viruses. If it throws something, immedietly delete it
-        second_step_file_list = []
-        for each in first_step_file_list:
-            path = inbound + "/" + each
-            if not os.path.isabs(path):
-                path = os.path.abspath(path)
-            results = av.scan_file(path)
-            if results is None:
-                second_step_file_list.append(each)
-            else:
-                eprint("WARNING: VIRUS DETECTED!")
-                os.remove(path)
-                eprint(f"FILE {each} DELETED FOR SAFETY REASONS.")
-
-        checked_move = []
-        for each in move:
-            path = inbound + "/" + each
-            if not os.path.isabs(path):
-                path = os.path.abspath(path)
-            results = av.scan_file(path)
-            if results is None:
-                checked_move.append(each)
-            else:
-                eprint("WARNING: VIRUS DETECTED!")
-                os.remove(path)
-                eprint(f"FILE {each} DELETED FOR SAFETY REASONS.")
-
-        # STEP 4: check size
-        # check everything to ensure it's not over our size limit
-        max_size = 5000000 # 5 MB
-        third_step_file_list = []
-        for each in second_step_file_list:
-            if os.path.getsize(inbound + "/" + each) > max_size:
-                eprint(f"{each} is greater than `max_size' ({max_size} bytes), despite passing AV and extension check")
-                eprint("Removing $each as a precautionary measure...")
-                os.remove(inbound + "/" + each)
-            else:
-                third_step_file_list.append(each)
-
-        move = []
-        for each in checked_move:
-            if os.path.getsize(inbound + "/" + each) > max_size:
-                eprint(f"{each} is greater than `max_size' ({max_size} bytes), despite passing AV and extension check")
-                eprint("Removing $each as a precautionary measure...")
-                os.remove(inbound + "/" + each)
-            else:
-                move.append(each)
-
-
-        # STEP 5: decrypt
-        # decrypt using GPG. if decryption failes, move to "suspicious" folder
+def clamd(clamd_socket):
+    """Get this thread's clamd connection, connecting if need be
+
+    An empty `clamd_socket' means use whatever clamd pyclamd can find."""
+    if getattr(CLAMD, "av", None) is None:
+        if clamd_socket:
+            CLAMD.av = clamav.ClamdUnixSocket(filename=clamd_socket)
+        else:
+            CLAMD.av = clamav.ClamdAgnostic()
+    return CLAMD.av
+
+
+def virus_scan(av, path, data):
+    """Scan a report for viruses. Returns None if it's clean.
+
+    The report is streamed to clamd if we can, since we have it in memory
+    already and clamd doesn't have to be able to read `path' then."""
+    if hasattr(av, "scan_stream"):
+        return av.scan_stream(data)
+    return av.scan_file(path)
+
+
+def filter_report(each, inbound, checked, sus, gpg, pin, clamd_socket, stream=None,
+                  metrics=None, cache=None):
+    """Filter report `each' from `inbound', returning what happened to it
+
+    Accepted reports are written to `checked' for intake to pick up, and
+    sent, parsed, down `stream' as (file name, report) if there is one. The
+    upload is only removed from `inbound' once that is done. Returns ACCEPTED,
+    SUSPICIOUS, DELETED, DUPLICATE, or None if the file is gone. How long
+    each step took goes in `metrics'. Files whose contents are in `cache'
+    get the same verdict as last time without being scanned again."""
+    if metrics is None:
+        metrics = Metrics("filter")
+    if each[:1] == ".":
+        # hidden files are still being uploaded
+        return None
+    path = inbound + "/" + each
+    if not os.path.isabs(path):
+        path = os.path.abspath(path)
+    try:
+        file = open(path, "rb")
+    except (FileNotFoundError, IsADirectoryError):
+        # already dealt with, or not a report at all
+        return None
+
+    # STEP 2: check file extension and name
+    # so we at least have something. Check to ensure the file extention is right.
+    named_right = ((each.split(".")[-1] == "dosir") and
+                   (each.split("-")[0] == "installation_report"))
+
+    # STEP 3: check size
+    # done before the scan so we never read more than `MAX_SIZE' into memory.
+    # Either way, it gets deleted. After this, the report is never read again.
+    with file:
+        info = os.fstat(file.fileno())
+        # how long it sat in `inbound' waiting on us
+        metrics.observe("filter_queue_seconds", max(time.time() - info.st_mtime, 0.0))
+        if info.st_size > MAX_SIZE:
+            eprint(f"{each} is greater than `max_size' ({MAX_SIZE} bytes)")
+            eprint(f"Removing {each} as a precautionary measure...")
+            os.remove(path)
+            return DELETED
+        data = file.read()
+
+    key = None
+    if cache is not None:
+        key = digest(data)
+        known = cache.verdict(key)
+        if known is not None:
+            metrics.count("filter_cache_hits_total", verdict=known)
+            if known == SUSPICIOUS:
+                shutil.move(path, sus + "/" + each)
+                return SUSPICIOUS
+            os.remove(path)
+            if known == DELETED:
+                eprint(f"FILE {each} WAS A KNOWN VIRUS. DELETED FOR SAFETY REASONS.")
+                return DELETED
+            print(f"{each} has already been accepted. Discarding...")
+            return DUPLICATE
+
+    # STEP 4: virus scan
+    # scan EVERYTHING for viruses. If it throws something, immedietly delete it
+    started = time.perf_counter()
+    found = virus_scan(clamd(clamd_socket), path, data)
+    metrics.observe("filter_scan_seconds", time.perf_counter() - started)
+    if found is not None:
+        eprint("WARNING: VIRUS DETECTED!")
+        if cache is not None:
+            cache.remember(key, DELETED)
+        os.remove(path)
+        eprint(f"FILE {each} DELETED FOR SAFETY REASONS.")
+        return DELETED
+    if not named_right:
+        shutil.move(path, sus + "/" + each)
+        return SUSPICIOUS
+
+    # STEP 5: decrypt
+    # decrypt using GPG. if decryption failes, move to "suspicious" folder
+    started = time.perf_counter()
+    output = gpg.decrypt(data, passphrase=pin)
+    metrics.observe("filter_decrypt_seconds", time.perf_counter() - started)
+    if not output.ok:
+        eprint(f"GPG decrypt failed for {each}. Moving to suspicious folder ({sus})")
+        eprint(f"Reason: {output.status}")
+        if cache is not None:
+            cache.remember(key, SUSPICIOUS)
+        shutil.move(path, sus + "/" + each)
+        return SUSPICIOUS
+    # the upload stays in `inbound' until the report is safely somewhere else
+
+    # STEP 6: ensure valid JSON
+    try:
+        report = json.loads(output.data)
+    except json.decoder.JSONDecodeError:
+        if cache is not None:
+            cache.remember(key, SUSPICIOUS)
+        with open(sus + "/" + each, "wb") as file:
+            file.write(output.data)
+        os.remove(path)
+        eprint(f"{each} had invalid JSON data. Marked as suspicious.")
+        return SUSPICIOUS
+    except:
+        if cache is not None:
+            cache.remember(key, SUSPICIOUS)
+        with open(sus + "/" + each, "wb") as file:
+            file.write(output.data)
+        os.remove(path)
+        eprint(f"{each} encountered an unknown error. Marked as suspicious.")
+        return SUSPICIOUS
+    if cache is not None:
+        # encrypted again for the retry, the file is different but the
+        # report is the same
+        if cache.accepted(digest(output.data)):
+            cache.remember(key, ACCEPTED)
+            os.remove(path)
+            print(f"{each} has already been accepted. Discarding...")
+            return DUPLICATE
+    # written to `checked' even when it is streamed, so it isn't lost if
+    # intake goes away before the DB has it. Under a hidden name first, so
+    # intake never sees half a report.
+    with open(checked + "/." + each, "wb") as file:
+        file.write(output.data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(checked + "/." + each, checked + "/" + each)
+    # only now, so an upload that couldn't be handed off isn't turned away
+    # as a duplicate when it's tried again
+    if cache is not None:
+        cache.remember(key, ACCEPTED)
+        cache.accept(digest(output.data))
+    os.remove(path)
+    if stream is not None:
         try:
-            os.mkdir(checked)
-        except FileExistsError:
-            pass
+            with STREAM_LOCK:
+                stream.send((each, report))
+        except OSError as err:
+            eprint(f"Could not stream {each} to intake ({err}). "
+                   f"It will be picked up from {checked}.")
+    return ACCEPTED
+
+
+def filter_reports(file_list, inbound, checked, sus, gpg, pin, clamd_socket, pool,
+                   stream=None, metrics=None, cache=None):
+    """Filter the reports named in `file_list' from `inbound' on `pool'
+
+    Returns a dict of file name -> outcome (see `filter_report'), ERROR for
+    any that couldn't be filtered."""
+    if metrics is None:
+        metrics = Metrics("filter")
+    if cache is not None:
+        try:
+            cache.check_signatures(clamd(clamd_socket).version())
+        except Exception as err:
+            eprint(f"Could not get clamd's signature version: {err}")
+            CLAMD.av = None
+    for each in (checked, sus):
         try:
-            os.mkdir(sus)
+            os.mkdir(each)
         except FileExistsError:
             pass
-        for each in third_step_file_list:
-            try:
-                with open(inbound + "/" + each, "rb") as file:
-                    output = gpg.decrypt_file(file, passphrase=pin, output=checked + "/" + each)
-            except:
-                eprint(f"GPG decrypt failed for $each. Moving to suspicious folder ({sus})")
-                eprint(f"Reason: {output.status}")
-                shutil.move(inbound + "/" + each, sus + "/" + each)
-            os.remove(inbound + "/" + each)
-
-        for each in move:
-            shutil.move(inbound + "/" + each, sus + "/" + each)
-
-        # STEP 6: ensure valid JSON
-        checked_files = os.listdir(checked)
-        for each in checked_files:
-            try:
-                with open(checked + "/" + each, "r") as file:
-                    json.load(file)
-            except json.decoder.JSONDecodeError:
-                shutil.move(checked + "/" + each, sus + "/" + each)
-                eprint(f"{each} had invalid JSON data. Marked as suspicious.")
-            except:
-                shutil.move(checked + "/" + each, sus + "/" + each)
-                eprint(f"{each} encountered an unknown error. Marked as suspicious.")
-
-        # STEP 7: sleep till next loop
-        time.sleep(freq)
+
+    def worker(each):
+        started = time.perf_counter()
+        try:
+            outcome = filter_report(each, inbound, checked, sus, gpg, pin, clamd_socket,
+                                    stream, metrics, cache)
+        except Exception as err:
+            # leave it where it is to be tried again
+            eprint(f"Could not filter {each}: {err}")
+            CLAMD.av = None
+            metrics.count("filter_reports_total", outcome=ERROR)
+            return ERROR
+        if outcome is not None:
+            metrics.count("filter_reports_total", outcome=outcome)
+            metrics.observe("filter_report_seconds", time.perf_counter() - started)
+        return outcome
+
+    outcomes = dict(zip(file_list, pool.map(worker, file_list)))
+    if cache is not None:
+        try:
+            cache.save()
+        except OSError as err:
+            eprint(f"Could not save verdict cache: {err}")
+    return outcomes
+
+
+def main(inbound: str, checked: str, sus: str, freq: float, secrets_file: str,
+         use_inotify: bool = True, workers: int = 4, clamd_socket: str = "",
+         gpg_home: str = None, stream=None, metrics_pipe=None, metrics_interval: float = 0,
+         cache_size: int = 0, cache_file: str = "", profile_dir: str = "",
+         profile_mode: str = "sampling"):
+    """Filter inbound reports to ensure system security and report validity
+
+    Up to `workers' reports are scanned and decrypted at once. With inotify,
+    reports are filtered as soon as they finish arriving. Otherwise
+    `inbound' is checked every `freq' seconds. If `stream' is given, accepted
+    reports are handed straight to intake through it. Metrics are sent down
+    `metrics_pipe' every `metrics_interval' seconds.
+
+    Verdicts on up to `cache_size' files, and the hashes of as many accepted
+    reports, are remembered (in `cache_file', if set) so files uploaded more
+    than once are only scanned and decrypted once.
+
+    Reports that couldn't be filtered are tried again every `RETRY_AFTER'
+    seconds, since inotify won't tell us about them again.
+
+    SIGUSR1 and SIGUSR2 start and stop profiling into `profile_dir' (see
+    profiling.py). Sampling sees the workers too."""
+    gpg, pin = setup_gpg_home(secrets_file, gpg_home)
+    pool = ThreadPoolExecutor(max_workers=max(workers, 1))
+    watcher = DirectoryWatcher(inbound, freq, use_inotify)
+    metrics = Metrics("filter", metrics_interval if metrics_pipe is not None else 0)
+    profiling.setup("filter", profile_dir, profile_mode, metrics)
+    cache = None
+    if cache_size > 0:
+        cache = VerdictCache(cache_size, cache_file)
+    # reports that ran into an ERROR, and when to try them again
+    retry = set()
+    retry_at = None
+    # STEP 1: Check for work
+    file_list = watcher.initial()
+    while True:
+        if len(file_list) == 0:
+            eprint("Nothing to scan.")
+        else:
+            metrics.observe("filter_batch_files", len(file_list), SIZE_BUCKETS)
+            outcomes = filter_reports(file_list, inbound, checked, sus, gpg, pin,
+                                      clamd_socket, pool, stream, metrics, cache)
+            counts = {}
+            for each in outcomes.values():
+                if each is not None:
+                    counts[each] = counts.get(each, 0) + 1
+            print(f"Filtered reports: {counts}")
+            retry.update(name for name, outcome in outcomes.items() if outcome == ERROR)
+            if len(retry) > 0 and retry_at is None:
+                retry_at = time.monotonic() + RETRY_AFTER
+        if metrics_pipe is not None:
+            metrics.push(metrics_pipe)
+        # STEP 7: wait for more work
+        timeout = metrics.wait_time()
+        if retry_at is not None:
+            due = max(retry_at - time.monotonic(), 0)
+            if timeout is None or due < timeout:
+                timeout = due
+        file_list = watcher.changes(timeout)
+        if retry_at is not None and time.monotonic() >= retry_at:
+            file_list = file_list + [each for each in retry if each not in file_list]
+            retry = set()
+            retry_at = None
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  fulltext.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Full-text search over the free-text fields of installation reports
+
+Every word in those fields maps to the reports using it and how many
+times each does, and so does every pair of words next to each other. Word
+and short phrase queries are answered and ranked from those counts alone.
+Words are also indexed by their trigrams, so a fragment of a word can be
+looked up without going through every word we know of. Anything the counts
+can't answer exactly (longer phrases, substrings, some of the fields) is
+checked against the text of the reports that could match."""
+from __future__ import print_function
+import sys
+import re
+import json
+import math
+import heapq
+from collections import Counter
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=sys.stderr, **kwargs)
+
+
+if sys.version_info[0] == 2:
+    eprint("Please run with Python 3 as Python 2 is End-of-Life.")
+    exit(2)
+
+
+# fields searched by default
+TEXT_FIELDS = ("INSTALLATION LOG", "CUSTOM MESSAGE")
+# kinds of query:
+#  * "terms": reports containing every word in the query, anywhere
+#  * "phrase": reports containing the words in order, right next to each other
+#  * "substring": reports containing the query exactly, even part way
+#    through a word
+MODES = ("terms", "phrase", "substring")
+
+WORD = re.compile(r"\w+")
+# longer than this is a hash or some such, which nobody searches by word
+MAX_WORD = 40
+
+
+def text_of(value):
+    """`value' of a free-text field as lower case text"""
+    if value is None:
+        return ""
+    if not isinstance(value, str):
+        value = json.dumps(value)
+    return value.lower()
+
+
+def indexable(word):
+    """Whether `word' goes in the index. Plain numbers (timestamps, sizes,
+    line numbers) would only bloat it."""
+    return len(word) <= MAX_WORD and not word.isdigit()
+
+
+def trigrams(word):
+    """Every three letter run in `word'"""
+    return {word[each:each + 3] for each in range(len(word) - 2)}
+
+
+def phrase_pattern(words):
+    """Regex matching `words' as whole words, one after the other
+
+    The look-behind goes after the first word rather than in front of it,
+    so the pattern starts with plain text, which re can search for a lot
+    faster."""
+    first = re.escape(words[0])
+    return re.compile(first + r"(?<!\w" + first + ")" +
+                      "".join(r"\W+" + re.escape(each) for each in words[1:]) + r"(?!\w)")
+
+
+class FullTextIndex:
+    """Map word, and pair of words, -> report code -> how many times that
+    report uses it, for the words in `fields'"""
+    def __init__(self, fields=TEXT_FIELDS):
+        self.fields = tuple(fields)
+        self.postings = {}
+        # (word, next word) -> report code -> count, for phrases
+        self.pairs = {}
+        # trigram -> set of words
+        self.grams = {}
+
+    def counts(self, report):
+        """How many times `report' uses each indexable word, and each pair
+        of them next to each other"""
+        words = Counter()
+        pairs = Counter()
+        for each in self.fields:
+            found = WORD.findall(text_of(report.get(each)))
+            words.update(found)
+            pairs.update(zip(found, found[1:]))
+        words = {word: count for word, count in words.items() if indexable(word)}
+        return words, {pair: count for pair, count in pairs.items()
+                       if pair[0] in words and pair[1] in words}
+
+    def add(self, report):
+        """Index `report'"""
+        code = report['Installation Report Code']
+        words, pairs = self.counts(report)
+        for word, count in words.items():
+            posting = self.postings.get(word)
+            if posting is None:
+                posting = self.postings[word] = {}
+                for gram in trigrams(word):
+                    self.grams.setdefault(gram, set()).add(word)
+            posting[code] = count
+        for pair, count in pairs.items():
+            posting = self.pairs.get(pair)
+            if posting is None:
+                posting = self.pairs[pair] = {}
+            posting[code] = count
+
+    def remove(self, report):
+        """Drop `report' from the index"""
+        code = report['Installation Report Code']
+        words, pairs = self.counts(report)
+        for pair in pairs:
+            posting = self.pairs.get(pair)
+            if posting is None:
+                continue
+            posting.pop(code, None)
+            if len(posting) == 0:
+                del self.pairs[pair]
+        for word in words:
+            posting = self.postings.get(word)
+            if posting is None:
+                continue
+            posting.pop(code, None)
+            if len(posting) > 0:
+                continue
+            del self.postings[word]
+            for gram in trigrams(word):
+                grams = self.grams.get(gram)
+                if grams is not None:
+                    grams.discard(word)
+                    if len(grams) == 0:
+                        del self.grams[gram]
+
+    def rebuild(self, db):
+        """Throw away the index and build it back up from `db'"""
+        self.postings = {}
+        self.pairs = {}
+        self.grams = {}
+        for each in db.values():
+            self.add(each)
+
+    def state(self):
+        """The index as plain data, for restore() to pick back up. The
+        trigrams are quick to work out again, so they are left out."""
+        return {"fields": self.fields, "postings": self.postings, "pairs": self.pairs}
+
+    def restore(self, state):
+        """Pick the index back up from state(). Raises ValueError if it was
+        kept for different fields, or before pairs were counted."""
+        if tuple(state["fields"]) != self.fields:
+            raise ValueError("Index was saved for different fields")
+        if "pairs" not in state:
+            raise ValueError("Index was saved without counts")
+        self.postings = state["postings"]
+        self.pairs = state["pairs"]
+        self.grams = {}
+        for word in self.postings:
+            for gram in trigrams(word):
+                self.grams.setdefault(gram, set()).add(word)
+
+    def vocabulary(self, fragment, test):
+        """Indexed words containing `fragment' that pass `test'"""
+        grams = trigrams(fragment)
+        if len(grams) == 0:
+            # too short to have trigrams, so it's all of them
+            return [each for each in self.postings if test(each)]
+        words = sorted((self.grams.get(each, set()) for each in grams), key=len)
+        return [each for each in words[0].intersection(*words[1:]) if test(each)]
+
+    def candidates(self, query, mode):
+        """Codes of the reports that could match `query', or None if the index
+        can't narrow it down at all"""
+        words = WORD.findall(query)
+        postings = []
+        if mode == "phrase":
+            for pair in zip(words, words[1:]):
+                if indexable(pair[0]) and indexable(pair[1]):
+                    posting = self.pairs.get(pair)
+                    if posting is None:
+                        return set()
+                    postings.append(posting)
+        for position, word in enumerate(words):
+            # in a substring query, the ends may be part of a longer word
+            start = mode == "substring" and position == 0 and query[:1] == word[:1]
+            end = mode == "substring" and position == len(words) - 1 and query[-1:] == word[-1:]
+            if not (start or end):
+                if not indexable(word):
+                    continue
+                posting = self.postings.get(word)
+                if posting is None:
+                    return set()
+                postings.append(posting)
+                continue
+            if word.isdigit():
+                continue
+            if start and end:
+                matches = self.vocabulary(word, lambda each: True)
+            elif start:
+                matches = self.vocabulary(word, lambda each: each.endswith(word))
+            else:
+                matches = self.vocabulary(word, lambda each: each.startswith(word))
+            if len(matches) == 0:
+                return set()
+            postings.append(set().union(*(self.postings[each] for each in matches)))
+        if len(postings) == 0:
+            return None
+        postings.sort(key=len)
+        return set(postings[0]).intersection(*postings[1:])
+
+    def counted(self, words, mode):
+        """code -> how many times each of `words' is used, straight from the
+        index, or None if the index doesn't have the counts to tell"""
+        if not all(indexable(each) for each in words):
+            return None
+        if mode == "terms" or len(words) == 1:
+            postings = [self.postings.get(each, {}) for each in words]
+        elif mode == "phrase" and len(words) == 2:
+            postings = [self.pairs.get(tuple(words), {})]
+        else:
+            return None
+        smallest = min(postings, key=len)
+        counts = {}
+        for code in smallest:
+            found = [each.get(code) for each in postings]
+            if None not in found:
+                counts[code] = found
+        return counts
+
+    def search(self, query, mode, db, limit=100, fields=None):
+        """Find the reports in `db' matching `query', best first
+
+        Returns how many matched, and the (score, code) of the first `limit'
+        of them. Scores are tf-idf: a word counts for more the more often a
+        report uses it, and the fewer reports use it at all. Word queries
+        and phrases of up to two words on the default fields are ranked from
+        the index alone; anything else has its candidates checked against
+        the text. Raises ValueError for queries we can't run."""
+        if mode not in MODES:
+            raise ValueError(f"search mode must be one of: {', '.join(MODES)}")
+        query = query.lower()
+        words = WORD.findall(query)
+        if len(words) == 0:
+            raise ValueError("nothing to search for")
+        if fields is None:
+            fields = self.fields
+        for each in fields:
+            if each not in self.fields:
+                raise ValueError(f"{each} can't be searched. Options are: {', '.join(self.fields)}")
+        total = max(len(db), 1)
+        weights = [math.log(1 + total / max(len(self.postings.get(each, ())), 1))
+                   for each in words]
+        counts = None
+        if mode != "substring" and tuple(fields) == self.fields:
+            counts = self.counted(words, mode)
+        if counts is None:
+            counts = self.verify(query, words, mode, db, fields)
+        if mode == "terms":
+            scored = ((sum((1 + math.log(count)) * weight
+                           for count, weight in zip(found, weights)), code)
+                      for code, found in counts.items())
+        else:
+            weight = sum(weights)
+            scored = (((1 + math.log(found[0])) * weight, code)
+                      for code, found in counts.items())
+        return len(counts), heapq.nsmallest(limit, scored,
+                                            key=lambda each: (-each[0], each[1]))
+
+    def verify(self, query, words, mode, db, fields):
+        """code -> how many times each part of `query' is used, by going
+        through the text of every report that could match"""
+        codes = self.candidates(query, mode)
+        if codes is None:
+            # nothing to go on but the text itself
+            codes = db.keys()
+        if mode == "terms":
+            patterns = [phrase_pattern([each]) for each in words]
+        elif mode == "phrase":
+            patterns = [phrase_pattern(words)]
+        counts = {}
+        for code in codes:
+            report = db[code]
+            texts = [text_of(report.get(each)) for each in fields]
+            if mode == "substring":
+                found = [sum(each.count(query) for each in texts)]
+            else:
+                found = [sum(len(pattern.findall(each)) for each in texts)
+                         for pattern in patterns]
+            if min(found) > 0:
+                counts[code] = found
+        return counts
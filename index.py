@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  index.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Secondary indexes over installation report fields, so content queries
+don't have to walk the whole database"""
+from __future__ import print_function
+import sys
+import json
+import hashlib
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=sys.stderr, **kwargs)
+
+
+if sys.version_info[0] == 2:
+    eprint("Please run with Python 3 as Python 2 is End-of-Life.")
+    exit(2)
+
+
+# fields reports may be searched on
+QUERYABLE_FIELDS = ("system-installer Version", "OS", "CPU INFO", "PCIe / GPU INFO",
+                    "RAM / SWAP INFO", "DISK SETUP", "INSTALLATION LOG", "CUSTOM MESSAGE",
+                    "MODE")
+
+# values longer than this are indexed by digest, so the index doesn't pin
+# a second reference to every installation log in the database
+MAX_INLINE_VALUE = 256
+
+
+def index_key(value):
+    """Turn a field value into something hashable and reasonably small"""
+    if not isinstance(value, str):
+        value = json.dumps(value, sort_keys=True)
+    if len(value) > MAX_INLINE_VALUE:
+        return hashlib.sha1(value.encode()).digest()
+    return value
+
+
+class ReportIndex:
+    """Map field -> value -> set of report codes for every queryable field"""
+    def __init__(self, fields=QUERYABLE_FIELDS):
+        self.fields = tuple(fields)
+        self.postings = {each: {} for each in self.fields}
+
+    def add(self, report):
+        """Index `report'"""
+        code = report['Installation Report Code']
+        for each in self.fields:
+            if each in report:
+                key = index_key(report[each])
+                self.postings[each].setdefault(key, set()).add(code)
+
+    def remove(self, report):
+        """Drop `report' from the index"""
+        code = report['Installation Report Code']
+        for each in self.fields:
+            if each not in report:
+                continue
+            key = index_key(report[each])
+            posting = self.postings[each].get(key)
+            if posting is None:
+                continue
+            posting.discard(code)
+            if len(posting) == 0:
+                del self.postings[each][key]
+
+    def rebuild(self, db):
+        """Throw away the index and build it back up from `db'"""
+        self.postings = {each: {} for each in self.fields}
+        for each in db.values():
+            self.add(each)
+
+    def state(self):
+        """The index as plain data, for restore() to pick back up"""
+        return {"fields": self.fields, "postings": self.postings}
+
+    def restore(self, state):
+        """Pick the index back up from state(). Raises ValueError if it was
+        kept for different fields."""
+        if tuple(state["fields"]) != self.fields:
+            raise ValueError("Index was saved for different fields")
+        self.postings = state["postings"]
+
+    def search(self, terms, db):
+        """Return the codes of every report in `db' matching all of `terms'
+
+        Indexed fields are answered by intersecting their posting sets,
+        smallest first. Anything else is checked against the (already
+        narrowed down) candidates directly."""
+        postings = []
+        others = {}
+        for field, value in terms.items():
+            if field in self.postings:
+                posting = self.postings[field].get(index_key(value))
+                if posting is None:
+                    return set()
+                postings.append(posting)
+            else:
+                others[field] = value
+        if len(postings) > 0:
+            postings.sort(key=len)
+            codes = postings[0].intersection(*postings[1:])
+        elif len(others) > 0:
+            codes = set(db.keys())
+        else:
+            return set()
+        if len(others) > 0:
+            codes = {each for each in codes
+                     if all(db[each].get(field) == value for field, value in others.items())}
+        return codes
@@ -29,6 +29,9 @@ import sys
 import os
 import json
 import time
+from watcher import DirectoryWatcher
+from metrics import Metrics, SIZE_BUCKETS
+import profiling
 
 
 def eprint(*args, **kwargs):
@@ -41,36 +44,228 @@ if sys.version_info[0] == 2:
     exit(2)
 
 
-def main(pipe, loop_freq, intake_dir):
-    """Handle intake of installation reports"""
+# seconds to wait for a report the filter wrote to the intake directory to
+# come down the stream as well, before reading it from the file instead
+STREAM_WAIT = 5.0
+# seconds before reports that didn't make it to the DB are sent again
+RETRY_AFTER = 5.0
+
+
+def send_batch(pipe, intake_dir, batch, metrics=None, control=None):
+    """Hand a batch of (file name, report) pairs to the DB in one message
+
+    Files are removed once the DB has acknowledged them. Reports the DB
+    refuses are discarded, same as reports that can't be loaded at all.
+    Reports with no file name have nothing to remove. Anything
+    else that turns up while we wait is given to `control', which returns
+    False if it isn't for us either.
+
+    Returns the pairs that never made it to the DB (the router says so with
+    {"RETRY": reason} in place of their result), whose files are kept so
+    they can be sent again."""
+    if metrics is None:
+        metrics = Metrics("intake")
+    started = time.perf_counter()
+    pipe.send({"ADD_BATCH": [each[1] for each in batch]})
+    while True:
+        resp = pipe.recv()
+        if "RESULTS" in resp:
+            break
+        if control is not None and control(resp):
+            continue
+        eprint(f"Ignoring unexpected message while waiting on DB: {resp}")
+    metrics.observe("intake_batch_seconds", time.perf_counter() - started)
+    metrics.observe("intake_batch_reports", len(batch), SIZE_BUCKETS)
+    retry = []
+    for (name, report), result in zip(batch, resp["RESULTS"]):
+        if isinstance(result, dict) and "RETRY" in result:
+            # not the report's fault, so it isn't thrown away
+            metrics.count("intake_reports_total", result="retry")
+            retry.append((name, report))
+            continue
+        metrics.count("intake_reports_total",
+                      result="accepted" if result is True else "rejected")
+        if result is not True:
+            if name is None:
+                name = report.get('Installation Report Code', "from filter")
+            eprint(f"DB rejected report {name} ({result}). Discarding...")
+        if name is not None:
+            os.remove(intake_dir + "/" + name)
+    if len(retry) > 0:
+        reason = next(each for each in resp["RESULTS"] if isinstance(each, dict))["RETRY"]
+        eprint(f"{len(retry)} reports didn't make it to the DB ({reason}). "
+               f"Trying again in {RETRY_AFTER} seconds...")
+    return retry
+
+
+def load_report(intake_dir, name):
+    """Load report `name' from `intake_dir'. Returns None if there is nothing
+    (usable) there."""
+    path = intake_dir + "/" + name
+    if name[0] == ".":
+        # still being written by the filter
+        return None
+    if not os.path.isfile(path):
+        # already handled, or gone before we got to it
+        return None
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except:
+        eprint(f"Could not load report {name}. Discarding...")
+        os.remove(path)
+        return None
+
+
+def main(pipe, loop_freq, intake_dir, batch_size=100, batch_time=1.0, use_inotify=True,
+         stream=None, metrics_interval=0, profile_dir="", profile_mode="sampling"):
+    """Handle intake of installation reports
+
+    Reports are sent to the DB in batches of at most `batch_size', and a
+    batch is never held back for longer than `batch_time' seconds. Reports
+    come in already parsed over `stream', if the filter is handing them to
+    us directly, or from `intake_dir', which is watched through inotify if
+    possible and polled every `loop_freq' seconds otherwise. Streamed
+    reports are in `intake_dir' too, until the DB has acknowledged them, so
+    a restart picks them back up. While the filter is streaming, files that
+    turn up there are only read if they haven't come down `stream' within
+    `STREAM_WAIT' seconds (dropped in by hand, say), so no report is parsed
+    twice. Metrics are sent to the DB's side of `pipe' every
+    `metrics_interval' seconds.
+
+    When the router sends {"PAUSE": True} the DB is falling behind, so we
+    stop picking up reports, leaving them in `intake_dir' and `stream',
+    until it sends {"RESUME": True}. Reports that didn't make it to the DB
+    at all are sent again `RETRY_AFTER' seconds later.
+
+    SIGUSR1 and SIGUSR2 start and stop profiling into `profile_dir' (see
+    profiling.py)."""
+    watcher = DirectoryWatcher(intake_dir, loop_freq, use_inotify)
+    names = watcher.initial()
+    also = []
+    if stream is not None:
+        also.append(stream)
+    batch = []
+    queued = set()
+    started = time.monotonic()
+    metrics = Metrics("intake", metrics_interval)
+    profiling.setup("intake", profile_dir, profile_mode, metrics)
+    paused = False
+    # files that turned up while we were paused, in order
+    held = {}
+    # files that turned up while the filter is streaming, and when to stop
+    # waiting for them to come down the stream
+    expected = {}
+    # (file name, report) that didn't make it to the DB, and when to send
+    # them again
+    retry = []
+    retry_at = None
+
+    def control(message):
+        """Deal with PAUSE and RESUME from the router. Returns False if
+        `message' is neither."""
+        nonlocal paused
+        if "PAUSE" in message.keys():
+            paused = True
+            metrics.count("intake_pauses_total")
+            return True
+        if "RESUME" in message.keys():
+            paused = False
+            return True
+        return False
+
+    def add(name, report, source="directory"):
+        nonlocal started
+        if len(batch) == 0:
+            started = time.monotonic()
+        metrics.count("intake_received_total", source=source)
+        batch.append((name, report))
+        if name is not None:
+            queued.add(name)
+        if len(batch) >= batch_size:
+            flush()
+
+    def flush():
+        """Send the batch, holding on to what didn't make it"""
+        nonlocal batch, retry_at
+        failed = send_batch(pipe, intake_dir, batch, metrics, control)
+        batch = []
+        queued.clear()
+        retry.extend(failed)
+        # so they aren't picked up again from `intake_dir' in the meantime
+        queued.update(name for name, report in retry if name is not None)
+        if len(retry) > 0 and retry_at is None:
+            retry_at = time.monotonic() + RETRY_AFTER
+
     while True:
-        reports = os.listdir(intake_dir)
-        for each in reports:
-            try:
-                with open(intake_dir + "/" + each, "r") as file:
-                    report = json.load(file)
-            except:
-                eprint(f"Could not load report {each}. Discarding...")
-                os.remove(intake_dir + "/" + each)
+        while pipe.poll():
+            message = pipe.recv()
+            if not control(message):
+                eprint(f"Ignoring unexpected message from DB: {message}")
+        if not paused:
+            names = list(held) + names
+            held = {}
+        try:
+            while (not paused) and stream is not None and stream.poll():
+                name, report = stream.recv()
+                expected.pop(name, None)
+                # the filter also leaves it in `intake_dir', in case we go
+                # away before the DB has it, so we may have already seen it
+                if name in queued or not os.path.isfile(intake_dir + "/" + name):
+                    continue
+                add(name, report, "stream")
+        except EOFError:
+            eprint("Filter stopped streaming reports. Only watching the intake directory now.")
+            stream = None
+            also = []
+            names = list(expected) + names
+            expected = {}
+        now = time.monotonic()
+        for each in names:
+            if paused:
+                held[each] = None
+                continue
+            if each in queued or each[:1] == ".":
                 continue
-            pipe.send({"ADD": report})
-            count = 0
-            while True:
-                if not pipe.poll():
-                    time.sleep(2)
+            if stream is not None:
+                # most likely on its way down the stream, already parsed
+                expected.setdefault(each, now + STREAM_WAIT)
+                continue
+            report = load_report(intake_dir, each)
+            if report is not None:
+                add(each, report)
+        if not paused and retry_at is not None and now >= retry_at:
+            again = list(retry)
+            retry.clear()
+            retry_at = None
+            for name, report in again:
+                add(name, report, "retry")
+        if not paused:
+            for each in [name for name, due in expected.items() if due <= now]:
+                del expected[each]
+                if each in queued:
                     continue
-                resp = pipe.recv()
-                if ((resp == {"DONE": True}) and (count < 3)):
-                    break
-                else:
-                    if count == 3:
-                        pipe.send({"RECOVER": None})
-                    elif count == 4:
-                        pipe.send({"READ": None})
-                        pipe.send({"ADD": data})
-                        count = 0
-                    elif count < 3:
-                        pipe.send({"ADD": data})
-                    count += 1
-            os.remove(intake_dir + "/" + each)
-        time.sleep(loop_freq)
+                report = load_report(intake_dir, each)
+                if report is not None:
+                    add(each, report)
+        timeout = None
+        if len(batch) > 0 and not paused:
+            timeout = batch_time - (time.monotonic() - started)
+            if timeout <= 0:
+                flush()
+                timeout = None
+        for due in (min(expected.values(), default=None), retry_at):
+            if due is None or paused:
+                continue
+            due = max(due - time.monotonic(), 0)
+            if timeout is None or due < timeout:
+                timeout = due
+        metrics.push(pipe)
+        due = metrics.wait_time()
+        if due is not None and (timeout is None or due < timeout):
+            timeout = due
+        if paused:
+            # only the router can wake us up
+            names = watcher.changes(timeout, [pipe])
+        else:
+            names = watcher.changes(timeout, also + [pipe])
@@ -26,7 +26,6 @@ from __future__ import print_function
 import sys
 import multiprocessing as multiproc
 import json
-import time
 import os
 
 # all our libraries will each fun as their own thread
@@ -34,6 +33,10 @@ import db
 import request_handler as rh
 import intake_handler as ih
 import filter
+import router
+import sharedmem
+import replica
+import profiling
 
 
 def __eprint__(*args, **kwargs):
@@ -54,8 +57,10 @@ with open("settings.json", "r") as file:
 
 # handle path shortcuts
 for each in SETTINGS:
+    if not isinstance(SETTINGS[each], str):
+        continue
     if (("reports" in each) or ("file" in each) or ("dir" in each)):
-        if SETTINGS[each][0] == "~":
+        if SETTINGS[each][:1] == "~":
             if len(SETTINGS[each]) > 1:
                 if SETTINGS[each][1] == "/":
                     SETTINGS[each] = os.getenv("HOME") + SETTINGS[each][1:]
@@ -65,58 +70,105 @@ for each in SETTINGS:
                 SETTINGS[each] = os.getenv("HOME")
 
 
+# replies a previous run never got around to collecting
+sharedmem.clean_up()
+
 # set up pipes
 db_parent, db_pipe = multiproc.Pipe()
 intake_parent, intake_pipe = multiproc.Pipe()
 request_parent, request_pipe = multiproc.Pipe()
+# filter hands accepted reports straight to intake
+stream_recv, stream_send = None, None
+if SETTINGS["stream_reports"]:
+    stream_recv, stream_send = multiproc.Pipe(duplex=False)
+# the filter has no other way to get its metrics to the router
+metrics_recv, metrics_send = multiproc.Pipe(duplex=False)
+# read replicas get changes straight from the DB, and queries straight from
+# the request handler
+replica_feeds, replica_pipes, replica_threads = [], [], []
+for each in range(SETTINGS["read_replicas"]):
+    feed_recv, feed_send = multiproc.Pipe(duplex=False)
+    replica_parent, replica_pipe = multiproc.Pipe()
+    replica_feeds.append(feed_send)
+    replica_pipes.append(replica_pipe)
+    replica_threads.append(multiproc.Process(target=replica.main, args=(replica_parent,
+                                             feed_recv, each, SETTINGS["page_size"],
+                                             SETTINGS["db_compact_reports"],
+                                             SETTINGS["replica_max_staleness"],
+                                             SETTINGS["shared_memory_threshold"],
+                                             SETTINGS["metrics_interval"],
+                                             SETTINGS["profile_dir"],
+                                             SETTINGS["profile_mode"])))
 
 # setup threads
 db_thread = multiproc.Process(target=db.main, args=(db_parent, SETTINGS["response_frequency"],
-                                                    SETTINGS["db_name"]))
+                                                    SETTINGS["db_name"],
+                                                    SETTINGS["db_storage"],
+                                                    SETTINGS["db_compact_threshold"],
+                                                    SETTINGS["page_size"],
+                                                    SETTINGS["db_compact_reports"],
+                                                    SETTINGS["metrics_interval"],
+                                                    SETTINGS["shared_memory_threshold"],
+                                                    replica_feeds,
+                                                    SETTINGS["replica_max_staleness"] / 4,
+                                                    SETTINGS["db_retention_days"],
+                                                    SETTINGS["db_retention_min_version"],
+                                                    SETTINGS["db_retention_max_reports"],
+                                                    SETTINGS["db_retention_interval"],
+                                                    SETTINGS["profile_dir"],
+                                                    SETTINGS["profile_mode"]))
 intake_thread = multiproc.Process(target=ih.main, args=(intake_parent,
                                 SETTINGS["intake_frequency"],
-                                SETTINGS["accepted_reports"]))
+                                SETTINGS["accepted_reports"],
+                                SETTINGS["intake_batch_size"],
+                                SETTINGS["intake_batch_time"],
+                                SETTINGS["use_inotify"],
+                                stream_recv,
+                                SETTINGS["metrics_interval"],
+                                SETTINGS["profile_dir"],
+                                SETTINGS["profile_mode"]))
 request_thread = multiproc.Process(target=rh.main, args=(request_parent,
-                                                         SETTINGS["response_frequency"]))
+                                                         SETTINGS["request_cache_size"],
+                                                         SETTINGS["metrics_interval"],
+                                                         replica_pipes,
+                                                         SETTINGS["profile_dir"],
+                                                         SETTINGS["profile_mode"]))
 filter_thread = multiproc.Process(target=filter.main, args=(SETTINGS["unchecked_reports"],
                                                             SETTINGS["accepted_reports"],
                                                             SETTINGS["sus_reports"],
                                                             SETTINGS["filter_frequency"],
-                                                            SETTINGS["secrets_file"]))
-# start threads
+                                                            SETTINGS["secrets_file"],
+                                                            SETTINGS["use_inotify"],
+                                                            SETTINGS["filter_workers"],
+                                                            SETTINGS["clamd_socket"],
+                                                            SETTINGS["gpg_dir"],
+                                                            stream_send,
+                                                            metrics_send,
+                                                            SETTINGS["metrics_interval"],
+                                                            SETTINGS["filter_cache_size"],
+                                                            SETTINGS["filter_cache_file"],
+                                                            SETTINGS["profile_dir"],
+                                                            SETTINGS["profile_mode"]))
+# start threads, which each pick up profiling signals once they can handle them
+profiling.hold()
 db_thread.start()
 intake_thread.start()
 request_thread.start()
 filter_thread.start()
+for each in replica_threads:
+    each.start()
+# so the router can tell them to start and stop profiling
+processes = {"db": db_thread.pid, "intake": intake_thread.pid, "request": request_thread.pid,
+             "filter": filter_thread.pid}
+for number, each in enumerate(replica_threads):
+    processes[f"replica-{number}"] = each.pid
 
 # coordinate process communication and keep things thread safe
-flip_flop = True
-time.sleep(0.01)
 # make sure DB is ready to go before anything else
-while True:
-    if db_pipe.poll():
-        if db_pipe.recv() == {"STATUS": "READY"}:
-            break
-    time.sleep(0.1)
-
-while True:
-    if flip_flop:
-        if db_pipe.poll():
-            data = db_pipe.recv()
-            if "DATA" in data.keys():
-                request_pipe.send(data)
-            elif "ERROR" in data.keys():
-                request_pipe.send(data)
-                intake_pipe.send(data)
-            else:
-                intake_pipe.send(data)
-        flip_flop = None
-    elif flip_flop is None:
-        if intake_pipe.poll():
-             db_pipe.send(intake_pipe.recv())
-        flip_flop = False
-    else:
-        if request_pipe.poll():
-            db_pipe.send(request_pipe.recv())
-        flip_flop = True
-    time.sleep(SETTINGS["main_frequency"])
+router.wait_for_ready(db_pipe)
+router.route(db_pipe, intake_pipe, request_pipe, SETTINGS["router_stats_interval"],
+             metrics_recv, SETTINGS["metrics_interval"], SETTINGS["metrics_file"],
+             SETTINGS["router_db_window"], SETTINGS["router_query_limit"],
+             SETTINGS["router_intake_limit"], SETTINGS["router_query_priority"],
+             SETTINGS["router_pause_backlog"], SETTINGS["router_batch_chunk"], processes,
+             SETTINGS["profile_dir"], SETTINGS["profile_mode"])
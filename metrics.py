@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  metrics.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Counters, gauges and latency histograms for each stage of the pipeline
+
+Each process keeps its own Metrics and every so often sends a snapshot of
+it to the router, which keeps the latest one from each stage. Recording is
+a dict lookup and a bisect, so it can go on the hot path."""
+from __future__ import print_function
+import sys
+import os
+import time
+import threading
+from bisect import bisect_left
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=sys.stderr, **kwargs)
+
+
+if sys.version_info[0] == 2:
+    eprint("Please run with Python 3 as Python 2 is End-of-Life.")
+    exit(2)
+
+
+# upper bounds of the buckets for timings, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 3600.0)
+# upper bounds of the buckets for counting things, like batch sizes and
+# how many messages were waiting on a pipe
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+# what every metric is prefixed with in the Prometheus text file
+PREFIX = "data_intake_"
+
+
+def metric_key(name, labels):
+    """`name' with `labels' attached, Prometheus style"""
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{each}="{labels[each]}"' for each in sorted(labels)) + "}"
+
+
+def split_key(key):
+    """The name and the label list (without braces) of `key'"""
+    name, _, labels = key.partition("{")
+    return name, labels[:-1]
+
+
+class Histogram:
+    """Counts of observed values falling in each of `bounds' buckets, plus
+    one more for anything bigger"""
+    __slots__ = ("bounds", "buckets", "count", "total")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        """Count `value'"""
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def snapshot(self):
+        """The histogram as plain data"""
+        return {"bounds": list(self.bounds), "buckets": list(self.buckets),
+                "count": self.count, "sum": self.total}
+
+
+class Metrics:
+    """Everything measured in one `stage'
+
+    A snapshot is due every `interval' seconds, as long as something has
+    been recorded since the last one. An `interval' of 0 means never."""
+    def __init__(self, stage, interval=0):
+        self.stage = stage
+        self.interval = interval
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        # the filter records from several threads at once
+        self.lock = threading.Lock()
+        self.sent = time.monotonic()
+        self.dirty = False
+
+    def count(self, name, amount=1, **labels):
+        """Add `amount' to counter `name'"""
+        key = metric_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+            self.dirty = True
+
+    def gauge(self, name, value, **labels):
+        """Set gauge `name' to `value'"""
+        key = metric_key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+            self.dirty = True
+
+    def observe(self, name, value, bounds=LATENCY_BUCKETS, **labels):
+        """Add `value' to histogram `name'"""
+        key = metric_key(name, labels)
+        with self.lock:
+            try:
+                histogram = self.histograms[key]
+            except KeyError:
+                histogram = self.histograms[key] = Histogram(bounds)
+            histogram.observe(value)
+            self.dirty = True
+
+    def snapshot(self):
+        """Everything recorded so far, as plain data"""
+        with self.lock:
+            return {"stage": self.stage, "time": time.time(),
+                    "counters": dict(self.counters), "gauges": dict(self.gauges),
+                    "histograms": {key: value.snapshot()
+                                   for key, value in self.histograms.items()}}
+
+    def wait_time(self):
+        """Seconds until the next snapshot is due, or None if there's nothing
+        new to send"""
+        if (not self.dirty) or self.interval <= 0:
+            return None
+        return max(0.0, self.interval - (time.monotonic() - self.sent))
+
+    def push(self, pipe, force=False):
+        """Send {"METRICS": snapshot} down `pipe' if one is due, or right away
+        if `force' is set"""
+        if not force and self.wait_time() != 0.0:
+            return
+        self.sent = time.monotonic()
+        self.dirty = False
+        pipe.send({"METRICS": self.snapshot()})
+
+
+def prometheus(snapshots):
+    """Render `snapshots', a dict of stage -> snapshot, in the Prometheus text
+    exposition format. Every sample gets a `stage' label."""
+    metrics = {}
+
+    def add(kind, key, stage, suffix, value, extra=""):
+        name, labels = split_key(key)
+        labels = ",".join(each for each in (f'stage="{stage}"', labels, extra) if each)
+        metrics.setdefault(name, (kind, []))[1].append(
+            f"{PREFIX}{name}{suffix}{{{labels}}} {value}")
+
+    for stage in sorted(snapshots):
+        snapshot = snapshots[stage]
+        for key, value in sorted(snapshot["counters"].items()):
+            add("counter", key, stage, "", value)
+        for key, value in sorted(snapshot["gauges"].items()):
+            add("gauge", key, stage, "", value)
+        for key, value in sorted(snapshot["histograms"].items()):
+            cumulative = 0
+            for bound, count in zip(value["bounds"] + ["+Inf"], value["buckets"]):
+                cumulative += count
+                add("histogram", key, stage, "_bucket", cumulative, f'le="{bound}"')
+            add("histogram", key, stage, "_sum", value["sum"])
+            add("histogram", key, stage, "_count", value["count"])
+    output = []
+    for name in sorted(metrics):
+        output.append(f"# TYPE {PREFIX}{name} {metrics[name][0]}")
+        output.extend(metrics[name][1])
+    return "\n".join(output) + "\n"
+
+
+def write_prometheus(snapshots, path):
+    """Write `snapshots' to `path' for node_exporter's textfile collector,
+    which must never see half a file"""
+    with open(f"{path}.tmp", "w") as file:
+        file.write(prometheus(snapshots))
+    os.replace(f"{path}.tmp", path)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  profiling.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Profiling any of our processes on demand
+
+Every process sets up a Profiler when it starts. SIGUSR1 starts or stops
+profiling where its time goes, and SIGUSR2 starts or stops tracing its
+memory; the D-Bus `toggle_profiling' method gets the router to send them.
+Results are written to the profile directory when they are stopped, named
+after the process. Until then nothing is hooked in, so there is no cost
+while nothing is being profiled.
+
+Time is profiled by either:
+ * "sampling": every thread's stack is sampled every `SAMPLE_INTERVAL'
+   seconds, so time spent waiting (on clamd, say, or in the pool of filter
+   workers) shows up as well. Written as `.folded', one stack and how many
+   samples it was seen in per line, which flamegraph.pl and speedscope read.
+ * "cprofile": cProfile, on the main thread only. Written as `.prof', for
+   pstats or snakeviz.
+Memory is traced with tracemalloc and written as a `.heap' snapshot (see
+tracemalloc.Snapshot.load()), plus the biggest allocations as `.txt'."""
+from __future__ import print_function
+import sys
+import os
+import time
+import signal
+import threading
+import tracemalloc
+import cProfile
+from collections import Counter
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=sys.stderr, **kwargs)
+
+
+if sys.version_info[0] == 2:
+    eprint("Please run with Python 3 as Python 2 is End-of-Life.")
+    exit(2)
+
+
+# what to profile -> the signal that starts and stops it
+SIGNALS = {"cpu": signal.SIGUSR1, "memory": signal.SIGUSR2}
+MODES = ("sampling", "cprofile")
+# seconds between samples of every thread's stack
+SAMPLE_INTERVAL = 0.005
+# how many frames tracemalloc keeps for each allocation
+TRACE_FRAMES = 25
+# how many of the biggest allocations go in the `.txt' summary
+TOP_ALLOCATIONS = 50
+
+
+def frame_name(frame):
+    """What `frame' looks like in a folded stack"""
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Sampler:
+    """Counts every thread's stack, every `interval' seconds, from a thread
+    of its own"""
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+
+    def enable(self):
+        """Start sampling"""
+        self.thread.start()
+
+    def disable(self):
+        """Stop sampling"""
+        self.stopping.set()
+        self.thread.join()
+
+    def run(self):
+        """Sample until told to stop"""
+        me = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            names = {each.ident: each.name for each in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, "thread"))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def dump_stats(self, path):
+        """Write the stacks seen to `path', folded"""
+        with open(path, "w") as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f"{stack} {count}\n")
+
+
+class Profiler:
+    """Starts and stops profiling of this process, `name', writing results
+    into `directory'
+
+    `metrics' (see metrics.py), if given, get a "profiling" gauge for each
+    kind, so get_stats() shows what is being profiled where."""
+    def __init__(self, name, directory, mode="sampling", metrics=None):
+        if mode not in MODES:
+            eprint(f"Unknown profile mode {mode!r}. Sampling instead.")
+            mode = "sampling"
+        self.name = name
+        self.directory = directory
+        self.mode = mode
+        self.metrics = metrics
+        self.cpu = None
+
+    def active(self, kind):
+        """Whether `kind' of profiling is going on"""
+        if kind == "cpu":
+            return self.cpu is not None
+        return tracemalloc.is_tracing()
+
+    def path(self, extension):
+        """Where to write a profile ending in `extension'"""
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        return os.path.join(self.directory,
+                            f"{self.name}-{os.getpid()}-{stamp}{extension}")
+
+    def start(self, kind):
+        """Start `kind' ("cpu" or "memory") of profiling"""
+        if self.active(kind):
+            return
+        if kind == "cpu":
+            self.cpu = Sampler() if self.mode == "sampling" else cProfile.Profile()
+            self.cpu.enable()
+        else:
+            tracemalloc.start(TRACE_FRAMES)
+        print(f"{self.name}: {kind} profiling started")
+        self.gauge(kind)
+
+    def stop(self, kind):
+        """Stop `kind' of profiling, returning where it was written to"""
+        if not self.active(kind):
+            return None
+        if kind == "cpu":
+            profile, self.cpu = self.cpu, None
+            profile.disable()
+            output = self.path(".folded" if self.mode == "sampling" else ".prof")
+            profile.dump_stats(output)
+        else:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            output = self.path(".heap")
+            snapshot.dump(output)
+            with open(output[:-len(".heap")] + ".txt", "w") as file:
+                for each in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+                    file.write(f"{each}\n")
+        print(f"{self.name}: {kind} profile written to {output}")
+        self.gauge(kind)
+        return output
+
+    def toggle(self, kind):
+        """Start `kind' of profiling if it isn't going, stop it if it is"""
+        try:
+            if self.active(kind):
+                self.stop(kind)
+            else:
+                self.start(kind)
+        except OSError as err:
+            eprint(f"{self.name}: could not write {kind} profile: {err}")
+
+    def gauge(self, kind):
+        """Let the metrics know whether `kind' is being profiled"""
+        if self.metrics is not None:
+            self.metrics.gauge("profiling", int(self.active(kind)), kind=kind)
+
+    def install(self, add_handler=None):
+        """Start and stop profiling on `SIGNALS'. Main loops that don't let
+        Python signal handlers run (GLib's) can pass `add_handler(signum,
+        callback)' to hook them in their own way."""
+        for kind, signum in SIGNALS.items():
+            if add_handler is not None:
+                add_handler(signum, lambda *args, kind=kind: self.toggle(kind) or True)
+            else:
+                signal.signal(signum, lambda signum, frame, kind=kind: self.toggle(kind))
+
+
+def hold():
+    """Hold back `SIGNALS' until setup() is called. Processes started after
+    this would otherwise be killed by one arriving before they get that far."""
+    signal.pthread_sigmask(signal.SIG_BLOCK, SIGNALS.values())
+
+
+def setup(name, directory, mode="sampling", metrics=None, add_handler=None):
+    """A Profiler for this process, already listening for `SIGNALS'. With no
+    `directory', profiling is off and the signals are ignored. Any that came
+    in after hold() are let through once we are listening."""
+    profiler = None
+    if not directory:
+        for signum in SIGNALS.values():
+            if add_handler is not None:
+                add_handler(signum, lambda *args: True)
+            else:
+                signal.signal(signum, signal.SIG_IGN)
+    else:
+        profiler = Profiler(name, directory, mode, metrics)
+        profiler.install(add_handler)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, SIGNALS.values())
+    return profiler
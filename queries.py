@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  queries.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Answer read-only queries against a set of reports and the views kept
+over them. Shared by the DB and its read replicas."""
+from __future__ import print_function
+import sys
+from report import plain
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=sys.stderr, **kwargs)
+
+
+if sys.version_info[0] == 2:
+    eprint("Please run with Python 3 as Python 2 is End-of-Life.")
+    exit(2)
+
+
+# commands that only read, so anything holding a copy of the reports can
+# answer them
+READ_COMMANDS = ("RECV", "AGGREGATE", "SEARCH")
+
+
+def recv(query, db, index, archive=None):
+    """Pull reports from `db': one by "code", those matching "in_report", or
+    "all" of them. Only "code" looks in the `archive' (see archive.py)."""
+    output = None
+    if "code" in query:
+        try:
+            output = plain(db[query["code"]])
+        except KeyError:
+            if archive is not None:
+                output = archive.get(query["code"])
+            if output is None:
+                eprint(f"Installation {query['code']} requested but not found.")
+    elif "in_report" in query:
+        codes = index.search(query["in_report"], db)
+        output = [plain(db[each]) for each in sorted(codes)]
+    elif "all" in query:
+        output = {code: plain(report) for code, report in db.items()}
+    return output
+
+
+def aggregate(query, aggregates):
+    """Fleet statistics, from counts kept up to date by ADD and DEL"""
+    try:
+        return aggregates.query(query.get("group_by", ()), query.get("filters"))
+    except (ValueError, TypeError, AttributeError) as err:
+        return f"ERROR: {err}"
+
+
+def search(query, db, text_index, limit=100):
+    """Full text search, ranked, at most "limit" results (`limit' if the
+    query doesn't say)"""
+    try:
+        total, found = text_index.search(query["query"], query.get("mode", "terms"), db,
+                                         query.get("limit") or limit, query.get("fields"))
+    except (ValueError, TypeError, KeyError, AttributeError) as err:
+        return f"ERROR: {err}"
+    return {"total": total,
+            "results": [{"score": score, "report": plain(db[code])} for score, code in found]}
+
+
+def run(cmd, db, index, aggregates, text_index, limit=100):
+    """Answer `cmd', which must be one of `READ_COMMANDS'"""
+    if "RECV" in cmd.keys():
+        return recv(cmd["RECV"], db, index)
+    if "AGGREGATE" in cmd.keys():
+        return aggregate(cmd["AGGREGATE"], aggregates)
+    return search(cmd["SEARCH"], db, text_index, limit)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  replica.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Read replicas: processes holding their own copy of the database, kept up
+to date by the DB, that answer read-only queries so the DB doesn't have to"""
+from __future__ import print_function
+import sys
+import json
+import time
+import pickle
+import threading
+from multiprocessing.connection import wait
+from index import ReportIndex
+from aggregates import Aggregates
+from fulltext import FullTextIndex
+from report import Report
+from metrics import Metrics
+from sharedmem import publish
+from segments import SegmentReader, load_checkpoint
+import queries
+import profiling
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=sys.stderr, **kwargs)
+
+
+if sys.version_info[0] == 2:
+    eprint("Please run with Python 3 as Python 2 is End-of-Life.")
+    exit(2)
+
+
+# how often we tell the request handler how we're doing, in seconds
+STATUS_INTERVAL = 1.0
+
+
+class Replica:
+    """A copy of the reports in the DB, and the views over them, as of
+    `version'
+
+    Changes come in on a separate thread, which queues them up and applies
+    them whenever the copy isn't in use, so the DB never has to wait on us.
+    Anything reading the copy should hold `lock' and call `catch_up()'
+    first.
+
+    When the DB keeps reports in segments (see segments.py), we start from
+    its checkpoint and only keep where each report is, reading them from
+    the DB's own segment files, so the reports are never copied into RAM."""
+    def __init__(self, compact_reports=True):
+        self.compact_reports = compact_reports
+        self.db = {}
+        self.index = ReportIndex()
+        self.aggregates = Aggregates()
+        self.text_index = FullTextIndex()
+        self.views = (self.index, self.aggregates, self.text_index)
+        self.version = 0
+        # the DB's clock when it sent the last change we've applied
+        self.as_of = 0.0
+        self.synced = False
+        self.backlog = []
+        self.lock = threading.Lock()
+
+    def store(self, report):
+        """What actually gets kept for `report'"""
+        if self.compact_reports and not isinstance(report, Report):
+            return Report(report)
+        return report
+
+    def reset(self, snapshot=None):
+        """Start over with nothing, or from the checkpoint in the segment
+        directory `snapshot'. Returns False if that can't be loaded."""
+        if isinstance(self.db, SegmentReader):
+            self.db.close()
+        self.synced = False
+        if snapshot is None:
+            self.db = {}
+        else:
+            self.db = SegmentReader(snapshot)
+            saved = load_checkpoint(snapshot)
+            try:
+                if saved is None or len(saved["views"]) != len(self.views):
+                    raise ValueError("No usable checkpoint")
+                for view, state in zip(self.views, saved["views"]):
+                    view.restore(state)
+                self.db.offsets = saved["store"]["offsets"]
+                return True
+            except (ValueError, KeyError, TypeError) as error:
+                # the DB sends another one after anything that replaces it
+                eprint(f"Can't load the DB's checkpoint in {snapshot}: {error}")
+        for each in self.views:
+            each.rebuild(self.db)
+        return snapshot is None
+
+    def apply(self, message):
+        """Apply one message from the DB"""
+        synced = "SYNCED" in message
+        if "RESET" in message:
+            synced = self.reset(message.get("SNAPSHOT")) and synced
+        shared = isinstance(self.db, SegmentReader)
+        for each in message.get("DEL", ()):
+            if each in self.db:
+                for view in self.views:
+                    view.remove(self.db[each])
+                if shared:
+                    self.db.forget(each)
+                else:
+                    del self.db[each]
+        for report in message.get("ADD", ()):
+            code = report['Installation Report Code']
+            if code in self.db:
+                for view in self.views:
+                    view.remove(self.db[code])
+            if shared:
+                self.db.point(code, message["WHERE"][code])
+            else:
+                self.db[code] = self.store(report)
+            for view in self.views:
+                view.add(report)
+        if synced:
+            self.synced = True
+        self.version = message["version"]
+        self.as_of = message["time"]
+
+    def catch_up(self):
+        """Apply everything that has come in. Hold `lock' while calling this."""
+        while len(self.backlog) > 0:
+            # list.pop(0) is atomic, so the feed thread can keep appending
+            message = pickle.loads(self.backlog.pop(0))
+            try:
+                self.apply(message)
+            except OSError as error:
+                # the segments we were reading were compacted or recovered
+                # away. The DB sends a fresh checkpoint after either.
+                eprint(f"Lost the DB's segments: {error}")
+                self.synced = False
+                self.version = message["version"]
+                self.as_of = message["time"]
+
+    def follow(self, feed):
+        """Take changes off `feed' for as long as it's open. Runs on its own
+        thread."""
+        while True:
+            try:
+                self.backlog.append(feed.recv_bytes())
+            except EOFError:
+                eprint("DB stopped sending changes. Replica is going stale.")
+                return
+            if self.lock.acquire(blocking=False):
+                try:
+                    self.catch_up()
+                finally:
+                    self.lock.release()
+
+    def staleness(self):
+        """At most how many seconds behind the DB we are"""
+        return max(time.time() - self.as_of, 0.0)
+
+    def status(self):
+        """How we're doing, for the request handler"""
+        return {"version": self.version, "staleness": self.staleness(),
+                "synced": self.synced, "reports": len(self.db)}
+
+
+def main(pipe, feed, number=0, page_size=100, compact_reports=True, max_staleness=2.0,
+         shm_threshold=0, metrics_interval=0, profile_dir="", profile_mode="sampling"):
+    """Answer read-only queries (see queries.READ_COMMANDS) from `pipe' using
+    a copy of the database kept up to date through `feed'
+
+    Replies are sent already serialized, as {"REPLY": json} or, if it's at
+    least `shm_threshold' characters, {"SHM": handle}, along with the
+    version they are from and how stale they could be. If we are more than
+    `max_staleness' seconds behind, or don't have a full copy yet, the reply
+    is {"STALE": staleness} and the query should go to the DB instead. So
+    should a RECV of a code we don't have, which may have been archived
+    (see archive.py); that reply is {"MISS": code}.
+
+    SIGUSR1 and SIGUSR2 start and stop profiling into `profile_dir' (see
+    profiling.py)."""
+    replica = Replica(compact_reports)
+    metrics = Metrics(f"replica-{number}", metrics_interval)
+    profiling.setup(f"replica-{number}", profile_dir, profile_mode, metrics)
+    thread = threading.Thread(target=replica.follow, args=(feed,), daemon=True)
+    thread.start()
+    status_due = time.monotonic()
+    while True:
+        timeout = max(status_due - time.monotonic(), 0)
+        if len(wait([pipe], timeout)) > 0:
+            try:
+                cmd = pipe.recv()
+            except EOFError:
+                return
+            started = time.perf_counter()
+            with replica.lock:
+                replica.catch_up()
+                staleness = replica.staleness()
+                if (not replica.synced) or staleness > max_staleness or not thread.is_alive():
+                    metrics.count("replica_stale_total")
+                    pipe.send({"STALE": staleness, "ID": cmd.get("ID")})
+                    continue
+                if "code" in cmd.get("RECV", {}) and cmd["RECV"]["code"] not in replica.db:
+                    metrics.count("replica_misses_total")
+                    pipe.send({"MISS": cmd["RECV"]["code"], "ID": cmd.get("ID")})
+                    continue
+                try:
+                    output = queries.run(cmd, replica.db, replica.index, replica.aggregates,
+                                         replica.text_index, page_size)
+                except OSError:
+                    # segments the DB has since replaced. It has the answer.
+                    metrics.count("replica_stale_total")
+                    pipe.send({"STALE": staleness, "ID": cmd.get("ID")})
+                    continue
+                version = replica.version
+            text = json.dumps({"DATA": output})
+            data = {"ID": cmd.get("ID"), "VERSION": version, "STALENESS": staleness}
+            if shm_threshold > 0 and len(text) >= shm_threshold:
+                data["SHM"] = publish(text)
+            else:
+                data["REPLY"] = text
+            pipe.send(data)
+            metrics.observe("replica_command_seconds", time.perf_counter() - started,
+                            command=next(iter(cmd.keys() - {"ID"}), "NONE"))
+            metrics.observe("replica_staleness_seconds", staleness)
+        if time.monotonic() >= status_due:
+            # without the lock, so a long catch up doesn't make us look dead
+            status = replica.status()
+            metrics.gauge("replica_version", status["version"])
+            metrics.gauge("replica_reports", status["reports"])
+            pipe.send({"STATUS": status})
+            status_due = time.monotonic() + STATUS_INTERVAL
+        metrics.push(pipe)
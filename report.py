@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  report.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Compact in-memory representation of installation reports"""
+from __future__ import print_function
+import sys
+import json
+import zlib
+from collections.abc import Mapping
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=sys.stderr, **kwargs)
+
+
+if sys.version_info[0] == 2:
+    eprint("Please run with Python 3 as Python 2 is End-of-Life.")
+    exit(2)
+
+
+# the same handful of values show up in report after report
+INTERNED_FIELDS = ("system-installer Version", "OS", "CPU INFO", "PCIe / GPU INFO",
+                   "RAM / SWAP INFO", "DISK SETUP", "MODE")
+# big, rarely read, and very compressible
+COMPRESSED_FIELDS = ("INSTALLATION LOG", "CUSTOM MESSAGE")
+FIELDS = ('Installation Report Code',) + INTERNED_FIELDS + COMPRESSED_FIELDS
+POSITION = {each: count for count, each in enumerate(FIELDS)}
+
+# text shorter than this isn't worth compressing
+COMPRESS_OVER = 512
+# non-string values are only shared if their JSON is at most this long
+SHARE_UNDER = 1024
+
+# shared copies of non-string field values, by their JSON
+SHARED = {}
+
+
+class Missing:
+    """Stands in for fields a report doesn't have"""
+    __slots__ = ()
+
+    def __reduce__(self):
+        return "MISSING"
+
+
+MISSING = Missing()
+
+
+def intern_value(value):
+    """Get a shared copy of `value', so identical values only take up memory once"""
+    if isinstance(value, str):
+        return sys.intern(value)
+    key = json.dumps(value, sort_keys=True)
+    if len(key) > SHARE_UNDER:
+        return value
+    return SHARED.setdefault(key, value)
+
+
+def compress_value(value):
+    """Compress long text. Anything else is left alone."""
+    if isinstance(value, str) and len(value) > COMPRESS_OVER:
+        return zlib.compress(value.encode())
+    return value
+
+
+class Report(Mapping):
+    """A read-only installation report
+
+    Behaves like the dict it was made from, but known fields are kept in a
+    tuple instead of a hash table, repeated values are shared between
+    reports, and logs are kept compressed until somebody reads them."""
+    __slots__ = ("values", "extra")
+
+    def __init__(self, report):
+        values = [MISSING] * len(FIELDS)
+        extra = None
+        for key, value in report.items():
+            if key in INTERNED_FIELDS:
+                value = intern_value(value)
+            elif key in COMPRESSED_FIELDS:
+                value = compress_value(value)
+            if key in POSITION:
+                values[POSITION[key]] = value
+            else:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+        self.values = tuple(values)
+        self.extra = extra
+
+    def __getitem__(self, key):
+        position = POSITION.get(key)
+        if position is None:
+            if self.extra is None:
+                raise KeyError(key)
+            return self.extra[key]
+        value = self.values[position]
+        if value is MISSING:
+            raise KeyError(key)
+        if isinstance(value, bytes):
+            # only compressed text is ever kept as bytes; JSON has no bytes
+            return zlib.decompress(value).decode()
+        return value
+
+    def __contains__(self, key):
+        position = POSITION.get(key)
+        if position is None:
+            return self.extra is not None and key in self.extra
+        return self.values[position] is not MISSING
+
+    def __iter__(self):
+        for count, each in enumerate(self.values):
+            if each is not MISSING:
+                yield FIELDS[count]
+        if self.extra is not None:
+            yield from self.extra
+
+    def __len__(self):
+        output = sum(1 for each in self.values if each is not MISSING)
+        if self.extra is not None:
+            output += len(self.extra)
+        return output
+
+    def to_dict(self):
+        """Plain dict copy, for sending or writing out"""
+        return dict(self.items())
+
+    def __repr__(self):
+        return f"Report({self.to_dict()!r})"
+
+
+def plain(report):
+    """`report' as something JSON and other processes can take"""
+    if isinstance(report, Report):
+        return report.to_dict()
+    return report
@@ -24,13 +24,22 @@
 """handles requests for data from the DB."""
 from __future__ import print_function
 import sys
-import time
 import json
+import time
+from collections import OrderedDict
 import dbus
 import dbus.service
 from dbus.mainloop.glib import DBusGMainLoop
 import gi
 from gi.repository import GLib
+from index import QUERYABLE_FIELDS
+from aggregates import DIMENSIONS
+from fulltext import MODES
+from metrics import Metrics
+from sharedmem import collect
+from queries import READ_COMMANDS
+from replica import STATUS_INTERVAL
+import profiling
 
 # We're going to use D-Bus to communicate with external processes.
 # Should make things clean, efficient, and cohesive
@@ -46,53 +55,364 @@ if sys.version_info[0] == 2:
     exit(2)
 
 
+def parse_search(search_string):
+    """Parse and check a JSON search term. Returns the search term, and an
+    error reply if it's no good."""
+    try:
+        search_term = json.loads(search_string)
+    except:
+        return None, '{"DATA": "ERROR: Need JSON formatted string"}'
+    if not isinstance(search_term, dict):
+        return None, '{"DATA": "ERROR: Need a JSON object"}'
+    for each in search_term:
+        if each not in QUERYABLE_FIELDS:
+            return None, json.dumps({"DATA": f"ERROR: key {each} not recognized."})
+    return search_term, None
+
+
+def parse_aggregate(group_by, filters):
+    """Parse and check the JSON list of dimensions to group by and the JSON
+    object of filters for an aggregate query. Either may be empty. Returns
+    the query, and an error reply if it's no good."""
+    try:
+        group_by = json.loads(group_by) if group_by else []
+        filters = json.loads(filters) if filters else {}
+    except:
+        return None, '{"DATA": "ERROR: Need JSON formatted strings"}'
+    if not isinstance(group_by, list) or not isinstance(filters, dict):
+        return None, '{"DATA": "ERROR: Need a JSON list to group by and a JSON object of filters"}'
+    for each in group_by + list(filters):
+        if each not in DIMENSIONS:
+            return None, json.dumps({"DATA": f"ERROR: can't group or filter by {each}. "
+                                             f"Options are: {', '.join(DIMENSIONS)}"})
+    return {"group_by": group_by, "filters": filters}, None
+
+
+# how long a read replica can go without sending its STATUS before we treat
+# it as dead, in seconds
+REPLICA_TIMEOUT = STATUS_INTERVAL * 5
+
+
+class ReportCache:
+    """Size bounded LRU cache of serialized replies, keyed by report code"""
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, code):
+        """Get the cached reply for `code', or None"""
+        try:
+            self.entries.move_to_end(code)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.entries[code]
+
+    def put(self, code, reply):
+        """Cache `reply' for `code', pushing out the least recently used entry
+        if we're full"""
+        if self.size <= 0:
+            return
+        self.entries[code] = reply
+        self.entries.move_to_end(code)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, codes):
+        """Drop `codes' from the cache, or everything if `codes' is None"""
+        if codes is None:
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+            return
+        for each in codes:
+            if self.entries.pop(each, None) is not None:
+                self.invalidations += 1
+
+    def stats(self):
+        """Counters for tuning the cache size"""
+        return {"hits": self.hits, "misses": self.misses,
+                "invalidations": self.invalidations,
+                "entries": len(self.entries), "size": self.size}
+
+
 class signal_handlers(dbus.service.Object):
-    """Signal Handlers for DBus"""
-    def __init__(self, bus_obj, bus_loc, pipe, response_time):
+    """Signal Handlers for DBus
+
+    Requests are answered asynchronously: each one is tagged with an ID and
+    sent to the DB, and the reply is sent back to the D-Bus caller whenever
+    it turns up on the pipe. So any number of requests can be in flight.
+
+    Read-only queries go to the least busy read replica in `replicas', if
+    there are any, and fall back to the DB when a replica is too far behind
+    or has died."""
+    def __init__(self, bus_obj, bus_loc, pipe, cache_size=0, replicas=()):
         """Make pipe available to whole class"""
         super().__init__(bus_obj, bus_loc)
         self.pipe = pipe
+        self.replicas = list(replicas)
+        # latest STATUS from each replica, None once it's gone
+        self.replica_status = [{} for each in self.replicas]
+        # when we last heard from each replica
+        self.replica_seen = [time.monotonic() for each in self.replicas]
+        self.cache = ReportCache(cache_size)
+        self.metrics = Metrics("request")
+        self.next_id = 0
+        # the newest DB version we've heard of
+        self.version = 0
+        # request ID -> (reply callback, cache key, command, when it was sent,
+        #                replica it went to or None for the DB)
+        self.pending = {}
+
+    def handle_notification(self, data):
+        """Deal with messages from the DB we didn't ask for. Returns False if
+        `data' isn't one."""
+        if "CHANGED" in data.keys():
+            self.cache.invalidate(data["CHANGED"])
+            self.version = max(self.version, data.get("VERSION", 0))
+            return True
+        return False
+
+    def finish(self, data):
+        """Send the reply `data' to whoever is waiting on it"""
+        reply_handler, cache_key, cmd, started, replica = self.pending.pop(data.pop("ID"))
+        if "SHM" in data.keys():
+            # big replies come serialized already
+            reply = collect(data["SHM"])
+        elif "REPLY" in data.keys():
+            # so do all replies from replicas, and the DB's smaller ones when
+            # it's using shared memory
+            reply = data["REPLY"]
+        else:
+            reply = json.dumps(data)
+        command = next(iter(cmd.keys() - {"ID"}))
+        self.metrics.observe("request_seconds", time.perf_counter() - started,
+                             command=command, source="db" if replica is None else "replica")
+        # a reply from a replica that's behind what we know of may hold
+        # something we've already thrown out of the cache
+        if ((cache_key is not None) and data.keys() & {"DATA", "SHM", "REPLY"} and
+                data.get("VERSION", self.version) >= self.version):
+            self.cache.put(cache_key, reply)
+        reply_handler(reply)
+
+    def drain(self, *args):
+        """Handle everything waiting on the pipe: notifications, and replies
+        to requests in flight"""
+        while self.pipe.poll():
+            data = self.pipe.recv()
+            if self.handle_notification(data):
+                continue
+            if data.get("ID") not in self.pending:
+                # errors caused by intake get broadcast to us as well
+                eprint(f"Dropping unexpected message from DB: {data}")
+                if "SHM" in data.keys():
+                    collect(data["SHM"])
+                continue
+            self.finish(data)
+        return True
+
+    def drain_replica(self, source, condition, number):
+        """Handle everything waiting on replica `number''s pipe"""
+        pipe = self.replicas[number]
         try:
-            self.resp_time = float(response_time)
-        except ValueError:
-            self.resp_time = 0.1
+            while pipe.poll():
+                data = pipe.recv()
+                self.replica_seen[number] = time.monotonic()
+                if "METRICS" in data.keys():
+                    # the router keeps everyone's metrics
+                    self.pipe.send(data)
+                elif "STATUS" in data.keys():
+                    self.replica_status[number] = data["STATUS"]
+                elif "STALE" in data.keys():
+                    self.metrics.count("request_replica_fallbacks_total", reason="stale")
+                    self.redirect(data["ID"])
+                elif "MISS" in data.keys():
+                    # only the DB has the archive
+                    self.metrics.count("request_replica_fallbacks_total", reason="missing")
+                    self.redirect(data["ID"])
+                elif data.get("ID") in self.pending:
+                    self.finish(data)
+        except (EOFError, OSError):
+            self.lose_replica(number)
+            return False
+        return True
+
+    def check_replicas(self):
+        """Give up on replicas that have stopped sending their STATUS. A
+        replica that dies doesn't always close its pipe, as other processes
+        may still hold the other end of it."""
+        for number, seen in enumerate(self.replica_seen):
+            if time.monotonic() - seen > REPLICA_TIMEOUT:
+                self.lose_replica(number)
+        return any(each is not None for each in self.replica_status)
+
+    def lose_replica(self, number):
+        """Stop using replica `number', sending what it had to the DB"""
+        if self.replica_status[number] is None:
+            return
+        eprint(f"Read replica {number} has gone away. Sending its queries to the DB.")
+        self.replica_status[number] = None
+        for each in [key for key, value in self.pending.items() if value[4] == number]:
+            self.metrics.count("request_replica_fallbacks_total", reason="dead")
+            self.redirect(each)
+
+    def redirect(self, request_id):
+        """Send request `request_id' to the DB instead of a replica"""
+        reply_handler, cache_key, cmd, started, replica = self.pending[request_id]
+        self.pending[request_id] = (reply_handler, cache_key, cmd, started, None)
+        self.pipe.send(cmd)
 
-    @dbus.service.method("org.draugeros.Request_Handler", in_signature='s', out_signature='s')
-    def get_report_by_id(self, report_id: str) -> str:
+    def pick_replica(self, cmd):
+        """The replica to send `cmd' to, or None if it has to go to the DB"""
+        if next(iter(cmd.keys())) not in READ_COMMANDS:
+            return None
+        load = {number: 0 for number, status in enumerate(self.replica_status)
+                if status is not None and status.get("synced")}
+        if len(load) == 0:
+            return None
+        for each in self.pending.values():
+            if each[4] in load:
+                load[each[4]] += 1
+        return min(load, key=load.get)
+
+    def request(self, cmd, reply_handler, cache_key=None):
+        """Send `cmd' to the DB, or a read replica, calling `reply_handler'
+        with the serialized reply once it arrives"""
+        self.next_id += 1
+        replica = self.pick_replica(cmd)
+        cmd["ID"] = self.next_id
+        self.pending[self.next_id] = (reply_handler, cache_key, cmd, time.perf_counter(),
+                                      replica)
+        if replica is None:
+            self.pipe.send(cmd)
+            return
+        try:
+            self.replicas[replica].send(cmd)
+        except OSError:
+            self.lose_replica(replica)
+
+    def push_metrics(self, force=False):
+        """Send our metrics to the router, if anything happened since last
+        time"""
+        if self.metrics.dirty or force:
+            for name, value in self.cache.stats().items():
+                self.metrics.gauge(f"request_cache_{name}", value)
+            self.metrics.gauge("request_pending", len(self.pending))
+            self.metrics.push(self.pipe, True)
+        return True
+
+    @dbus.service.method("org.draugeros.Request_Handler", in_signature='s', out_signature='s',
+                         async_callbacks=("reply_handler", "error_handler"))
+    def get_report_by_id(self, report_id: str, reply_handler, error_handler):
         """Retrieve Installation report from DB"""
         print(f"Requesting data on report: {report_id}")
+        # anything that changed since we last looked has to be forgotten first
+        self.drain()
+        reply = self.cache.get(str(report_id))
+        if reply is not None:
+            reply_handler(reply)
+            return
         try:
-            self.pipe.send({'RECV': {"code": str(report_id)}})
+            self.request({'RECV': {"code": str(report_id)}}, reply_handler, str(report_id))
         except ValueError:
-            return '{"DATA": "ERROR: ValueError"}'
-        while True:
-            if self.pipe.poll():
-                return json.dumps(self.pipe.recv())
-            #  print("Waiting on reply...")
-            time.sleep(self.resp_time)
-
-    @dbus.service.method("org.draugeros.Request_Handler", in_signature='s', out_signature='s')
-    def get_report_by_contents(self, search_string: str) -> str:
+            reply_handler('{"DATA": "ERROR: ValueError"}')
+
+    @dbus.service.method("org.draugeros.Request_Handler", in_signature='s', out_signature='s',
+                         async_callbacks=("reply_handler", "error_handler"))
+    def get_report_by_contents(self, search_string: str, reply_handler, error_handler):
         """Retrive installation reports from DB that match certain data"""
-        try:
-            search_term = json.loads(search_string)
-        except:
-            return "{'DATA': 'ERROR: Need JSON formatted string'}"
-        accepted_keys = ["system-installer Version", "OS", "CPU INFO", "PCIe / GPU INFO",
-                         "RAM / SWAP INFO", "DISK SETUP", "INSTALLATION LOG", "CUSTOM MESSAGE", "MODE"]
-        for each in search_term:
-            if each not in accepted_keys:
-                return f"{'DATA': 'ERROR: key {each} not recognized.'}"
+        search_term, error = parse_search(search_string)
+        if error is not None:
+            reply_handler(error)
+            return
         print(f"Requesting data on reports containing:\n{ json.dumps(search_term, indent=2) }")
-        self.pipe.send({"RECV": {"in_report": search_term}})
-        while True:
-             if self.pipe.poll():
-                 return json.dumps(self.pipe.recv())
-             #  print("Waiting on reply...")
-             time.sleep(self.resp_time)
+        self.request({"RECV": {"in_report": search_term}}, reply_handler)
+
+    @dbus.service.method("org.draugeros.Request_Handler", in_signature='ssi', out_signature='s',
+                         async_callbacks=("reply_handler", "error_handler"))
+    def search_reports(self, query: str, mode: str, limit: int, reply_handler, error_handler):
+        """Find reports whose installation log or custom message contain
+        `query', best match first. `mode' is "terms" (the default), "phrase"
+        or "substring". A `limit' of 0 means use the default."""
+        if mode == "":
+            mode = "terms"
+        if mode not in MODES:
+            reply_handler(json.dumps({"DATA": f"ERROR: mode must be one of: {', '.join(MODES)}"}))
+            return
+        print(f"Searching reports for {mode}: {query}")
+        self.request({"SEARCH": {"query": str(query), "mode": mode, "limit": max(int(limit), 0)}},
+                     reply_handler)
+
+    @dbus.service.method("org.draugeros.Request_Handler", in_signature='ss', out_signature='s',
+                         async_callbacks=("reply_handler", "error_handler"))
+    def get_aggregates(self, group_by: str, filters: str, reply_handler, error_handler):
+        """Count reports, grouped by the dimensions in the JSON list `group_by',
+        that match the JSON object `filters'"""
+        query, error = parse_aggregate(group_by, filters)
+        if error is not None:
+            reply_handler(error)
+            return
+        self.request({"AGGREGATE": query}, reply_handler)
+
+    @dbus.service.method("org.draugeros.Request_Handler", in_signature='si', out_signature='s',
+                         async_callbacks=("reply_handler", "error_handler"))
+    def open_cursor(self, search_string: str, page_size: int, reply_handler, error_handler):
+        """Open a cursor over reports matching `search_string', or every report
+        if it is empty. `page_size' of 0 means use the default."""
+        query = {"all": None}
+        if search_string not in ("", "{}"):
+            search_term, error = parse_search(search_string)
+            if error is not None:
+                reply_handler(error)
+                return
+            query = {"in_report": search_term}
+        self.request({"CURSOR": {"open": query, "page_size": int(page_size)}}, reply_handler)
+
+    @dbus.service.method("org.draugeros.Request_Handler", in_signature='i', out_signature='s',
+                         async_callbacks=("reply_handler", "error_handler"))
+    def fetch_page(self, cursor: int, reply_handler, error_handler):
+        """Get the next page of reports from `cursor'"""
+        self.request({"CURSOR": {"next": int(cursor)}}, reply_handler)
+
+    @dbus.service.method("org.draugeros.Request_Handler", in_signature='i', out_signature='s',
+                         async_callbacks=("reply_handler", "error_handler"))
+    def close_cursor(self, cursor: int, reply_handler, error_handler):
+        """Close `cursor' before reaching its last page"""
+        self.request({"CURSOR": {"close": int(cursor)}}, reply_handler)
+
+    @dbus.service.method("org.draugeros.Request_Handler", in_signature='', out_signature='s')
+    def get_cache_stats(self) -> str:
+        """Hit/miss counters for the report cache"""
+        return json.dumps(self.cache.stats())
+
+    @dbus.service.method("org.draugeros.Request_Handler", in_signature='', out_signature='s')
+    def get_replica_status(self) -> str:
+        """Version, staleness and size of each read replica, null for any
+        that have died"""
+        return json.dumps({"version": self.version, "replicas": self.replica_status})
+
+    @dbus.service.method("org.draugeros.Request_Handler", in_signature='', out_signature='s',
+                         async_callbacks=("reply_handler", "error_handler"))
+    def get_stats(self, reply_handler, error_handler):
+        """Counters and latency histograms from every stage, keyed by stage"""
+        # so ours are up to date too; the router gets them before the request
+        self.push_metrics(True)
+        self.request({"STATS": True}, reply_handler)
+
+    @dbus.service.method("org.draugeros.Request_Handler", in_signature='ss', out_signature='s',
+                         async_callbacks=("reply_handler", "error_handler"))
+    def toggle_profiling(self, process: str, kind: str, reply_handler, error_handler):
+        """Start `kind' ("cpu" or "memory") of profiling in `process' ("db",
+        "intake", "request", "filter", "router", "replica-N" or "all"), or
+        stop it and write the profile out if it is already going"""
+        self.request({"PROFILE": {"process": str(process), "kind": str(kind)}}, reply_handler)
 
 
-def main(pipe, response_time):
+def main(pipe, cache_size=0, metrics_interval=0, replicas=(), profile_dir="",
+         profile_mode="sampling"):
     """Start up DBus listeners"""
     #try:
     DBusGMainLoop(set_as_default=True)
@@ -100,7 +420,20 @@ def main(pipe, response_time):
     bus = dbus.SessionBus()
     name = dbus.service.BusName("org.draugeros.Request_Handler", bus)
     object = signal_handlers(bus, '/org/draugeros/Request_Handler',
-                                 pipe, response_time)
+                                 pipe, cache_size, replicas)
+    # replies and cache invalidations get handled as soon as they arrive
+    GLib.io_add_watch(pipe.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, object.drain)
+    for number, each in enumerate(replicas):
+        GLib.io_add_watch(each.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN | GLib.IO_HUP,
+                          object.drain_replica, number)
+    if len(replicas) > 0:
+        GLib.timeout_add_seconds(max(int(REPLICA_TIMEOUT), 1), object.check_replicas)
+    if metrics_interval > 0:
+        GLib.timeout_add_seconds(max(int(metrics_interval), 1), object.push_metrics)
+    # Python's own signal handlers wouldn't run until the main loop woke up
+    profiling.setup("request", profile_dir, profile_mode, object.metrics,
+                    lambda signum, callback: GLib.unix_signal_add(GLib.PRIORITY_DEFAULT,
+                                                                  signum, callback))
 
     mainloop = GLib.MainLoop()
     mainloop.run()
@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  router.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Pass messages between the DB, intake, and request processes"""
+from __future__ import print_function
+import sys
+import os
+import time
+from collections import deque
+from multiprocessing.connection import wait
+from metrics import Metrics, SIZE_BUCKETS, write_prometheus
+import profiling
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=sys.stderr, **kwargs)
+
+
+if sys.version_info[0] == 2:
+    eprint("Please run with Python 3 as Python 2 is End-of-Life.")
+    exit(2)
+
+
+# most messages taken off one pipe before the others get a turn
+MAX_DRAIN = 64
+# what the DB sends that doesn't answer a command
+UNPROMPTED = ("METRICS", "CHANGED")
+
+
+class RouterStats:
+    """Message counts and time spent in the hub, per direction"""
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Start a new measurement window"""
+        self.started = time.monotonic()
+        self.count = {}
+        self.hop_time = {}
+        self.max_hop = {}
+
+    def record(self, direction, seconds):
+        """Note one message forwarded in `direction', taking `seconds'"""
+        self.count[direction] = self.count.get(direction, 0) + 1
+        self.hop_time[direction] = self.hop_time.get(direction, 0.0) + seconds
+        if seconds > self.max_hop.get(direction, 0.0):
+            self.max_hop[direction] = seconds
+
+    def summary(self):
+        """Messages per second and hop latency for each direction"""
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        output = {}
+        for each in self.count:
+            output[each] = {"messages": self.count[each],
+                            "per_second": self.count[each] / elapsed,
+                            "avg_hop_ms": (self.hop_time[each] / self.count[each]) * 1000,
+                            "max_hop_ms": self.max_hop[each] * 1000}
+        return output
+
+
+class Batch:
+    """An ADD_BATCH from intake, sent to the DB a chunk at a time"""
+    def __init__(self, parts):
+        self.parts = parts
+        self.results = []
+
+
+class Scheduler:
+    """Commands waiting to go to the DB, queued per source
+
+    Queries come first: as long as both have something waiting, up to
+    `query_priority' queries go ahead of each intake command. At most
+    `db_window' commands are sent to the DB before it has answered them (0
+    for no limit), so the rest wait here, where they can still be put in
+    order, rather than in the DB's pipe. `limits' caps how many commands
+    each source may have waiting (0 for no limit).
+
+    ADD_BATCHes bigger than `chunk' reports are split up, so queries can go
+    in between the pieces rather than wait for all of it to be written.
+
+    Every command sent gets an "ID" of ours, which the DB copies into its
+    reply, so replies are matched up by that rather than by counting, and
+    go back to the source the command came from. The command's own ID, if
+    it had one, is put back before the reply is passed on."""
+    def __init__(self, db_window=0, limits=None, query_priority=1, chunk=0):
+        self.db_window = db_window
+        self.limits = limits or {}
+        self.query_priority = max(query_priority, 1)
+        self.chunk = chunk
+        # (command, when it was queued, Batch it is part of or None)
+        self.queues = {"request": deque(), "intake": deque()}
+        # our ID -> (source, Batch or None, reports in it if it's an
+        # ADD_BATCH, the command's own ID) for each command the DB hasn't
+        # answered yet, oldest first
+        self.in_flight = {}
+        self.last_id = 0
+        # queries sent since intake last had a turn
+        self.streak = 0
+
+    def full(self, source):
+        """Whether `source' has as many commands waiting as it's allowed"""
+        limit = self.limits.get(source, 0)
+        return limit > 0 and len(self.queues[source]) >= limit
+
+    def put(self, source, data):
+        """Queue `data' from `source'"""
+        queued = time.perf_counter()
+        if self.chunk > 0 and "ADD_BATCH" in data.keys() and len(data["ADD_BATCH"]) > self.chunk:
+            reports = data["ADD_BATCH"]
+            batch = Batch((len(reports) + self.chunk - 1) // self.chunk)
+            for each in range(0, len(reports), self.chunk):
+                self.queues[source].append(({"ADD_BATCH": reports[each:each + self.chunk]},
+                                            queued, batch))
+            return
+        self.queues[source].append((data, queued, None))
+
+    def answered(self, data):
+        """Note the DB answered a command with `data'. Returns the replies to
+        pass on, as (source, reply), which is none for part of a batch that
+        isn't done yet. Anything that isn't an answer to a command of ours
+        has None for its source.
+
+        The DB answers in order, so any command sent before the one `data'
+        answers that is still waiting was dropped, and never will be."""
+        if data.get("ID") not in self.in_flight:
+            # not an answer to anything we sent
+            return [(None, data)]
+        output = []
+        for each in list(self.in_flight):
+            if each == data["ID"]:
+                break
+            eprint(f"The DB never answered command {each}. Giving up on it.")
+            output.extend(self.settle(each, {"ERROR": "No reply from the DB"}))
+        output.extend(self.settle(data["ID"], data))
+        return output
+
+    def settle(self, key, data):
+        """Take command `key' out of flight, answered with `data'. Returns
+        the replies to pass on, as (source, reply)."""
+        source, batch, size, original = self.in_flight.pop(key)
+        if size is not None and "RESULTS" not in data:
+            # none of it made it in, but intake is waiting to hear about each.
+            # The DB never looked at them, so they aren't rejected, just to
+            # be tried again.
+            data = {"DONE": True,
+                    "RESULTS": [{"RETRY": data.get("ERROR", "No results from the DB")}] * size}
+        if original is None:
+            data.pop("ID", None)
+        else:
+            data["ID"] = original
+        if batch is None:
+            return [(source, data)]
+        batch.results.extend(data["RESULTS"])
+        batch.parts -= 1
+        if batch.parts > 0:
+            return []
+        return [(source, {"DONE": True, "RESULTS": batch.results})]
+
+    def backlog(self):
+        """Commands the DB has yet to answer, sent or not"""
+        return len(self.in_flight) + sum(len(each) for each in self.queues.values())
+
+    def next(self):
+        """Take the next command to send to the DB, as (source, data, when it
+        was queued), or None if there is nothing to send yet"""
+        if self.db_window > 0 and len(self.in_flight) >= self.db_window:
+            return None
+        queries, intake = self.queues["request"], self.queues["intake"]
+        if len(queries) > 0 and (len(intake) == 0 or self.streak < self.query_priority):
+            source = "request"
+            self.streak += 1
+        elif len(intake) > 0:
+            source = "intake"
+            self.streak = 0
+        else:
+            return None
+        data, queued, batch = self.queues[source].popleft()
+        self.last_id += 1
+        size = None
+        if isinstance(data.get("ADD_BATCH"), list):
+            size = len(data["ADD_BATCH"])
+        self.in_flight[self.last_id] = (source, batch, size, data.get("ID"))
+        return source, dict(data, ID=self.last_id), queued
+
+
+def wait_for_ready(db_pipe):
+    """Block until the DB says it's ready to go"""
+    while True:
+        if db_pipe.recv() == {"STATUS": "READY"}:
+            return
+
+
+def route(db_pipe, intake_pipe, request_pipe, stats_interval=0, metrics_pipe=None,
+          metrics_interval=0, metrics_file="", db_window=0, query_limit=0, intake_limit=0,
+          query_priority=1, pause_backlog=0, batch_chunk=0, processes=None, profile_dir="",
+          profile_mode="sampling"):
+    """Forward messages between processes as soon as they arrive
+
+    Blocks on all pipes at once, so nothing waits on a timer. If
+    `stats_interval' is above 0, throughput, hop latency and queue depths
+    are printed every `stats_interval' seconds.
+
+    Commands for the DB go through a Scheduler (see above), so queries don't
+    wait behind intake, with `db_window', `query_priority' and per source
+    limits of `query_limit' and `intake_limit', and intake's ADD_BATCHes
+    cut into `batch_chunk' reports at a time. A query that doesn't fit is
+    answered with {"ERROR": "BUSY"} straight away. Intake that doesn't fit
+    is left in its pipe until there is room. Once `pause_backlog' commands
+    are waiting on the DB intake is sent {"PAUSE": True}, and it stops
+    picking up reports until it gets {"RESUME": True}, when the backlog is
+    down to half that. 0 never pauses it.
+
+    Every process sends {"METRICS": snapshot} now and then, and the latest
+    one from each stage is kept here. The filter has no other reason to talk
+    to us, so it sends them down `metrics_pipe'. The request handler gets
+    them all by sending {"STATS": True}. If `metrics_file' is set they are
+    written there, in the Prometheus text format, every `metrics_interval'
+    seconds.
+
+    {"PROFILE": {"process": name, "kind": kind}} from the request handler
+    starts or stops that kind of profiling (see profiling.py) in the process
+    `name' in `processes' (name -> pid), the router, or "all" of them, by
+    sending it the signal for it. Ours is written to `profile_dir'."""
+    stats = RouterStats()
+    metrics = Metrics("router")
+    profiling.setup("router", profile_dir, profile_mode, metrics)
+    processes = dict(processes or {})
+    processes["router"] = os.getpid()
+    scheduler = Scheduler(db_window, {"request": query_limit, "intake": intake_limit},
+                          query_priority, batch_chunk)
+    paused = False
+    snapshots = {}
+    names = {db_pipe: "db", intake_pipe: "intake", request_pipe: "request"}
+    if metrics_pipe is not None:
+        names[metrics_pipe] = "filter"
+    next_stats = None
+    if stats_interval > 0:
+        next_stats = time.monotonic() + stats_interval
+    next_write = None
+    if metrics_file and metrics_interval > 0:
+        next_write = time.monotonic() + metrics_interval
+
+    def forward(pipe, data):
+        """Send `data' from `pipe' on to wherever it's going, returning the
+        direction it went in, or None if it stopped here or is queued"""
+        if "METRICS" in data.keys():
+            snapshots[data["METRICS"]["stage"]] = data["METRICS"]
+            return None
+        if pipe is db_pipe:
+            if any(each in data.keys() for each in UNPROMPTED):
+                return deliver(data)
+            direction = None
+            for source, each in scheduler.answered(data):
+                direction = deliver(each, source)
+            return direction
+        if "STATS" in data.keys():
+            output = dict(snapshots)
+            output["router"] = metrics.snapshot()
+            output = {"DATA": output}
+            if "ID" in data:
+                output["ID"] = data["ID"]
+            request_pipe.send(output)
+            return "request->router"
+        if "PROFILE" in data.keys():
+            output = {"DATA": profile(data["PROFILE"])}
+            if "ID" in data:
+                output["ID"] = data["ID"]
+            request_pipe.send(output)
+            return "request->router"
+        if scheduler.full(names[pipe]):
+            # only queries get here; intake isn't read while its queue is full
+            metrics.count("router_rejected_total", source=names[pipe])
+            output = {"ERROR": "BUSY"}
+            if "ID" in data:
+                output["ID"] = data["ID"]
+            request_pipe.send(output)
+            return "request->router"
+        scheduler.put(names[pipe], data)
+        return None
+
+    def deliver(data, source=None):
+        """Pass `data' from the DB on to `source', the process whose command
+        it answers, returning the direction it went in. Without a `source',
+        where it goes depends on what it is."""
+        if source == "request":
+            request_pipe.send(data)
+            return "db->request"
+        if source == "intake":
+            intake_pipe.send(data)
+            return "db->intake"
+        if "DATA" in data.keys():
+            request_pipe.send(data)
+            return "db->request"
+        if "SHM" in data.keys() or "REPLY" in data.keys():
+            # a reply serialized already, too big for the pipes or not
+            request_pipe.send(data)
+            return "db->request"
+        if "CHANGED" in data.keys():
+            # only the request handler caches anything
+            request_pipe.send(data)
+            return "db->request"
+        if "ERROR" in data.keys():
+            request_pipe.send(data)
+            intake_pipe.send(data)
+            return "db->all"
+        intake_pipe.send(data)
+        return "db->intake"
+
+    def profile(request):
+        """Signal the process(es) `request' names to start or stop profiling"""
+        kind = request.get("kind")
+        if kind not in profiling.SIGNALS:
+            return f"ERROR: kind must be one of: {', '.join(profiling.SIGNALS)}"
+        if request.get("process") == "all":
+            targets = processes
+        elif request.get("process") in processes:
+            targets = {request["process"]: processes[request["process"]]}
+        else:
+            return f"ERROR: process must be one of: {', '.join(processes)}, all"
+        signalled = []
+        for name, pid in targets.items():
+            try:
+                os.kill(pid, profiling.SIGNALS[kind])
+                signalled.append(name)
+            except OSError as err:
+                eprint(f"Could not signal {name} to profile: {err}")
+        return {"signalled": signalled}
+
+    def dispatch():
+        """Send the DB as much as the scheduler lets us"""
+        while True:
+            taken = scheduler.next()
+            if taken is None:
+                return
+            source, data, queued = taken
+            db_pipe.send(data)
+            seconds = time.perf_counter() - queued
+            stats.record(f"{source}->db", seconds)
+            metrics.observe("router_hop_seconds", seconds, direction=f"{source}->db")
+
+    def throttle():
+        """Pause or resume intake depending on how far behind the DB is"""
+        nonlocal paused
+        if pause_backlog <= 0:
+            return
+        backlog = scheduler.backlog()
+        if not paused and backlog >= pause_backlog:
+            paused = True
+            metrics.count("router_intake_pauses_total")
+            intake_pipe.send({"PAUSE": True})
+        elif paused and backlog <= pause_backlog // 2:
+            paused = False
+            intake_pipe.send({"RESUME": True})
+
+    while True:
+        timeout = None
+        deadlines = [each for each in (next_stats, next_write) if each is not None]
+        if len(deadlines) > 0:
+            timeout = max(min(deadlines) - time.monotonic(), 0)
+        # intake is left waiting on its pipe when its queue is full
+        ready = [each for each in names
+                 if not (each is intake_pipe and scheduler.full("intake"))]
+        for pipe in wait(ready, timeout):
+            # take whatever has piled up, within reason, so we can see how
+            # far behind we are
+            source = names[pipe]
+            depth = 0
+            while depth < MAX_DRAIN:
+                start = time.perf_counter()
+                try:
+                    data = pipe.recv()
+                except EOFError:
+                    if pipe is not metrics_pipe:
+                        raise
+                    eprint("Filter stopped sending metrics.")
+                    del names[pipe]
+                    break
+                depth += 1
+                direction = forward(pipe, data)
+                if direction is not None:
+                    seconds = time.perf_counter() - start
+                    stats.record(direction, seconds)
+                    metrics.observe("router_hop_seconds", seconds, direction=direction)
+                if not pipe.poll():
+                    break
+                if pipe is intake_pipe and scheduler.full("intake"):
+                    break
+            if depth > 0:
+                metrics.observe("router_pipe_depth", depth, SIZE_BUCKETS, source=source)
+        dispatch()
+        throttle()
+        for source, queue in scheduler.queues.items():
+            metrics.gauge("router_queue_depth", len(queue), source=source)
+        metrics.gauge("router_db_in_flight", len(scheduler.in_flight))
+        metrics.gauge("router_intake_paused", int(paused))
+        now = time.monotonic()
+        if next_stats is not None and now >= next_stats:
+            depths = {source: len(queue) for source, queue in scheduler.queues.items()}
+            print(f"ROUTER STATS: {stats.summary()} QUEUED: {depths} "
+                  f"IN FLIGHT: {len(scheduler.in_flight)} INTAKE PAUSED: {paused}")
+            stats.reset()
+            next_stats = now + stats_interval
+        if next_write is not None and now >= next_write:
+            output = dict(snapshots)
+            output["router"] = metrics.snapshot()
+            try:
+                write_prometheus(output, metrics_file)
+            except OSError as err:
+                eprint(f"Could not write metrics to {metrics_file}: {err}")
+            next_write = now + metrics_interval
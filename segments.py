@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  segments.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Segmented, append-only report storage. Only an offset index lives in RAM;
+reports are read out of memory-mapped segment files when asked for."""
+from __future__ import print_function
+import sys
+import os
+import json
+import mmap
+import pickle
+import shutil
+import struct
+from collections.abc import Mapping, MutableMapping
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=sys.stderr, **kwargs)
+
+
+if sys.version_info[0] == 2:
+    eprint("Please run with Python 3 as Python 2 is End-of-Life.")
+    exit(2)
+
+
+# every record is: operation, code length, body length, code, body
+HEADER = struct.Struct("!cHI")
+ADD = b"A"
+DEL = b"D"
+# where a checkpoint of the store (and whatever else is kept with it) lives
+CHECKPOINT = "checkpoint"
+# bumped whenever what goes in a checkpoint changes
+CHECKPOINT_VERSION = 1
+
+
+def segment_name(number):
+    """File name of segment `number'"""
+    return f"seg-{number:06d}.dat"
+
+
+def list_segments(path):
+    """Segment numbers in `path', oldest first"""
+    output = []
+    for each in os.listdir(path):
+        if each[:4] == "seg-" and each[-4:] == ".dat":
+            output.append(int(each[4:-4]))
+    return sorted(output)
+
+
+class SegmentReader(Mapping):
+    """Read-only view of reports in the segment files in directory `path'
+
+    Works like a dict of report code -> report, going by `offsets' (code ->
+    (segment number, offset of body, body length)). Reports are decoded
+    from a memory map of their segment every time they are looked up.
+    Segments are only ever appended to, so what a location points at never
+    changes under a reader, and a segment that is deleted can still be
+    read through a map made before it was."""
+    def __init__(self, path, offsets=None):
+        self.path = path
+        self.offsets = {} if offsets is None else offsets
+        self.maps = {}
+
+    def segment_path(self, number):
+        """Full path to segment `number'"""
+        return os.path.join(self.path, segment_name(number))
+
+    def point(self, code, location):
+        """Have `code' be the report at `location'"""
+        self.offsets[code] = location
+
+    def forget(self, code):
+        """Drop `code' from the index"""
+        self.offsets.pop(code, None)
+
+    def mapping(self, number, needed):
+        """Memory map of segment `number', covering at least `needed' bytes"""
+        data = self.maps.get(number)
+        if data is None or len(data) < needed:
+            if data is not None:
+                data.close()
+            with open(self.segment_path(number), "rb") as file:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[number] = data
+        return data
+
+    def raw(self, code):
+        """Encoded report `code', straight from its segment"""
+        return self.read(self.offsets[code])
+
+    def read(self, location):
+        """Encoded report at `location', which needn't still be live"""
+        number, offset, length = location
+        return self.mapping(number, offset + length)[offset:offset + length]
+
+    def __getitem__(self, code):
+        return json.loads(self.raw(code))
+
+    def __contains__(self, code):
+        return code in self.offsets
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def close(self):
+        """Let go of all files"""
+        for each in self.maps.values():
+            each.close()
+        self.maps = {}
+
+
+class SegmentStore(SegmentReader, MutableMapping):
+    """Reports stored in append-only segment files in directory `path'
+
+    Works like a dict of report code -> report, but only the location of
+    each report is kept in memory. Reports are decoded from a memory map of
+    their segment every time they are looked up. Writes go to the newest
+    segment until it grows past `segment_size' bytes; call `sync' to make
+    sure they are on disk.
+
+    Given the `state()' of an earlier open, only what was appended since
+    has to be scanned. Every change found that way is listed in `replayed'
+    as (code, old location, new location), either of which may be None,
+    so anything kept up to date alongside the store can catch up too."""
+    def __init__(self, path, segment_size=64 * 1024 * 1024, first_segment=1, state=None):
+        super().__init__(path)
+        self.segment_size = segment_size
+        self.live_bytes = 0
+        self.dead_bytes = 0
+        self.replayed = []
+        settle_compaction(path)
+        os.makedirs(path, exist_ok=True)
+        self.segments = list_segments(path)
+        scanned = self.resume(state)
+        for each in self.segments:
+            self.scan(each, scanned.get(each, 0))
+        if len(self.segments) == 0:
+            self.segments.append(first_segment)
+        self.open_active(self.segments[-1])
+
+    def open_active(self, number):
+        """Start appending to segment `number'"""
+        self.active = open(self.segment_path(number), "ab")
+        self.active_number = number
+        self.active_size = self.active.seek(0, os.SEEK_END)
+
+    def resume(self, state):
+        """Pick up the index from `state', if it still describes the start of
+        the segments on disk. Returns how far into each segment it goes."""
+        self.resumed = False
+        if state is None:
+            return {}
+        sizes = state["sizes"]
+        # anything written since may only add to the segments or add new ones
+        # after them. Otherwise they have been compacted, recovered or cut short.
+        if not sizes or sorted(sizes) != self.segments[:len(sizes)]:
+            return {}
+        for each in sizes:
+            if os.path.getsize(self.segment_path(each)) < sizes[each]:
+                return {}
+        self.offsets = state["offsets"]
+        self.live_bytes = state["live_bytes"]
+        self.dead_bytes = state["dead_bytes"]
+        self.resumed = True
+        return sizes
+
+    def state(self):
+        """Everything needed to open the store again without scanning what
+        has been written so far"""
+        sizes = {each: os.path.getsize(self.segment_path(each)) for each in self.segments}
+        sizes[self.active_number] = self.active_size
+        return {"sizes": sizes, "offsets": self.offsets, "live_bytes": self.live_bytes,
+                "dead_bytes": self.dead_bytes}
+
+    def scan(self, number, offset=0):
+        """Load the locations of everything in segment `number' from `offset'
+        on into the index"""
+        size = os.path.getsize(self.segment_path(number))
+        if size <= offset:
+            return
+        with open(self.segment_path(number), "rb") as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            while offset + HEADER.size <= size:
+                operation, code_length, body_length = HEADER.unpack_from(data, offset)
+                end = offset + HEADER.size + code_length + body_length
+                if ((operation not in (ADD, DEL)) or (end > size)):
+                    break
+                start = offset + HEADER.size
+                code = data[start:start + code_length].decode()
+                old = self.offsets.get(code)
+                self.forget(code)
+                if operation == ADD:
+                    self.offsets[code] = (number, start + code_length, body_length)
+                    self.live_bytes += body_length
+                if self.resumed:
+                    self.replayed.append((code, old, self.offsets.get(code)))
+                offset = end
+        finally:
+            data.close()
+        if offset < size:
+            # only a crash mid-append leaves this behind
+            eprint(f"Truncating incomplete record at the end of {segment_name(number)}")
+            os.truncate(self.segment_path(number), offset)
+
+    def forget(self, code):
+        """Drop `code' from the index, counting its space as dead"""
+        old = self.offsets.pop(code, None)
+        if old is not None:
+            self.live_bytes -= old[2]
+            self.dead_bytes += old[2]
+
+    def append(self, operation, code, body=b""):
+        """Write a record to the active segment. Returns where its body is."""
+        if self.active_size >= self.segment_size:
+            self.sync()
+            self.active.close()
+            self.segments.append(self.active_number + 1)
+            self.open_active(self.active_number + 1)
+        code = code.encode()
+        self.active.write(HEADER.pack(operation, len(code), len(body)) + code + body)
+        # reads go through mmap, so the OS has to have it
+        self.active.flush()
+        offset = self.active_size + HEADER.size + len(code)
+        self.active_size = offset + len(body)
+        return self.active_number, offset
+
+    def put_raw(self, code, body):
+        """Store an already encoded report"""
+        number, offset = self.append(ADD, code, body)
+        self.forget(code)
+        self.offsets[code] = (number, offset, len(body))
+        self.live_bytes += len(body)
+
+    def __setitem__(self, code, report):
+        self.put_raw(code, json.dumps(report).encode())
+
+    def __delitem__(self, code):
+        if code not in self.offsets:
+            raise KeyError(code)
+        self.append(DEL, code)
+        self.forget(code)
+
+    def sync(self):
+        """Make sure everything written so far is on disk"""
+        self.active.flush()
+        os.fsync(self.active.fileno())
+
+    def close(self):
+        """Let go of all files"""
+        super().close()
+        self.active.close()
+
+    def needs_compaction(self):
+        """Whether more than half the space on disk is overwritten or deleted
+        reports"""
+        return ((self.dead_bytes > self.live_bytes) and
+                (self.dead_bytes > self.segment_size))
+
+    def compact(self):
+        """Copy live reports into fresh segments and drop the old ones
+
+        Reports are copied as they are, without decoding them. New segments
+        are numbered after the old ones so backups never confuse the two.
+        They are built in `{path}.compacting', which is renamed to
+        `{path}.compacted' once complete, and then swapped in for the old
+        ones, so settle_compaction() can tell which way to go if we crash
+        part way through."""
+        staging = self.path + ".compacting"
+        if os.path.isdir(staging):
+            shutil.rmtree(staging)
+        os.makedirs(staging)
+        new = SegmentStore(staging, self.segment_size, self.active_number + 1)
+        for each in self.offsets:
+            new.put_raw(each, self.raw(each))
+        new.sync()
+        new.close()
+        self.close()
+        os.rename(staging, self.path + ".compacted")
+        os.rename(self.path, self.path + ".old")
+        os.rename(self.path + ".compacted", self.path)
+        shutil.rmtree(self.path + ".old")
+        self.__init__(self.path, self.segment_size)
+
+
+def settle_compaction(path):
+    """Clean up after a compaction of `path' that was cut short, so `path'
+    is a complete set of segments again, if there was one"""
+    if not os.path.isdir(path):
+        # stopped between moving the old segments aside and the new ones in
+        if os.path.isdir(f"{path}.compacted"):
+            eprint(f"Finishing an interrupted compaction of {path}")
+            os.rename(f"{path}.compacted", path)
+        elif os.path.isdir(f"{path}.old"):
+            eprint(f"Rolling back an interrupted compaction of {path}")
+            os.rename(f"{path}.old", path)
+    # whatever is left over is either half built or no longer needed
+    for each in (f"{path}.compacting", f"{path}.compacted", f"{path}.old"):
+        if os.path.isdir(each):
+            shutil.rmtree(each)
+
+
+def write_checkpoint(name, data):
+    """Pickle `data' to the file `name', replacing it in one go"""
+    with open(f"{name}.tmp", "wb") as file:
+        pickle.dump((CHECKPOINT_VERSION, data), file, pickle.HIGHEST_PROTOCOL)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(f"{name}.tmp", name)
+
+
+def read_checkpoint(name):
+    """The data last written with write_checkpoint() to `name', or None"""
+    try:
+        with open(name, "rb") as file:
+            version, data = pickle.load(file)
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError, TypeError):
+        return None
+    if version != CHECKPOINT_VERSION:
+        return None
+    return data
+
+
+def save_checkpoint(path, data):
+    """Keep `data' (which should include the store's `state()') in the
+    segment directory `path'. It goes when the segments are compacted or
+    recovered, so it can never be loaded against the wrong ones."""
+    write_checkpoint(os.path.join(path, CHECKPOINT), data)
+
+
+def load_checkpoint(path):
+    """The data last saved with save_checkpoint() in `path', or None"""
+    return read_checkpoint(os.path.join(path, CHECKPOINT))
+
+
+def settle_backup(path):
+    """Clean up after a backup of `path' that was cut short, so `{path}.bak'
+    is the last complete one"""
+    if os.path.isdir(f"{path}.bak.old"):
+        if os.path.isdir(f"{path}.bak"):
+            shutil.rmtree(f"{path}.bak.old")
+        else:
+            # stopped between moving the last backup aside and the new one in
+            os.rename(f"{path}.bak.old", f"{path}.bak")
+    if os.path.isdir(f"{path}.bak.staging"):
+        shutil.rmtree(f"{path}.bak.staging")
+
+
+def backup(path):
+    """Back up the segments in `path' to `{path}.bak'
+
+    The new backup is put together in `{path}.bak.staging' and only swapped
+    in once it's complete, so a crash leaves the last one as it was.
+    Segments are only ever appended to, and compaction never reuses their
+    numbers, so any the last backup already has all of are hard linked from
+    it rather than copied again."""
+    if not os.path.isdir(path):
+        raise FileNotFoundError(f"Cannot find recovery file: {path}")
+    settle_backup(path)
+    staging = f"{path}.bak.staging"
+    os.makedirs(staging)
+    for each in list_segments(path):
+        source = os.path.join(path, segment_name(each))
+        last = os.path.join(f"{path}.bak", segment_name(each))
+        target = os.path.join(staging, segment_name(each))
+        if os.path.isfile(last) and os.path.getsize(last) == os.path.getsize(source):
+            os.link(last, target)
+            continue
+        with open(source, "rb") as src, open(target, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+    if not os.path.isdir(f"{path}.bak"):
+        os.rename(staging, f"{path}.bak")
+        return
+    os.rename(f"{path}.bak", f"{path}.bak.old")
+    os.rename(staging, f"{path}.bak")
+    shutil.rmtree(f"{path}.bak.old")
+
+
+def recover(path):
+    """Replace the segments in `path' with the ones backed up"""
+    settle_backup(path)
+    if not os.path.isdir(f"{path}.bak"):
+        raise FileNotFoundError(f"Cannot find recovery file: {path}.bak")
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    shutil.copytree(f"{path}.bak", path)
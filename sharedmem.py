@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  sharedmem.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Hand big, already serialized replies from one process to another through
+shared memory, so only a small handle has to go through the pipes"""
+from __future__ import print_function
+import sys
+import os
+import itertools
+from multiprocessing import shared_memory, resource_tracker
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=sys.stderr, **kwargs)
+
+
+if sys.version_info[0] == 2:
+    eprint("Please run with Python 3 as Python 2 is End-of-Life.")
+    exit(2)
+
+
+# every block we make is named starting with this, so leftovers can be found
+PREFIX = "data-intake-"
+# where Linux keeps them
+SHM_DIR = "/dev/shm"
+
+COUNTER = itertools.count()
+
+
+def publish(text):
+    """Put `text' in a new block of shared memory, returning the handle to
+    send in its place. Whoever collects it frees it."""
+    data = text.encode()
+    block = shared_memory.SharedMemory(f"{PREFIX}{os.getpid()}-{next(COUNTER)}", True,
+                                       max(len(data), 1))
+    block.buf[:len(data)] = data
+    block.close()
+    # it belongs to the reader now, so our resource tracker mustn't clean it
+    # up when we exit
+    resource_tracker.unregister(block._name, "shared_memory")
+    return {"name": block.name, "size": len(data)}
+
+
+def collect(handle):
+    """Get the text `handle' points to, and free the block it was in"""
+    block = shared_memory.SharedMemory(handle["name"])
+    try:
+        return bytes(block.buf[:handle["size"]]).decode()
+    finally:
+        block.close()
+        block.unlink()
+
+
+def clean_up():
+    """Free blocks left over from processes that died before their replies
+    were collected"""
+    try:
+        names = os.listdir(SHM_DIR)
+    except OSError:
+        return
+    for each in names:
+        if each.startswith(PREFIX):
+            try:
+                os.remove(os.path.join(SHM_DIR, each))
+            except OSError:
+                pass
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  sqlstore.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Report storage in SQLite, in WAL mode, with the queryable fields indexed
+so content queries are answered by the database rather than from RAM"""
+from __future__ import print_function
+import sys
+import os
+import json
+import sqlite3
+from collections.abc import MutableMapping
+from index import QUERYABLE_FIELDS, index_key
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=sys.stderr, **kwargs)
+
+
+if sys.version_info[0] == 2:
+    eprint("Please run with Python 3 as Python 2 is End-of-Life.")
+    exit(2)
+
+
+SCHEMA = ("CREATE TABLE IF NOT EXISTS reports (code TEXT PRIMARY KEY, body TEXT NOT NULL)",
+          # one row per queryable field of every report, valued as index.index_key() has it
+          "CREATE TABLE IF NOT EXISTS fields (name TEXT NOT NULL, value NOT NULL, "
+          "code TEXT NOT NULL)",
+          # both cover every column, so lookups never have to visit the table
+          "CREATE INDEX IF NOT EXISTS fields_by_value ON fields (name, value, code)",
+          "CREATE INDEX IF NOT EXISTS fields_by_code ON fields (code, name, value)")
+# rows fetched at a time when walking every report
+FETCH_SIZE = 1000
+
+
+class SqliteStore(MutableMapping):
+    """Reports stored in the SQLite database `path'
+
+    Works like a dict of report code -> report. Writes are only made
+    durable by `sync'. The journal is a write ahead log, so a crash loses at
+    most what wasn't synced, and readers never block the writer."""
+    def __init__(self, path, fields=QUERYABLE_FIELDS):
+        self.path = path
+        self.fields = tuple(fields)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # fsync the log on every commit, as the other storage modes do
+        self.connection.execute("PRAGMA synchronous=FULL")
+        for each in SCHEMA:
+            self.connection.execute(each)
+        self.connection.commit()
+
+    def __getitem__(self, code):
+        row = self.connection.execute("SELECT body FROM reports WHERE code = ?",
+                                      (code,)).fetchone()
+        if row is None:
+            raise KeyError(code)
+        return json.loads(row[0])
+
+    def __setitem__(self, code, report):
+        self.connection.execute("DELETE FROM fields WHERE code = ?", (code,))
+        self.connection.execute("INSERT OR REPLACE INTO reports VALUES (?, ?)",
+                                (code, json.dumps(report)))
+        self.connection.executemany("INSERT INTO fields VALUES (?, ?, ?)",
+                                    [(each, index_key(report[each]), code)
+                                     for each in self.fields if each in report])
+
+    def __delitem__(self, code):
+        if code not in self:
+            raise KeyError(code)
+        self.connection.execute("DELETE FROM fields WHERE code = ?", (code,))
+        self.connection.execute("DELETE FROM reports WHERE code = ?", (code,))
+
+    def __contains__(self, code):
+        return self.connection.execute("SELECT 1 FROM reports WHERE code = ?",
+                                       (code,)).fetchone() is not None
+
+    def __iter__(self):
+        return iter([row[0] for row in self.connection.execute("SELECT code FROM reports")])
+
+    def __len__(self):
+        return self.connection.execute("SELECT count(*) FROM reports").fetchone()[0]
+
+    def rows(self, columns):
+        """Every row of `columns' in reports, without loading them all at once"""
+        cursor = self.connection.execute(f"SELECT {columns} FROM reports")
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if len(rows) == 0:
+                return
+            yield from rows
+
+    def values(self):
+        """Every report, decoded as we go"""
+        return (json.loads(body) for (body,) in self.rows("body"))
+
+    def items(self):
+        """Every (code, report), decoded as we go"""
+        return ((code, json.loads(body)) for code, body in self.rows("code, body"))
+
+    def matches(self, field, value):
+        """How many reports have `value' for `field'"""
+        return self.connection.execute("SELECT count(*) FROM fields WHERE name = ? AND value = ?",
+                                       (field, index_key(value))).fetchone()[0]
+
+    def search(self, terms):
+        """Return the codes of every report matching all of `terms'
+
+        Queryable fields are looked up in the fields index, starting from
+        the one with the fewest matches and joining the rest onto it, which
+        SQLite can't work out for itself. Anything else is checked against
+        the (already narrowed down) candidates directly, the same as
+        index.ReportIndex."""
+        indexed = [(field, value) for field, value in terms.items() if field in self.fields]
+        others = {field: value for field, value in terms.items() if field not in self.fields}
+        if len(indexed) > 0:
+            indexed.sort(key=lambda each: self.matches(*each))
+            query = "SELECT first.code FROM fields AS first"
+            parameters = []
+            for number, (field, value) in enumerate(indexed[1:]):
+                query += (f" JOIN fields AS f{number} ON f{number}.code = first.code"
+                          f" AND f{number}.name = ? AND f{number}.value = ?")
+                parameters.extend((field, index_key(value)))
+            query += " WHERE first.name = ? AND first.value = ?"
+            parameters.extend((indexed[0][0], index_key(indexed[0][1])))
+            codes = {row[0] for row in self.connection.execute(query, parameters)}
+        elif len(others) > 0:
+            codes = set(self)
+        else:
+            return set()
+        if len(others) > 0:
+            codes = {each for each in codes
+                     if all(self[each].get(field) == value for field, value in others.items())}
+        return codes
+
+    def sync(self):
+        """Make sure everything written so far is on disk"""
+        self.connection.commit()
+
+    def checkpoint(self):
+        """Fold the write ahead log back into the database file"""
+        self.connection.commit()
+        self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def backup(self, path):
+        """Copy the database to `path' with SQLite's online backup, which
+        doesn't have to stop writes to get a consistent copy"""
+        self.connection.commit()
+        target = sqlite3.connect(f"{path}.tmp")
+        try:
+            self.connection.backup(target)
+        finally:
+            target.close()
+        os.replace(f"{path}.tmp", path)
+
+    def recover(self, path):
+        """Replace everything with the copy in `path'"""
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"Cannot find recovery file: {path}")
+        self.connection.commit()
+        source = sqlite3.connect(path)
+        try:
+            source.backup(self.connection)
+        finally:
+            source.close()
+
+    def close(self):
+        """Let go of the database"""
+        self.connection.commit()
+        self.connection.close()
+
+
+class FieldIndex:
+    """Stands in for index.ReportIndex when reports are in a SqliteStore,
+    which keeps its own index of the same fields up to date"""
+    def add(self, report):
+        """Nothing to do: the store indexed it when it was written"""
+
+    def remove(self, report):
+        """Nothing to do: the store drops it when it is deleted"""
+
+    def rebuild(self, db):
+        """Nothing to do: the index is in the store"""
+
+    def search(self, terms, db):
+        """Return the codes of every report in `db' matching all of `terms'"""
+        return db.search(terms)
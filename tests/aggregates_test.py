@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  aggregates_test.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for aggregates.py, checked against counting every report"""
+import pytest
+from aggregates import Aggregates, DIMENSIONS
+
+
+@pytest.mark.parametrize("group_by", [(), ("OS",), ("GPU vendor", "MODE"),
+                                      ("system-installer Version",)])
+@pytest.mark.parametrize("filters", [None, {"MODE": "oem"}, {"OS": "Drauger OS 7.5.1"}])
+def test_aggregates(db, build, group_by, filters):
+    """Counts kept up to date match counting every report"""
+    aggregates = build(Aggregates())
+    counts = {}
+    for report in db.values():
+        if all(DIMENSIONS[name](report) == value for name, value in (filters or {}).items()):
+            key = tuple(DIMENSIONS[name](report) for name in group_by)
+            counts[key] = counts.get(key, 0) + 1
+    output = aggregates.query(group_by, filters)
+    assert output["total"] == sum(counts.values())
+    assert {tuple(each[name] for name in group_by): each["count"]
+            for each in output["groups"]} == counts
+    assert [each["count"] for each in output["groups"]] == sorted(counts.values(), reverse=True)
+
+
+def test_aggregates_unknown_dimension(build):
+    """Grouping by something we don't count is an error"""
+    with pytest.raises(ValueError):
+        build(Aggregates()).query(("nonsense",))
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  archive_test.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for retention and the archive in archive.py"""
+import os
+import pytest
+import archive
+from index import ReportIndex
+from aggregates import Aggregates
+
+
+def code(report):
+    """Code of `report'"""
+    return report['Installation Report Code']
+
+
+@pytest.mark.parametrize("older, newer", [("2.4.0", "2.5.0"), ("2.5.0", "2.5.1"),
+                                          ("2.9", "2.10"), ("v2.5", "2.5.1")])
+def test_version_key(older, newer):
+    """Versions sort the way versions do, not the way strings do"""
+    assert archive.version_key(older) < archive.version_key(newer)
+
+
+def test_version_key_nonsense():
+    """Things that aren't versions don't get a key"""
+    assert archive.version_key("unknown") is None
+    assert archive.version_key(None) is None
+
+
+def test_arrivals(tmp_path):
+    """When reports arrived, and that some have left, is still known after
+    opening the log again, even with a line cut short at the end"""
+    path = str(tmp_path / "arrivals")
+    arrivals = archive.Arrivals(path)
+    arrivals.stamp(["a", "b"], 100.0)
+    arrivals.stamp(["c"], 200.0)
+    # already known, so it keeps its first arrival time
+    arrivals.stamp(["a"], 300.0)
+    arrivals.drop(["b"])
+    arrivals.close()
+    with open(path, "a") as file:
+        file.write("d")
+    again = archive.Arrivals(path)
+    assert again.times == {"a": 100.0, "c": 200.0}
+    assert again.oldest() == ["a", "c"]
+    assert again.older_than(150.0) == ["a"]
+    again.close()
+
+
+def test_arrivals_rewritten(tmp_path):
+    """Once the log is mostly out of date, it is written out again"""
+    path = str(tmp_path / "arrivals")
+    arrivals = archive.Arrivals(path)
+    for each in range(600):
+        arrivals.stamp([f"{each}"], float(each))
+        arrivals.drop([f"{each}"])
+    arrivals.stamp(["kept"], 1.0)
+    arrivals.close()
+    with open(path) as file:
+        assert len(file.readlines()) < 1000
+    again = archive.Arrivals(path)
+    assert again.times == {"kept": 1.0}
+    again.close()
+
+
+def test_archive(tmp_path, reports):
+    """Archived reports can be looked up and discarded, and are still there
+    after opening the archive again, with or without a checkpoint"""
+    path = str(tmp_path / "archive")
+    store = archive.Archive(path)
+    added = reports(5)
+    store.put(added)
+    assert store.get(code(added[0])) == added[0]
+    assert store.get("not there") is None
+    assert store.discard(code(added[0]))
+    assert not store.discard(code(added[0]))
+    store.checkpoint()
+    store.put(reports(1, start=5))
+    store.close()
+    again = archive.Archive(path)
+    assert again.resumed
+    assert len(again) == 5
+    assert code(added[0]) not in again
+    assert again.get(code(added[1])) == added[1]
+    again.close()
+    os.remove(os.path.join(path, "checkpoint"))
+    scanned = archive.Archive(path)
+    assert not scanned.resumed
+    assert len(scanned) == 5
+    scanned.close()
+
+
+@pytest.fixture
+def fleet(tmp_path, reports):
+    """20 reports, arriving a second apart, and what the DB keeps over them"""
+    db = {code(each): each for each in reports(20)}
+    arrivals = archive.Arrivals(str(tmp_path / "arrivals"))
+    for number, each in enumerate(db):
+        arrivals.stamp([each], 1000.0 + number)
+    index = ReportIndex()
+    aggregates = Aggregates()
+    index.rebuild(db)
+    aggregates.rebuild(db)
+    yield db, arrivals, index, aggregates
+    arrivals.close()
+
+
+def test_retention_off(fleet):
+    """With nothing set, nothing is cold"""
+    retention = archive.Retention()
+    assert not retention.enabled()
+    assert retention.cold(*fleet, now=10 ** 9) == set()
+
+
+def test_retention_age(fleet):
+    """Reports that arrived too long ago are cold"""
+    db = fleet[0]
+    cold = archive.Retention(max_age=15).cold(*fleet, now=1020.0)
+    assert cold == set(list(db)[:5])
+
+
+def test_retention_version(fleet):
+    """Reports from installers older than `min_version' are cold"""
+    db = fleet[0]
+    cold = archive.Retention(min_version="2.5.0").cold(*fleet, now=1020.0)
+    assert cold == {each for each, report in db.items()
+                    if report["system-installer Version"] == "2.4.0"}
+
+
+def test_retention_count(fleet):
+    """Past the newest `max_reports', the oldest are cold, counting what is
+    going anyway"""
+    db = fleet[0]
+    assert archive.Retention(max_reports=15).cold(*fleet) == set(list(db)[:5])
+    cold = archive.Retention(min_version="2.5.0", max_reports=10).cold(*fleet)
+    assert len(cold) == 10
+    assert {each for each, report in db.items()
+            if report["system-installer Version"] == "2.4.0"} <= cold
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  backup_test.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for backing up and recovering the database"""
+import os
+import db
+import segments
+from report import plain
+
+
+def code(report):
+    """Code of `report'"""
+    return report['Installation Report Code']
+
+
+def contents(reports):
+    """`reports' (a dict-like of code -> report) as plain dicts"""
+    return {each: dict(plain(reports[each])) for each in reports.keys()}
+
+
+def test_incremental_backups_restore(tmp_path, reports):
+    """A full backup with incremental ones on top restores what was there
+    at the last of them"""
+    name = str(tmp_path / "reports.json")
+    storage = db.JsonStorage(name)
+    data = storage.open()
+    added = reports(10)
+    for each in added[:6]:
+        data[code(each)] = each
+    assert storage.backup(None) == "full"
+    for each in added[6:]:
+        data[code(each)] = each
+    assert storage.backup({code(each) for each in added[6:]}) == "incremental"
+    del data[code(added[0])]
+    data[code(added[1])] = dict(added[1], MODE="changed")
+    assert storage.backup({code(added[0]), code(added[1])}) == "incremental"
+    assert len(db.incremental_backups(name)) == 2
+    assert db.restore(name) == contents(data)
+
+
+def test_full_backup_every(tmp_path, reports):
+    """Incremental backups stop piling up after FULL_BACKUP_EVERY of them"""
+    name = str(tmp_path / "reports.json")
+    storage = db.JsonStorage(name)
+    data = storage.open()
+    storage.backup(None)
+    kinds = []
+    for each in reports(db.FULL_BACKUP_EVERY + 1):
+        data[code(each)] = each
+        kinds.append(storage.backup({code(each)}))
+    assert kinds == ["incremental"] * db.FULL_BACKUP_EVERY + ["full"]
+    assert db.incremental_backups(name) == []
+    assert db.restore(name) == contents(data)
+
+
+def test_stale_incrementals_are_ignored(tmp_path, reports):
+    """Incremental backups a crash left behind after a full backup don't
+    bring deleted reports back"""
+    name = str(tmp_path / "reports.json")
+    storage = db.JsonStorage(name)
+    data = storage.open()
+    added = reports(3)
+    storage.backup(None)
+    for each in added:
+        data[code(each)] = each
+    storage.backup({code(each) for each in added})
+    left = {}
+    for each in db.incremental_backups(name):
+        with open(each, "r") as file:
+            left[each] = file.read()
+    del data[code(added[0])]
+    storage.backup(None)
+    # as if we crashed before they were removed
+    for each, text in left.items():
+        with open(each, "w") as file:
+            file.write(text)
+    assert db.restore(name) == contents(data)
+    # and ones made since still count
+    extra = reports(1, start=3)[0]
+    data[code(extra)] = extra
+    storage.backup({code(extra)})
+    assert db.restore(name) == contents(data)
+
+
+def test_old_style_backups_restore(tmp_path):
+    """Full backups from before they had generations still restore, along
+    with their incremental backups"""
+    name = str(tmp_path / "reports.json")
+    db.atomic_dump({"a": {"x": 1}, "b": {"x": 2}}, f"{name}.bak")
+    os.makedirs(f"{name}.bak.d")
+    db.atomic_dump({"ADD": {"c": {"x": 3}}, "DEL": ["a"]},
+                   os.path.join(f"{name}.bak.d", "inc-000001.json"))
+    assert db.restore(name) == {"b": {"x": 2}, "c": {"x": 3}}
+
+
+def test_journal_recover(tmp_path, reports):
+    """RECOVER puts the database back as it was at the last backup, with
+    nothing journaled since replayed on top"""
+    name = str(tmp_path / "reports.json")
+    storage = db.JournalStorage(name)
+    data = storage.open()
+    added = reports(6)
+    for each in added[:4]:
+        data[code(each)] = each
+        storage.persist([{"ADD": each}])
+    storage.backup(None)
+    expected = contents(data)
+    for each in added[4:]:
+        data[code(each)] = each
+        storage.persist([{"ADD": each}])
+    storage.recover()
+    assert contents(storage.reload()) == expected
+
+
+def test_segments_backup_and_recover(tmp_path, reports):
+    """Recovering segments gets back what was there at the last backup"""
+    name = str(tmp_path / "reports.json")
+    storage = db.SegmentStorage(name)
+    data = storage.open()
+    added = reports(10)
+    for each in added[:6]:
+        data[code(each)] = each
+    storage.backup()
+    for each in added[6:]:
+        data[code(each)] = each
+    storage.backup()
+    expected = contents(data)
+    del data[code(added[0])]
+    data = storage.recover()
+    assert contents(data) == expected
+    data.close()
+
+
+def test_segments_backup_links_what_it_has(tmp_path, reports):
+    """Segments already backed up in full aren't copied again"""
+    path = str(tmp_path / "store")
+    store = segments.SegmentStore(path, segment_size=2000)
+    for each in reports(20):
+        store[code(each)] = each
+    store.sync()
+    segments.backup(path)
+    backed_up = {each: os.stat(os.path.join(f"{path}.bak", each))
+                 for each in os.listdir(f"{path}.bak")}
+    for each in reports(5, start=20):
+        store[code(each)] = each
+    store.sync()
+    segments.backup(path)
+    linked = 0
+    for each in os.listdir(f"{path}.bak"):
+        unchanged = (each in backed_up and
+                     os.path.getsize(os.path.join(path, each)) == backed_up[each].st_size)
+        same = os.stat(os.path.join(f"{path}.bak", each)).st_ino == getattr(
+            backed_up.get(each), "st_ino", None)
+        assert same == unchanged
+        linked += same
+    assert 0 < linked < len(os.listdir(f"{path}.bak"))
+    store.close()
+
+
+def test_interrupted_segments_backup(tmp_path, reports):
+    """A backup cut short leaves the last complete one to recover from"""
+    path = str(tmp_path / "store")
+    store = segments.SegmentStore(path)
+    added = reports(5)
+    for each in added:
+        store[code(each)] = each
+    store.sync()
+    segments.backup(path)
+    # crashed part way through swapping the next one in
+    os.rename(f"{path}.bak", f"{path}.bak.old")
+    os.makedirs(f"{path}.bak.staging")
+    store.close()
+    segments.recover(path)
+    assert not os.path.isdir(f"{path}.bak.old")
+    assert not os.path.isdir(f"{path}.bak.staging")
+    store = segments.SegmentStore(path)
+    assert contents(store) == {code(each): each for each in added}
+    store.close()
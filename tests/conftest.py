@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  conftest.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Shared fixtures for the tests in this directory"""
+import os
+import sys
+import pytest
+
+# the modules under test live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+OS_RELEASES = ("Drauger OS 7.5.1", "Drauger OS 7.6")
+VERSIONS = ("2.4.0", "2.5.0", "2.5.1")
+GPUS = ("VGA compatible controller: Intel Corporation UHD Graphics 620",
+        "VGA compatible controller: NVIDIA Corporation GP106 [GeForce GTX 1060]",
+        "VGA compatible controller: Advanced Micro Devices, Inc. [AMD/ATI] Ellesmere")
+
+
+def make_report(number, version=None):
+    """Installation report number `number', made up but varied enough to
+    tell apart in indexes, aggregates and searches"""
+    log = "Partitioning drive /dev/sda\nInstalling packages\n"
+    if number % 4 == 0:
+        log += "Error: failed to set time zone\n"
+    log += "partitioning done\n" * (number % 3)
+    return {"Installation Report Code": f"{number:024x}",
+            "OS": OS_RELEASES[number % 2],
+            "system-installer Version": version or VERSIONS[number % 3],
+            "PCIe / GPU INFO": GPUS[number % 5 % 3],
+            "MODE": ("oem", "normal")[number // 2 % 2],
+            "INSTALLATION LOG": log,
+            "CUSTOM MESSAGE": "Thanks for the installer" if number % 5 == 0 else ""}
+
+
+@pytest.fixture
+def reports():
+    """Make `count' reports, numbered from `start'"""
+    def make(count, start=0, version=None):
+        return [make_report(each, version) for each in range(start, start + count)]
+    return make
+
+
+@pytest.fixture
+def db(reports):
+    """Some reports, some of which were replaced or deleted along the way"""
+    output = {each['Installation Report Code']: each for each in reports(60)}
+    for each in reports(10, start=50, version="9.9.9"):
+        output[each['Installation Report Code']] = each
+    for each in reports(5, start=20):
+        del output[each['Installation Report Code']]
+    return output
+
+
+@pytest.fixture
+def build(db, reports):
+    """Bring a view up to date with `db' the way the DB does it: a report at
+    a time, replacing and deleting as it goes"""
+    def make(view):
+        seen = {}
+        for each in reports(60):
+            view.add(each)
+            seen[each['Installation Report Code']] = each
+        for each in reports(10, start=50, version="9.9.9"):
+            view.remove(seen[each['Installation Report Code']])
+            view.add(each)
+            seen[each['Installation Report Code']] = each
+        for each in reports(5, start=20):
+            view.remove(seen.pop(each['Installation Report Code']))
+        assert seen == db
+        return view
+    return make
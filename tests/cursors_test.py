@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  cursors_test.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for cursors.py"""
+import pytest
+import cursors
+
+
+def page_through(table, cursor_id, db):
+    """Every page of `cursor_id', until the last"""
+    output = []
+    done = False
+    while not done:
+        page, done = table.fetch(cursor_id, db)
+        output.append(page)
+    return output
+
+
+def test_pages():
+    """Results come a page at a time, and the cursor closes after the last"""
+    db = {each: f"report {each}" for each in range(7)}
+    table = cursors.CursorTable(page_size=3)
+    cursor_id = table.open(sorted(db))
+    assert page_through(table, cursor_id, db) == [
+        ["report 0", "report 1", "report 2"], ["report 3", "report 4", "report 5"],
+        ["report 6"]]
+    with pytest.raises(KeyError):
+        table.fetch(cursor_id, db)
+
+
+@pytest.mark.parametrize("asked, used", [(None, 3), (0, 3), (2, 2), (50, 3)])
+def test_page_size(asked, used):
+    """A cursor can ask for smaller pages, but not bigger ones"""
+    table = cursors.CursorTable(page_size=3)
+    cursor_id = table.open(range(10), asked)
+    page, done = table.fetch(cursor_id, {each: each for each in range(10)})
+    assert len(page) == used
+
+
+def test_deleted_skipped():
+    """Reports deleted after the cursor was opened are left out, without
+    making pages short"""
+    db = {each: each for each in range(6)}
+    table = cursors.CursorTable(page_size=2)
+    cursor_id = table.open(sorted(db))
+    del db[1]
+    del db[2]
+    assert page_through(table, cursor_id, db) == [[0, 3], [4, 5]]
+
+
+def test_close():
+    """Closing a cursor lets go of it"""
+    table = cursors.CursorTable()
+    cursor_id = table.open(range(10))
+    assert table.close(cursor_id)
+    assert not table.close(cursor_id)
+    with pytest.raises(KeyError):
+        table.fetch(cursor_id, {})
+
+
+def test_limit():
+    """Once `limit' cursors are open, the least recently used one goes"""
+    db = {each: each for each in range(10)}
+    table = cursors.CursorTable(page_size=1, limit=2)
+    first = table.open(range(10))
+    second = table.open(range(10))
+    table.fetch(first, db)
+    third = table.open(range(10))
+    assert set(table.cursors) == {first, third}
+    assert second not in table.cursors
+
+
+def test_timeout(monkeypatch):
+    """Cursors nobody has used in `timeout' seconds are closed"""
+    now = [1000.0]
+    monkeypatch.setattr(cursors.time, "monotonic", lambda: now[0])
+    table = cursors.CursorTable(timeout=60)
+    old = table.open(range(10))
+    now[0] += 61
+    new = table.open(range(10))
+    assert set(table.cursors) == {new}
+    assert old != new
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  db_test.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for the DB process in db.py, talked to over its pipe the way the
+router does"""
+import json
+import time
+import itertools
+import threading
+from multiprocessing import Pipe
+import pytest
+import db
+import replica
+from report import plain
+from sharedmem import collect
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """Start the DB on a database of its own. Returns start(**kwargs), which
+    starts db.main() with `kwargs' and returns our end of its pipe once the
+    DB is READY."""
+    # signal handlers can only be set up on the main thread
+    monkeypatch.setattr(db.profiling, "setup", lambda *args, **kwargs: None)
+    pipes = []
+
+    def start(**kwargs):
+        ours, theirs = Pipe()
+        pipes.append(ours)
+
+        def run():
+            try:
+                db.main(theirs, 0.01, str(tmp_path / "reports.json"), **kwargs)
+            except (EOFError, OSError):
+                # we hung up on it
+                pass
+
+        threading.Thread(target=run, daemon=True).start()
+        assert ours.poll(10)
+        assert ours.recv() == {"STATUS": "READY"}
+        return ours
+
+    yield start
+    for each in pipes:
+        each.close()
+
+
+IDS = itertools.count()
+
+
+def ask(pipe, command, timeout=10):
+    """Send `command' and return the DB's reply to it, passing over anything
+    else it sends in the meantime"""
+    command = dict(command, ID=next(IDS))
+    pipe.send(command)
+    while True:
+        assert pipe.poll(timeout), f"no reply to {command}"
+        data = pipe.recv()
+        if data.get("ID") == command["ID"]:
+            del data["ID"]
+            return data
+
+
+def code(report):
+    """Code of `report'"""
+    return report['Installation Report Code']
+
+
+def test_add_batch(database, monkeypatch, reports):
+    """Every report in a batch gets its own result, and the whole batch goes
+    to disk at once"""
+    persisted = []
+    persist = db.JournalStorage.persist
+
+    def counted(self, records):
+        persisted.append(len(records))
+        persist(self, records)
+
+    monkeypatch.setattr(db.JournalStorage, "persist", counted)
+    pipe = database()
+    added = reports(3)
+    batch = [added[0], "not a report", {"OS": "Drauger OS 7.6"}] + added[1:]
+    assert ask(pipe, {"ADD_BATCH": batch}) == {
+        "DONE": True, "RESULTS": [True, "Report is not a JSON object",
+                                  "Report has no Installation Report Code", True, True]}
+    assert persisted == [3]
+    for each in added:
+        assert ask(pipe, {"RECV": {"code": code(each)}}) == {"DATA": each}
+    assert ask(pipe, {"RECV": {"all": True}}) == {"DATA": {code(each): each for each in added}}
+
+
+def test_ids(database, reports):
+    """Replies carry the ID of the command they answer, so several can be in
+    flight at once, and commands without one get replies without one"""
+    pipe = database()
+    added = reports(3)
+    pipe.send({"ADD_BATCH": added})
+    for number, each in enumerate(added):
+        pipe.send({"RECV": {"code": code(each)}, "ID": f"recv-{number}"})
+    pipe.send({"NONSENSE": True, "ID": "bad"})
+    replies = {}
+    untagged = []
+    while len(replies) < 4:
+        assert pipe.poll(10)
+        data = pipe.recv()
+        if "ID" in data:
+            replies[data.pop("ID")] = data
+        elif "CHANGED" not in data and "METRICS" not in data:
+            untagged.append(data)
+    assert untagged == [{"DONE": True, "RESULTS": [True] * 3}]
+    for number, each in enumerate(added):
+        assert replies[f"recv-{number}"] == {"DATA": each}
+    assert replies["bad"] == {"ERROR": "Command not understood"}
+
+
+def test_cursor(database, reports):
+    """Large results can be paged through with CURSOR commands"""
+    pipe = database(page_size=4)
+    added = reports(10)
+    ask(pipe, {"ADD_BATCH": added})
+    wanted = sorted((each for each in added if each["OS"] == "Drauger OS 7.6"), key=code)
+    opened = ask(pipe, {"CURSOR": {"open": {"in_report": {"OS": "Drauger OS 7.6"}},
+                                   "page_size": 2}})["DATA"]
+    assert opened["total"] == len(wanted)
+    pages = []
+    while True:
+        page = ask(pipe, {"CURSOR": {"next": opened["cursor"]}})["DATA"]
+        pages.append(page["reports"])
+        if page["done"]:
+            break
+    assert [len(each) for each in pages] == [2, 2, 1]
+    assert sum(pages, []) == wanted
+    assert ask(pipe, {"CURSOR": {"next": opened["cursor"]}}) == {
+        "DATA": f"ERROR: cursor {opened['cursor']} is not open"}
+
+
+def test_aggregate(database, reports):
+    """AGGREGATE counts are kept up to date through ADDs and DELs"""
+    pipe = database()
+    added = reports(10)
+    ask(pipe, {"ADD_BATCH": added})
+    ask(pipe, {"DEL": code(added[0])})
+    output = ask(pipe, {"AGGREGATE": {"group_by": ["OS"]}})["DATA"]
+    assert output["total"] == 9
+    assert {each["OS"]: each["count"] for each in output["groups"]} == {
+        "Drauger OS 7.5.1": 4, "Drauger OS 7.6": 5}
+    assert ask(pipe, {"AGGREGATE": {"group_by": ["nonsense"]}})["DATA"].startswith("ERROR")
+
+
+def test_search(database, reports):
+    """SEARCH finds reports by their logs, best match first"""
+    pipe = database()
+    added = reports(12)
+    ask(pipe, {"ADD_BATCH": added})
+    output = ask(pipe, {"SEARCH": {"query": "time zone", "mode": "phrase"}})["DATA"]
+    assert output["total"] == 3
+    assert sorted(code(each["report"]) for each in output["results"]) == \
+        [code(added[each]) for each in (0, 4, 8)]
+    assert ask(pipe, {"SEARCH": {"query": "x", "mode": "nonsense"}})["DATA"].startswith("ERROR")
+
+
+def test_shared_memory(database, reports):
+    """Replies at least `shm_threshold' long go through shared memory, and
+    smaller ones already serialized"""
+    added = reports(20)
+    small = json.dumps({"DATA": added[0]})
+    pipe = database(shm_threshold=len(small) + 1)
+    ask(pipe, {"ADD_BATCH": added})
+    output = ask(pipe, {"RECV": {"code": code(added[0])}})
+    assert list(output) == ["REPLY"]
+    assert json.loads(output["REPLY"]) == {"DATA": added[0]}
+    output = ask(pipe, {"RECV": {"all": True}})
+    assert json.loads(collect(output["SHM"])) == {
+        "DATA": {code(each): each for each in added}}
+
+
+@pytest.mark.parametrize("storage", ["journal", "segments"])
+def test_replica_feed(database, reports, storage):
+    """A replica following the DB ends up with the same reports, whether it
+    gets copies of them or reads them from the DB's segments"""
+    feed_recv, feed_send = Pipe(duplex=False)
+    pipe = database(storage=storage, replica_feeds=[feed_send])
+    copy = replica.Replica()
+    threading.Thread(target=copy.follow, args=(feed_recv,), daemon=True).start()
+    added = reports(10)
+    ask(pipe, {"ADD_BATCH": added})
+    ask(pipe, {"DEL": code(added[0])})
+    ask(pipe, {"ADD_BATCH": [dict(added[1], MODE="changed")]})
+    expected = ask(pipe, {"RECV": {"all": True}})["DATA"]
+    deadline = time.monotonic() + 10
+    while True:
+        with copy.lock:
+            copy.catch_up()
+            got = {each: dict(plain(copy.db[each])) for each in copy.db.keys()}
+        if (copy.synced and got == expected) or time.monotonic() > deadline:
+            break
+        time.sleep(0.01)
+    assert copy.synced
+    assert got == expected
+
+
+def test_retention(database, reports):
+    """Cold reports move to the archive while the DB is idle, where they can
+    still be looked up by code, and deleted"""
+    pipe = database(retention_max_reports=5, retention_interval=0.05)
+    added = reports(10)
+    ask(pipe, {"ADD_BATCH": added[:5]})
+    ask(pipe, {"ADD_BATCH": added[5:]})
+    deadline = time.monotonic() + 10
+    while len(ask(pipe, {"RECV": {"all": True}})["DATA"]) > 5:
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    assert sorted(ask(pipe, {"RECV": {"all": True}})["DATA"]) == [code(each) for each in added[5:]]
+    assert ask(pipe, {"RECV": {"code": code(added[0])}}) == {"DATA": added[0]}
+    assert ask(pipe, {"DEL": code(added[0])}) == {"DONE": True}
+    assert ask(pipe, {"RECV": {"code": code(added[0])}}) == {"DATA": None}
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  filter_test.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for filter.py, with stand-ins for clamd and GPG"""
+import os
+import json
+import threading
+from multiprocessing import Pipe
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import filter
+
+# what the stand-in for clamd takes to be a virus
+VIRUS = b"X5O!P%@AP[4\\PZX54(P^)7CC)7}$EICAR"
+
+
+class Scanner:
+    """Stands in for clamd. Anything with `VIRUS' in it is a virus. With a
+    `barrier', every scan waits for that many to be going at once."""
+    def __init__(self, barrier=None):
+        self.barrier = barrier
+        self.scanned = []
+        self.lock = threading.Lock()
+
+    def scan_stream(self, data):
+        with self.lock:
+            self.scanned.append(data)
+        if self.barrier is not None:
+            self.barrier.wait()
+        if VIRUS in data:
+            return {"stream": ("FOUND", "Eicar-Test-Signature")}
+        return None
+
+    def version(self):
+        return "ClamAV 1.0.0/27000/Mon Jan  1 00:00:00 2024"
+
+
+class Decrypted:
+    """What GPG.decrypt() gives back"""
+    def __init__(self, ok, data=b"", status=""):
+        self.ok = ok
+        self.data = data
+        self.status = status
+
+
+class GPG:
+    """Stands in for gnupg.GPG. "Encrypted" data is b"ENC:" and then the
+    plain text, and only decrypts with the right passphrase."""
+    def decrypt(self, data, passphrase=None):
+        if data.startswith(b"ENC:") and passphrase == "pin":
+            return Decrypted(True, data[len(b"ENC:"):])
+        return Decrypted(False, status="decryption failed")
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    """inbound, checked and suspicious directories"""
+    output = [str(tmp_path / each) for each in ("inbound", "checked", "sus")]
+    os.mkdir(output[0])
+    return output
+
+
+@pytest.fixture
+def scanner(monkeypatch):
+    """The stand-in clamd every worker gets"""
+    output = Scanner()
+    monkeypatch.setattr(filter, "clamd", lambda clamd_socket: output)
+    return output
+
+
+def upload(inbound, report, name=None, raw=None):
+    """Leave `report' (or `raw' bytes) in `inbound', encrypted, the way
+    system-installer uploads it. Returns its file name."""
+    if name is None:
+        name = f"installation_report-{report['Installation Report Code']}.dosir"
+    if raw is None:
+        raw = b"ENC:" + json.dumps(report).encode()
+    with open(os.path.join(inbound, name), "wb") as file:
+        file.write(raw)
+    return name
+
+
+def run(dirs, names, workers=4, **kwargs):
+    """Filter `names', returning what happened to each"""
+    inbound, checked, sus = dirs
+    with ThreadPoolExecutor(workers) as pool:
+        return filter.filter_reports(names, inbound, checked, sus, GPG(), "pin", "",
+                                     pool, **kwargs)
+
+
+def test_outcomes(dirs, scanner, monkeypatch, reports):
+    """Each kind of upload ends up where it should"""
+    inbound, checked, sus = dirs
+    monkeypatch.setattr(filter, "MAX_SIZE", 10000)
+    good = reports(1)[0]
+    names = {
+        "good": upload(inbound, good),
+        "virus": upload(inbound, None, "installation_report-virus.dosir", VIRUS),
+        "misnamed": upload(inbound, good, "report.json"),
+        "undecryptable": upload(inbound, None, "installation_report-gpg.dosir", b"garbage"),
+        "invalid": upload(inbound, None, "installation_report-json.dosir", b"ENC:{not json"),
+        "huge": upload(inbound, None, "installation_report-huge.dosir", b"ENC:" + b" " * 10001),
+        "hidden": upload(inbound, good, ".installation_report-uploading.dosir"),
+        "gone": "installation_report-gone.dosir"}
+    outcomes = run(dirs, list(names.values()))
+    assert {kind: outcomes[name] for kind, name in names.items()} == {
+        "good": filter.ACCEPTED, "virus": filter.DELETED, "misnamed": filter.SUSPICIOUS,
+        "undecryptable": filter.SUSPICIOUS, "invalid": filter.SUSPICIOUS,
+        "huge": filter.DELETED, "hidden": None, "gone": None}
+    assert os.listdir(inbound) == [names["hidden"]]
+    assert os.listdir(checked) == [names["good"]]
+    with open(os.path.join(checked, names["good"])) as file:
+        assert json.load(file) == good
+    assert sorted(os.listdir(sus)) == sorted(names[each] for each in ("misnamed",
+                                                                       "undecryptable",
+                                                                       "invalid"))
+    # too big to be a report, so it was never read, let alone scanned
+    assert len(scanner.scanned) == 5
+
+
+def test_concurrent(dirs, monkeypatch, reports):
+    """Up to `workers' reports are scanned at the same time"""
+    inbound = dirs[0]
+    scanner = Scanner(threading.Barrier(4, timeout=5))
+    monkeypatch.setattr(filter, "clamd", lambda clamd_socket: scanner)
+    names = [upload(inbound, each) for each in reports(8)]
+    outcomes = run(dirs, names, workers=4)
+    assert set(outcomes.values()) == {filter.ACCEPTED}
+    assert sorted(os.listdir(dirs[1])) == sorted(names)
+
+
+def test_error_kept(dirs, monkeypatch, reports):
+    """A report that couldn't be filtered is left where it is, to be tried
+    again"""
+    inbound = dirs[0]
+
+    class Down:
+        def scan_stream(self, data):
+            raise ConnectionError("clamd is down")
+
+    monkeypatch.setattr(filter, "clamd", lambda clamd_socket: Down())
+    name = upload(inbound, reports(1)[0])
+    assert run(dirs, [name]) == {name: filter.ERROR}
+    assert os.listdir(inbound) == [name]
+
+
+def test_streamed(dirs, scanner, reports):
+    """Accepted reports are sent to intake parsed, and still written out in
+    case intake goes away before the DB has them"""
+    inbound, checked, sus = dirs
+    stream_recv, stream_send = Pipe(duplex=False)
+    added = reports(5)
+    names = [upload(inbound, each) for each in added]
+    upload(inbound, None, "installation_report-virus.dosir", VIRUS)
+    run(dirs, names + ["installation_report-virus.dosir"], stream=stream_send)
+    streamed = []
+    while stream_recv.poll(0.1):
+        streamed.append(stream_recv.recv())
+    assert sorted(streamed, key=lambda each: each[0]) == sorted(zip(names, added))
+    assert sorted(os.listdir(checked)) == sorted(names)
+    assert os.listdir(inbound) == []
+
+
+def test_stream_gone(dirs, scanner, reports):
+    """If intake has gone away, reports are still accepted, and left for it
+    to pick up from their files"""
+    inbound, checked, sus = dirs
+    stream_recv, stream_send = Pipe(duplex=False)
+    stream_recv.close()
+    names = [upload(inbound, each) for each in reports(3)]
+    assert set(run(dirs, names, stream=stream_send).values()) == {filter.ACCEPTED}
+    assert sorted(os.listdir(checked)) == sorted(names)
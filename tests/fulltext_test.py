@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  fulltext_test.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for fulltext.py, checked against going through every report"""
+import re
+import pytest
+from fulltext import FullTextIndex, TEXT_FIELDS, text_of
+
+
+def matches(report, query, mode):
+    """How many times `report' has `query' in it, the slow way, or 0 if it
+    doesn't match"""
+    texts = [text_of(report.get(each)) for each in TEXT_FIELDS]
+    query = query.lower()
+    if mode == "substring":
+        return sum(each.count(query) for each in texts)
+    words = re.findall(r"\w+", query)
+    if mode == "phrase":
+        pattern = r"(?<!\w)" + r"\W+".join(re.escape(each) for each in words) + r"(?!\w)"
+        return sum(len(re.findall(pattern, each)) for each in texts)
+    counts = [sum(len(re.findall(r"(?<!\w)" + re.escape(word) + r"(?!\w)", each))
+                  for each in texts) for word in words]
+    return min(counts)
+
+
+@pytest.mark.parametrize("query, mode", [("partitioning", "terms"),
+                                         ("error zone", "terms"),
+                                         ("partitioning drive", "phrase"),
+                                         ("failed to set time zone", "phrase"),
+                                         ("zone error", "phrase"),
+                                         ("installer", "terms"),
+                                         ("artition", "substring"),
+                                         ("/dev/sda", "substring"),
+                                         ("nothing like it", "terms")])
+def test_full_text_search(db, build, query, mode):
+    """Search finds exactly the reports the text says it should"""
+    text_index = build(FullTextIndex())
+    expected = {each for each, report in db.items() if matches(report, query, mode) > 0}
+    total, found = text_index.search(query, mode, db, limit=len(db))
+    assert total == len(expected)
+    assert {each for score, each in found} == expected
+    scores = [score for score, each in found]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_full_text_ranking(db, build):
+    """Reports that use a word more come first"""
+    text_index = build(FullTextIndex())
+    total, found = text_index.search("done", "terms", db, limit=5)
+    best = max(matches(each, "done", "terms") for each in db.values())
+    assert all(matches(db[each], "done", "terms") == best for score, each in found)
+
+
+def test_full_text_limit_and_fields(db, build):
+    """`limit' caps what is returned but not the total, and `fields' narrows
+    where we look"""
+    text_index = build(FullTextIndex())
+    total, found = text_index.search("partitioning", "terms", db, limit=3)
+    assert total == len(db)
+    assert len(found) == 3
+    total, found = text_index.search("thanks", "terms", db, fields=["CUSTOM MESSAGE"])
+    assert {each for score, each in found} == {
+        each for each, report in db.items() if "Thanks" in report["CUSTOM MESSAGE"]}
+    with pytest.raises(ValueError):
+        text_index.search("thanks", "terms", db, fields=["OS"])
+    with pytest.raises(ValueError):
+        text_index.search("thanks", "nonsense", db)
+
+
+def test_full_text_state(db, build):
+    """An index picked back up from its state searches the same, and one
+    rebuilt from scratch is the same as one kept up to date"""
+    kept = build(FullTextIndex())
+    restored = FullTextIndex()
+    restored.restore(kept.state())
+    assert restored.grams == kept.grams
+    rebuilt = FullTextIndex()
+    rebuilt.rebuild(db)
+    assert rebuilt.state() == kept.state()
+    for query, mode in (("partitioning drive", "phrase"), ("artition", "substring")):
+        assert restored.search(query, mode, db) == kept.search(query, mode, db)
+
+
+def test_full_text_old_state():
+    """State saved before word counts were kept has to be rebuilt"""
+    with pytest.raises(ValueError):
+        FullTextIndex().restore({"fields": TEXT_FIELDS, "postings": {}})
+
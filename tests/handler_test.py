@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  handler_test.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for request_handler.py that don't need a session bus"""
+import json
+import pytest
+
+# request_handler can't be imported without D-Bus and GLib
+pytest.importorskip("dbus")
+pytest.importorskip("gi")
+import request_handler
+
+
+def test_cache_lru():
+    """The least recently used entry is the one pushed out"""
+    cache = request_handler.ReportCache(2)
+    cache.put("a", "A")
+    cache.put("b", "B")
+    assert cache.get("a") == "A"
+    cache.put("c", "C")
+    assert cache.get("b") is None
+    assert cache.get("a") == "A"
+    assert cache.get("c") == "C"
+    assert cache.stats() == {"hits": 3, "misses": 1, "invalidations": 0,
+                             "entries": 2, "size": 2}
+
+
+def test_cache_invalidate():
+    """Changed reports are dropped, or everything if we don't know what
+    changed"""
+    cache = request_handler.ReportCache(10)
+    for each in "abcd":
+        cache.put(each, each.upper())
+    cache.invalidate(["a", "z"])
+    assert cache.get("a") is None
+    assert cache.get("b") == "B"
+    cache.invalidate(None)
+    assert cache.get("b") is None
+    assert cache.stats()["invalidations"] == 4
+    assert cache.stats()["entries"] == 0
+
+
+def test_cache_off():
+    """A size of 0 caches nothing"""
+    cache = request_handler.ReportCache(0)
+    cache.put("a", "A")
+    assert cache.get("a") is None
+
+
+@pytest.mark.parametrize("search, error", [
+    ('{"OS": "Drauger OS 7.6"}', None),
+    ("not json", "ERROR: Need JSON formatted string"),
+    ('["OS"]', "ERROR: Need a JSON object"),
+    ('{"nonsense": 1}', "ERROR: key nonsense not recognized.")])
+def test_parse_search(search, error):
+    """Bad search terms get an error reply that is JSON like any other"""
+    term, reply = request_handler.parse_search(search)
+    if error is None:
+        assert term == json.loads(search)
+        assert reply is None
+    else:
+        assert term is None
+        assert json.loads(reply) == {"DATA": error}
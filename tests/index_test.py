@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  index_test.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for index.py, checked against going through every report"""
+import pytest
+from index import ReportIndex
+
+
+@pytest.mark.parametrize("terms", [{"OS": "Drauger OS 7.6"},
+                                   {"OS": "Drauger OS 7.6", "MODE": "oem"},
+                                   {"system-installer Version": "9.9.9"},
+                                   {"system-installer Version": "2.4.0", "MODE": "normal"},
+                                   {"OS": "Drauger OS 7.6", "not indexed": None},
+                                   {"OS": "Drauger OS 1.0"}])
+def test_index_search(db, build, terms):
+    """The index finds exactly the reports with every one of `terms'"""
+    index = build(ReportIndex())
+    expected = {each for each, report in db.items()
+                if all(report.get(field) == value for field, value in terms.items())}
+    assert index.search(terms, db) == expected
+
+
+def test_index_rebuild(db, build):
+    """Rebuilding gives the same index as keeping it up to date"""
+    index = ReportIndex()
+    index.rebuild(db)
+    assert index.state() == build(ReportIndex()).state()
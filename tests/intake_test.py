@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  intake_test.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for intake: picking reports up from the filter, and handing them to
+the DB in batches"""
+import os
+import json
+import time
+import threading
+from multiprocessing import Pipe
+import pytest
+import intake_handler
+
+
+@pytest.fixture
+def intake(tmp_path, monkeypatch):
+    """Start intake on a directory of its own, with us standing in for the DB.
+    Returns start(**kwargs), which starts it with `kwargs' passed to
+    intake_handler.main() and returns our end of its pipe."""
+    # signal handlers can only be set up on the main thread
+    monkeypatch.setattr(intake_handler.profiling, "setup", lambda *args, **kwargs: None)
+    monkeypatch.setattr(intake_handler, "STREAM_WAIT", 0.3)
+    pipes = []
+
+    def start(**kwargs):
+        db, pipe = Pipe()
+        pipes.append(db)
+
+        def run():
+            try:
+                intake_handler.main(pipe, 0.05, str(tmp_path), batch_time=0.05, **kwargs)
+            except (EOFError, OSError):
+                # we hung up on it
+                pass
+
+        threading.Thread(target=run, daemon=True).start()
+        return db
+
+    yield start
+    for each in pipes:
+        each.close()
+
+
+@pytest.fixture
+def parses(monkeypatch):
+    """Every file json.load() is called on"""
+    output = []
+    load = json.load
+
+    def counted(file, *args, **kwargs):
+        output.append(os.path.basename(file.name))
+        return load(file, *args, **kwargs)
+
+    monkeypatch.setattr(json, "load", counted)
+    return output
+
+
+def write(directory, report, name=None):
+    """Leave `report' in `directory' the way the filter does. Returns its
+    file name."""
+    if name is None:
+        name = f"installation_report-{report['Installation Report Code']}.dosir"
+    with open(f"{directory}/.{name}", "w") as file:
+        json.dump(report, file)
+    os.replace(f"{directory}/.{name}", f"{directory}/{name}")
+    return name
+
+
+def receive(db, count, results=None, timeout=10, sizes=None):
+    """Answer ADD_BATCHes as the DB would until `count' reports have come in,
+    with `results' if given, or accepting them all. Returns the reports, and
+    appends how big each batch was to `sizes' if given."""
+    output = []
+    deadline = time.monotonic() + timeout
+    while len(output) < count:
+        assert db.poll(max(deadline - time.monotonic(), 0)), f"only got {len(output)} reports"
+        data = db.recv()
+        if "ADD_BATCH" not in data:
+            continue
+        output.extend(data["ADD_BATCH"])
+        if sizes is not None:
+            sizes.append(len(data["ADD_BATCH"]))
+        if results is None:
+            db.send({"DONE": True, "RESULTS": [True] * len(data["ADD_BATCH"])})
+        else:
+            db.send({"DONE": True, "RESULTS": results[:len(data["ADD_BATCH"])]})
+            results = results[len(data["ADD_BATCH"]):]
+    return output
+
+
+def code(report):
+    """Code of `report'"""
+    return report['Installation Report Code']
+
+
+def left(directory, count, timeout=5):
+    """Wait for intake to get `directory' down to `count' files, returning
+    what is left"""
+    deadline = time.monotonic() + timeout
+    while len(os.listdir(directory)) > count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return os.listdir(directory)
+
+
+def test_batches(tmp_path, intake, reports):
+    """Reports go to the DB a batch at a time, no bigger than `batch_size',
+    and their files go once it has them"""
+    added = reports(25)
+    for each in added:
+        write(tmp_path, each)
+    sizes = []
+    db = intake(use_inotify=False, batch_size=10)
+    assert sorted(receive(db, 25, sizes=sizes), key=code) == added
+    assert max(sizes) <= 10
+    assert len(sizes) < 25
+    assert left(tmp_path, 0) == []
+
+
+def test_send_batch(tmp_path):
+    """The DB's result for each report decides what happens to its file"""
+    db, pipe = Pipe()
+    names = ["accepted.dosir", "rejected.dosir", "retry.dosir"]
+    batch = []
+    for each in names:
+        report = {"Installation Report Code": each}
+        write(tmp_path, report, each)
+        batch.append((each, report))
+    db.send({"CHANGED": None})
+    db.send({"DONE": True, "RESULTS": [True, "Not a report", {"RETRY": "DB went away"}]})
+    controlled = []
+    retry = intake_handler.send_batch(pipe, str(tmp_path), batch,
+                                      control=lambda data: controlled.append(data) or True)
+    assert db.recv() == {"ADD_BATCH": [each[1] for each in batch]}
+    assert controlled == [{"CHANGED": None}]
+    assert retry == batch[2:]
+    assert os.listdir(tmp_path) == ["retry.dosir"]
+
+
+@pytest.mark.parametrize("use_inotify", [True, False])
+def test_streamed_reports_parsed_once(tmp_path, intake, parses, reports, use_inotify):
+    """Reports that come down the stream are never read back from their file,
+    while ones dropped in by hand still are"""
+    stream_recv, stream_send = Pipe(duplex=False)
+    db = intake(use_inotify=use_inotify, stream=stream_recv)
+    streamed = reports(5)
+    for each in streamed:
+        stream_send.send((write(tmp_path, each), each))
+    by_hand = reports(1, start=5)[0]
+    name = write(tmp_path, by_hand, "dropped-in.dosir")
+    got = receive(db, 6)
+    assert sorted(got, key=code) == sorted(streamed + [by_hand], key=code)
+    assert parses == [name]
+    # and they're all gone once the DB has them
+    assert left(tmp_path, 0) == []
+
+
+def test_stream_stopped(tmp_path, intake, parses, reports):
+    """If the filter goes away, the reports it left behind are read from their
+    files straight away"""
+    stream_recv, stream_send = Pipe(duplex=False)
+    db = intake(stream=stream_recv)
+    names = [write(tmp_path, each) for each in reports(3)]
+    stream_send.close()
+    assert sorted(code(each) for each in receive(db, 3, timeout=0.25)) == \
+        sorted(code(each) for each in reports(3))
+    assert sorted(parses) == sorted(names)
+
+
+def test_retry_reports_kept(tmp_path, intake, monkeypatch, reports):
+    """Reports the DB rejects are thrown away, but ones that never got to it
+    are kept and sent again"""
+    monkeypatch.setattr(intake_handler, "RETRY_AFTER", 0.2)
+    db = intake(use_inotify=False)
+    for each in reports(3):
+        write(tmp_path, each)
+    first = receive(db, 3, [True, "Not a report", {"RETRY": "No reply from the DB"}])
+    kept = f"installation_report-{code(first[2])}.dosir"
+    assert left(tmp_path, 1) == [kept]
+    assert receive(db, 1) == [first[2]]
+    assert left(tmp_path, 0) == []
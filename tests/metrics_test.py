@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  metrics_test.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for metrics.py"""
+from multiprocessing import Pipe
+import metrics
+
+
+def test_counters_and_gauges():
+    """Counters add up and gauges are set, separately for each set of labels"""
+    stage = metrics.Metrics("test")
+    stage.count("reports_total", result="accepted")
+    stage.count("reports_total", 2, result="accepted")
+    stage.count("reports_total", result="rejected")
+    stage.gauge("pending", 3)
+    stage.gauge("pending", 1)
+    snapshot = stage.snapshot()
+    assert snapshot["stage"] == "test"
+    assert snapshot["counters"] == {'reports_total{result="accepted"}': 3,
+                                    'reports_total{result="rejected"}': 1}
+    assert snapshot["gauges"] == {"pending": 1}
+
+
+def test_histogram():
+    """Values land in the first bucket they fit in, or the last if none"""
+    histogram = metrics.Histogram((1, 10))
+    for each in (0.5, 1, 5, 100):
+        histogram.observe(each)
+    assert histogram.snapshot() == {"bounds": [1, 10], "buckets": [2, 1, 1],
+                                    "count": 4, "sum": 106.5}
+
+
+def test_labels():
+    """Labels are always in the same order, and can be split back off"""
+    key = metrics.metric_key("seconds", {"b": "2", "a": "1"})
+    assert key == 'seconds{a="1",b="2"}'
+    assert metrics.split_key(key) == ("seconds", 'a="1",b="2"')
+    assert metrics.split_key("seconds") == ("seconds", "")
+
+
+def test_push():
+    """Snapshots are only sent when something has changed and one is due"""
+    ours, theirs = Pipe()
+    stage = metrics.Metrics("test", interval=3600)
+    stage.push(theirs)
+    assert not ours.poll(0)
+    stage.count("things")
+    stage.sent -= 3600
+    stage.push(theirs)
+    assert ours.recv()["METRICS"]["counters"] == {"things": 1}
+    # nothing new since
+    stage.sent -= 3600
+    stage.push(theirs)
+    assert not ours.poll(0)
+    stage.push(theirs, force=True)
+    assert "METRICS" in ours.recv()
+    # never, unless forced
+    assert metrics.Metrics("test").wait_time() is None
+
+
+def test_prometheus(tmp_path):
+    """Snapshots come out in the Prometheus text format, with a stage label"""
+    stage = metrics.Metrics("db")
+    stage.count("commands_total", command="ADD")
+    stage.observe("seconds", 0.5, (1,))
+    path = str(tmp_path / "metrics.prom")
+    metrics.write_prometheus({"db": stage.snapshot()}, path)
+    with open(path) as file:
+        assert file.read().splitlines() == [
+            "# TYPE data_intake_commands_total counter",
+            'data_intake_commands_total{stage="db",command="ADD"} 1',
+            "# TYPE data_intake_seconds histogram",
+            'data_intake_seconds_bucket{stage="db",le="1"} 1',
+            'data_intake_seconds_bucket{stage="db",le="+Inf"} 1',
+            'data_intake_seconds_sum{stage="db"} 0.5',
+            'data_intake_seconds_count{stage="db"} 1']
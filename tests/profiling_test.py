@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  profiling_test.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for profiling.py"""
+import os
+import signal
+import time
+import tracemalloc
+import multiprocessing as multiproc
+import pytest
+import profiling
+from metrics import Metrics
+
+
+def busy(seconds):
+    """Keep the main thread busy for `seconds', so there is something to
+    sample"""
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        sum(range(1000))
+
+
+def written(directory, extension):
+    """Profiles ending in `extension' in `directory'"""
+    return [each for each in os.listdir(directory) if each.endswith(extension)]
+
+
+@pytest.mark.parametrize("mode, extension", [("sampling", ".folded"), ("cprofile", ".prof")])
+def test_cpu_profile(tmp_path, mode, extension):
+    """Toggling CPU profiling on and off writes a profile in the right format"""
+    profiler = profiling.Profiler("test", str(tmp_path), mode)
+    profiler.toggle("cpu")
+    assert profiler.active("cpu")
+    busy(0.05)
+    profiler.toggle("cpu")
+    assert not profiler.active("cpu")
+    assert len(written(tmp_path, extension)) == 1
+    if mode == "sampling":
+        with open(tmp_path / written(tmp_path, extension)[0]) as file:
+            assert any("busy (profiling_test.py" in line for line in file)
+
+
+def test_memory_profile(tmp_path):
+    """Toggling memory profiling on and off writes a snapshot, and a summary
+    of where memory went"""
+    profiler = profiling.Profiler("test", str(tmp_path))
+    profiler.toggle("memory")
+    assert tracemalloc.is_tracing()
+    kept = [bytearray(1024) for each in range(100)]
+    profiler.toggle("memory")
+    assert not tracemalloc.is_tracing()
+    heap = written(tmp_path, ".heap")
+    assert len(heap) == 1
+    snapshot = tracemalloc.Snapshot.load(str(tmp_path / heap[0]))
+    assert len(snapshot.traces) > 0
+    assert len(written(tmp_path, ".txt")) == 1
+    del kept
+
+
+def test_unknown_mode(tmp_path):
+    """A mode we don't know falls back to sampling"""
+    assert profiling.Profiler("test", str(tmp_path), "magic").mode == "sampling"
+
+
+def test_metrics(tmp_path):
+    """The "profiling" gauge says what is being profiled"""
+    metrics = Metrics("test")
+    profiler = profiling.Profiler("test", str(tmp_path), metrics=metrics)
+    profiler.start("cpu")
+    assert metrics.snapshot()["gauges"]['profiling{kind="cpu"}'] == 1
+    profiler.stop("cpu")
+    assert metrics.snapshot()["gauges"]['profiling{kind="cpu"}'] == 0
+
+
+def test_stop_when_not_started(tmp_path):
+    """Stopping what isn't going writes nothing"""
+    profiler = profiling.Profiler("test", str(tmp_path))
+    assert profiler.stop("cpu") is None
+    assert profiler.stop("memory") is None
+    assert os.listdir(tmp_path) == []
+
+
+def late_setup(ready, go, pipe, directory):
+    """A process that takes its time to call profiling.setup()"""
+    ready.set()
+    go.wait()
+    profiler = profiling.setup("child", directory)
+    # held back signals are handled as soon as they are let through
+    end = time.monotonic() + 5
+    while profiler is not None and not profiler.active("cpu"):
+        if time.monotonic() > end:
+            break
+        time.sleep(0.01)
+    pipe.send(profiler is not None and profiler.active("cpu"))
+
+
+@pytest.mark.parametrize("directory", ["", "profiles"])
+def test_signal_before_setup(tmp_path, directory):
+    """A signal sent to a process started after hold(), before it has its
+    handlers, waits for them instead of killing it"""
+    if directory:
+        directory = str(tmp_path / directory)
+    context = multiproc.get_context("fork")
+    ready = context.Event()
+    go = context.Event()
+    parent, child = context.Pipe()
+    before = signal.pthread_sigmask(signal.SIG_BLOCK, [])
+    profiling.hold()
+    try:
+        process = context.Process(target=late_setup, args=(ready, go, child, directory))
+        process.start()
+    finally:
+        signal.pthread_sigmask(signal.SIG_SETMASK, before)
+    assert ready.wait(10)
+    os.kill(process.pid, signal.SIGUSR1)
+    go.set()
+    assert parent.poll(10)
+    assert parent.recv() == bool(directory)
+    process.join(10)
+    assert process.exitcode == 0
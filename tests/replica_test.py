@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  replica_test.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for read replicas in replica.py, fed changes by hand the way the DB
+sends them"""
+import json
+import time
+import pickle
+import threading
+from multiprocessing import Pipe
+import pytest
+import replica
+from report import plain
+
+
+def code(report):
+    """Code of `report'"""
+    return report['Installation Report Code']
+
+
+def message(version, **kwargs):
+    """A change from the DB, as of now"""
+    return dict(kwargs, version=version, time=time.time())
+
+
+def contents(copy):
+    """The reports in `copy' as plain dicts"""
+    return {each: dict(plain(copy.db[each])) for each in copy.db.keys()}
+
+
+def test_apply(reports):
+    """Changes from the DB are applied to the reports and the views"""
+    copy = replica.Replica()
+    added = reports(10)
+    copy.apply(message(1, RESET=True))
+    copy.apply(message(1, ADD=added[:6]))
+    assert not copy.synced
+    copy.apply(message(1, ADD=added[6:]))
+    copy.apply(message(1, SYNCED=True))
+    assert copy.synced
+    changed = dict(added[1], MODE="changed")
+    copy.apply(message(2, ADD=[changed], DEL=[code(added[0])]))
+    expected = {code(each): each for each in [changed] + added[2:]}
+    assert contents(copy) == expected
+    assert copy.status()["version"] == 2
+    assert copy.status()["reports"] == 9
+    fresh = replica.Replica()
+    for view, rebuilt in zip(copy.views, fresh.views):
+        rebuilt.rebuild(copy.db)
+        assert view.state() == rebuilt.state()
+
+
+@pytest.fixture
+def running(monkeypatch):
+    """Start replica.main() with its own query pipe and feed. Returns our
+    ends of both."""
+    # signal handlers can only be set up on the main thread
+    monkeypatch.setattr(replica.profiling, "setup", lambda *args, **kwargs: None)
+    ours, theirs = Pipe()
+    feed_recv, feed_send = Pipe(duplex=False)
+
+    def run():
+        try:
+            replica.main(theirs, feed_recv, max_staleness=5.0)
+        except (EOFError, OSError):
+            # we hung up on it
+            pass
+
+    threading.Thread(target=run, daemon=True).start()
+    yield ours, feed_send
+    ours.close()
+    feed_send.close()
+
+
+def ask(pipe, command, timeout=10):
+    """Send `command', returning the replica's reply"""
+    pipe.send(dict(command, ID="test"))
+    while True:
+        assert pipe.poll(timeout)
+        data = pipe.recv()
+        if data.get("ID") == "test":
+            return data
+
+
+def answered(pipe, command, timeout=10):
+    """Ask `command' until the replica has caught up enough to answer it"""
+    deadline = time.monotonic() + timeout
+    while True:
+        output = ask(pipe, command)
+        if "STALE" not in output or time.monotonic() > deadline:
+            return output
+        time.sleep(0.01)
+
+
+def feed(feed_send, *messages):
+    """Send `messages' as the DB would"""
+    for each in messages:
+        feed_send.send_bytes(pickle.dumps(each))
+
+
+def test_queries(running, reports):
+    """A replica answers queries once it has a full copy, and sends anything
+    it can't answer back to the DB"""
+    pipe, feed_send = running
+    added = reports(5)
+    assert "STALE" in ask(pipe, {"RECV": {"code": code(added[0])}})
+    feed(feed_send, message(1, RESET=True), message(1, ADD=added), message(1, SYNCED=True))
+    output = answered(pipe, {"RECV": {"code": code(added[0])}})
+    assert json.loads(output["REPLY"]) == {"DATA": added[0]}
+    assert output["VERSION"] == 1
+    assert ask(pipe, {"RECV": {"code": "not there"}})["MISS"] == "not there"
+    output = ask(pipe, {"AGGREGATE": {"group_by": ["MODE"]}})
+    assert json.loads(output["REPLY"])["DATA"]["total"] == 5
+
+
+def test_too_stale(running, reports):
+    """Once a replica has fallen too far behind, queries go to the DB"""
+    pipe, feed_send = running
+    feed(feed_send, dict(message(1, RESET=True, SYNCED=True), time=time.time() - 60))
+    deadline = time.monotonic() + 10
+    while not pipe.recv().get("STATUS", {}).get("synced"):
+        assert time.monotonic() < deadline
+    assert 60 <= ask(pipe, {"RECV": {"all": True}})["STALE"] < 120
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  report_test.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for report.py"""
+import json
+import pickle
+import pytest
+from report import Report, plain, COMPRESS_OVER, POSITION
+
+
+@pytest.fixture
+def full(reports):
+    """A report with a long log, a field we don't know about, and one we do
+    know about left out"""
+    output = reports(1)[0]
+    output["INSTALLATION LOG"] = "Installing packages\n" * (COMPRESS_OVER // 10)
+    output["Something new"] = {"nested": [1, 2, 3]}
+    del output["MODE"]
+    return output
+
+
+def test_same_as_dict(full):
+    """A Report reads just like the dict it was made from"""
+    report = Report(full)
+    assert dict(report) == full
+    assert len(report) == len(full)
+    assert set(report) == set(full)
+    for key, value in full.items():
+        assert key in report
+        assert report[key] == value
+    for key in ("MODE", "not a field"):
+        assert key not in report
+        assert report.get(key) is None
+        with pytest.raises(KeyError):
+            report[key]
+    assert report == full
+
+
+def test_compressed(full):
+    """Long logs are kept compressed, short text isn't"""
+    report = Report(full)
+    assert isinstance(report.values[POSITION["INSTALLATION LOG"]], bytes)
+    assert report["INSTALLATION LOG"] == full["INSTALLATION LOG"]
+    short = Report(dict(full, **{"INSTALLATION LOG": "short"}))
+    assert short.values[POSITION["INSTALLATION LOG"]] == "short"
+
+
+def test_interned(reports):
+    """The same values in different reports are shared"""
+    first, second = (Report(dict(each)) for each in reports(2, version="9.9.9"))
+    assert first["system-installer Version"] is second["system-installer Version"]
+    third = Report(dict(reports(1)[0], **{"RAM / SWAP INFO": {"RAM": 8, "SWAP": 2}}))
+    fourth = Report(dict(reports(1)[0], **{"RAM / SWAP INFO": {"SWAP": 2, "RAM": 8}}))
+    assert third["RAM / SWAP INFO"] is fourth["RAM / SWAP INFO"]
+
+
+def test_plain(full):
+    """plain() gives back something JSON can take, and leaves dicts alone"""
+    assert json.loads(json.dumps(plain(Report(full)))) == full
+    assert plain(full) is full
+
+
+def test_pickle(full):
+    """Reports survive being pickled, as they are in checkpoints"""
+    report = pickle.loads(pickle.dumps(Report(full), pickle.HIGHEST_PROTOCOL))
+    assert dict(report) == full
+    assert "MODE" not in report
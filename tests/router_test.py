@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  router_test.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for the order the router sends commands to the DB in, and how it
+matches up the replies"""
+import threading
+from multiprocessing import Pipe
+import pytest
+import router
+from router import Scheduler
+
+
+def send_all(scheduler):
+    """Everything the scheduler will send right now, as (source, data)"""
+    output = []
+    while True:
+        sent = scheduler.next()
+        if sent is None:
+            return output
+        output.append(sent[:2])
+
+
+def reply(data, **kwargs):
+    """What the DB would answer `data' with"""
+    return dict(kwargs, ID=data["ID"])
+
+
+def test_queries_go_first():
+    """Queries jump intake, `query_priority' at a time, and each source
+    stays in order"""
+    scheduler = Scheduler(query_priority=2)
+    for each in range(3):
+        scheduler.put("intake", {"ADD": each})
+    for each in range(5):
+        scheduler.put("request", {"GET": each})
+    sent = [(source, data.get("ADD", data.get("GET"))) for source, data in send_all(scheduler)]
+    assert sent == [("request", 0), ("request", 1), ("intake", 0),
+                    ("request", 2), ("request", 3), ("intake", 1),
+                    ("request", 4), ("intake", 2)]
+
+
+def test_window():
+    """No more than `db_window' commands are sent before they are answered"""
+    scheduler = Scheduler(db_window=2)
+    for each in range(5):
+        scheduler.put("request", {"GET": each})
+    sent = send_all(scheduler)
+    assert [data["GET"] for source, data in sent] == [0, 1]
+    assert scheduler.backlog() == 5
+    assert scheduler.answered(reply(sent[0][1], DATA=0)) == [("request", {"DATA": 0})]
+    sent = send_all(scheduler)
+    assert [data["GET"] for source, data in sent] == [2]
+    assert scheduler.backlog() == 4
+
+
+def test_limits():
+    """A source is full once it has `limits' commands waiting, which is
+    when the router answers queries BUSY"""
+    scheduler = Scheduler(db_window=1, limits={"request": 2})
+    assert not scheduler.full("request")
+    scheduler.put("request", {"GET": 0})
+    scheduler.put("request", {"GET": 1})
+    assert scheduler.full("request")
+    for each in range(10):
+        scheduler.put("intake", {"ADD": each})
+    assert not scheduler.full("intake")
+    # sending one makes room
+    send_all(scheduler)
+    assert not scheduler.full("request")
+
+
+def test_ids():
+    """Replies are matched up by our ID, go back where the command came from,
+    and get the command's own ID back"""
+    scheduler = Scheduler()
+    scheduler.put("request", {"GET": 0, "ID": "mine"})
+    scheduler.put("intake", {"ADD": 1})
+    first, second = [data for source, data in send_all(scheduler)]
+    assert first["ID"] != second["ID"]
+    assert scheduler.answered(reply(first, ERROR="No such report")) == [
+        ("request", {"ERROR": "No such report", "ID": "mine"})]
+    assert scheduler.answered(reply(second, DONE=True)) == [("intake", {"DONE": True})]
+    # not something we sent, so passed on as it is, for whoever it's for
+    assert scheduler.answered({"DATA": 2, "ID": 1000}) == [(None, {"DATA": 2, "ID": 1000})]
+    assert scheduler.backlog() == 0
+
+
+def test_dropped_reply():
+    """Commands the DB skipped over are answered with an error, rather than
+    the next reply going to the wrong one. Reports in a dropped batch are
+    to be tried again, not rejected."""
+    scheduler = Scheduler()
+    scheduler.put("request", {"GET": 0, "ID": "a"})
+    scheduler.put("intake", {"ADD_BATCH": [{}, {}]})
+    scheduler.put("request", {"GET": 1, "ID": "b"})
+    sent = [data for source, data in send_all(scheduler)]
+    assert scheduler.answered(reply(sent[2], DATA=1)) == [
+        ("request", {"ERROR": "No reply from the DB", "ID": "a"}),
+        ("intake", {"DONE": True, "RESULTS": [{"RETRY": "No reply from the DB"}] * 2}),
+        ("request", {"DATA": 1, "ID": "b"})]
+    assert scheduler.backlog() == 0
+
+
+def test_chunks():
+    """Big ADD_BATCHes are sent in pieces, with queries in between, and their
+    results are put back together in order"""
+    scheduler = Scheduler(query_priority=1, chunk=3)
+    scheduler.put("intake", {"ADD_BATCH": list(range(8))})
+    scheduler.put("request", {"GET": 0})
+    scheduler.put("request", {"GET": 1})
+    sent = send_all(scheduler)
+    assert [source for source, data in sent] == ["request", "intake", "request",
+                                                 "intake", "intake"]
+    pieces = [data for source, data in sent if source == "intake"]
+    assert [each["ADD_BATCH"] for each in pieces] == [[0, 1, 2], [3, 4, 5], [6, 7]]
+    replies = []
+    for source, data in sent:
+        if source == "intake":
+            results = [f"added {each}" for each in data["ADD_BATCH"]]
+            replies.extend(scheduler.answered(reply(data, DONE=True, RESULTS=results)))
+        else:
+            replies.extend(scheduler.answered(reply(data, DATA=data["GET"])))
+    assert replies == [("request", {"DATA": 0}), ("request", {"DATA": 1}),
+                       ("intake", {"DONE": True,
+                                   "RESULTS": [f"added {each}" for each in range(8)]})]
+
+
+def test_chunk_error():
+    """A piece the DB couldn't write still has a result for each report,
+    telling intake to try them again"""
+    scheduler = Scheduler(chunk=2)
+    scheduler.put("intake", {"ADD_BATCH": list(range(4))})
+    first, second = [data for source, data in send_all(scheduler)]
+    assert scheduler.answered(reply(first, DONE=True, RESULTS=[True, "Not a report"])) == []
+    assert scheduler.answered(reply(second, ERROR="Disk full")) == [
+        ("intake", {"DONE": True, "RESULTS": [True, "Not a report",
+                                              {"RETRY": "Disk full"}, {"RETRY": "Disk full"}]})]
+
+
+def test_small_batches_whole():
+    """Batches that fit in a chunk, or when chunking is off, go as they are"""
+    for scheduler in (Scheduler(chunk=5), Scheduler()):
+        scheduler.put("intake", {"ADD_BATCH": list(range(5))})
+        sent = send_all(scheduler)
+        assert len(sent) == 1
+        assert sent[0][1]["ADD_BATCH"] == list(range(5))
+
+
+@pytest.fixture
+def routed(monkeypatch):
+    """The router running between pipes we hold the other ends of, as
+    (db, intake, request)"""
+    # signal handlers can only be set up on the main thread
+    monkeypatch.setattr(router.profiling, "setup", lambda *args, **kwargs: None)
+    ends = [Pipe() for each in range(3)]
+
+    def run():
+        try:
+            router.route(*(theirs for ours, theirs in ends))
+        except (EOFError, OSError):
+            # we hung up on it
+            pass
+
+    threading.Thread(target=run, daemon=True).start()
+    ours = [ours for ours, theirs in ends]
+    yield ours
+    for each in ours:
+        each.close()
+
+
+def test_replies_go_to_their_source(routed):
+    """An error answering a query only goes to the request handler, and an
+    answer to intake only to intake"""
+    db, intake, request = routed
+    request.send({"RECV": {"code": "nothing"}, "ID": 7})
+    assert db.poll(5)
+    sent = db.recv()
+    db.send({"ERROR": "No such report", "ID": sent["ID"]})
+    assert request.poll(5)
+    assert request.recv() == {"ERROR": "No such report", "ID": 7}
+    intake.send({"ADD_BATCH": [{}]})
+    assert db.poll(5)
+    sent = db.recv()
+    db.send({"ERROR": "Disk full", "ID": sent["ID"]})
+    assert intake.poll(5)
+    assert intake.recv() == {"DONE": True, "RESULTS": [{"RETRY": "Disk full"}]}
+    assert not request.poll(0.2)
+    # changes are still for the request handler alone
+    db.send({"CHANGED": ["code"]})
+    assert request.poll(5)
+    assert request.recv() == {"CHANGED": ["code"]}
+    assert not intake.poll(0.2)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  sharedmem_test.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for sharedmem.py"""
+import os
+import json
+import multiprocessing as multiproc
+from multiprocessing import shared_memory
+import pytest
+import sharedmem
+
+
+@pytest.mark.parametrize("text", ["", "plain", "ünïcödé " * 1000])
+def test_round_trip(text):
+    """What is published is what is collected, and the block is gone after"""
+    handle = sharedmem.publish(text)
+    assert handle["name"].startswith(sharedmem.PREFIX)
+    assert sharedmem.collect(handle) == text
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(handle["name"])
+
+
+def publish_and_exit(pipe, text):
+    """Publish `text' from another process, which then goes away"""
+    pipe.send(sharedmem.publish(text))
+
+
+def test_outlives_writer():
+    """A reply can still be collected after the process that wrote it exits"""
+    context = multiproc.get_context("fork")
+    ours, theirs = context.Pipe()
+    process = context.Process(target=publish_and_exit, args=(theirs, "reply"))
+    process.start()
+    handle = ours.recv()
+    process.join(10)
+    assert process.exitcode == 0
+    assert sharedmem.collect(handle) == "reply"
+
+
+def test_clean_up(tmp_path, monkeypatch):
+    """Leftover blocks of ours are freed, and nobody else's"""
+    monkeypatch.setattr(sharedmem, "SHM_DIR", str(tmp_path))
+    for each in (f"{sharedmem.PREFIX}1-0", f"{sharedmem.PREFIX}2-5", "someone-else"):
+        (tmp_path / each).write_text("")
+    sharedmem.clean_up()
+    assert os.listdir(tmp_path) == ["someone-else"]
@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  storage_test.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for the Storage engines in db.py and the segment store under them"""
+import os
+import json
+import threading
+import pytest
+import db
+import segments
+from report import plain
+from index import ReportIndex
+from aggregates import Aggregates
+from fulltext import FullTextIndex
+
+
+def code(report):
+    """Code of `report'"""
+    return report['Installation Report Code']
+
+
+def contents(reports):
+    """`reports' (a dict-like of code -> report) as plain dicts"""
+    return {each: dict(plain(reports[each])) for each in reports.keys()}
+
+
+def fill(storage, reports, deleted=()):
+    """Add `reports' and then delete the codes `deleted', the way the DB
+    does"""
+    data = storage.db
+    for each in reports:
+        data[code(each)] = each
+        storage.persist([{"ADD": each}])
+    for each in deleted:
+        del data[each]
+        storage.persist([{"DEL": each}])
+
+
+def close(storage):
+    """Let go of whatever `storage' has open"""
+    if hasattr(storage.db, "close"):
+        storage.db.close()
+    if getattr(storage, "journal", None) is not None:
+        storage.settle()
+        storage.journal.close()
+
+
+def views():
+    """A fresh set of everything the DB keeps alongside the reports"""
+    return (ReportIndex(), Aggregates(), FullTextIndex())
+
+
+@pytest.mark.parametrize("kind", sorted(db.STORAGE))
+def test_round_trip(tmp_path, reports, kind):
+    """What goes in comes back out after opening the database again"""
+    name = str(tmp_path / "reports.json")
+    storage = db.STORAGE[kind](name)
+    storage.open()
+    added = reports(20)
+    fill(storage, added, [code(each) for each in added[:3]])
+    storage.commit()
+    expected = {code(each): each for each in added[3:]}
+    assert contents(storage.db) == expected
+    close(storage)
+    again = db.STORAGE[kind](name)
+    assert contents(again.open()) == expected
+    close(again)
+
+
+@pytest.mark.parametrize("kind", sorted(db.STORAGE))
+def test_overwrite(tmp_path, reports, kind):
+    """Adding a report with a code we have replaces it"""
+    name = str(tmp_path / "reports.json")
+    storage = db.STORAGE[kind](name)
+    storage.open()
+    fill(storage, reports(5))
+    changed = dict(reports(1)[0], MODE="changed")
+    fill(storage, [changed])
+    storage.commit()
+    close(storage)
+    again = db.STORAGE[kind](name)
+    data = again.open()
+    assert len(data) == 5
+    assert dict(plain(data[code(changed)])) == changed
+    close(again)
+
+
+def test_journal_replay(tmp_path, reports):
+    """Changes only in the journal are there after a restart"""
+    name = str(tmp_path / "reports.json")
+    storage = db.JournalStorage(name, compact_threshold=10 ** 6)
+    storage.open()
+    added = reports(10)
+    fill(storage, added, [code(added[0])])
+    assert os.path.getsize(f"{name}.journal") > 0
+    # nothing was folded into the snapshot
+    assert db.read(name) == contents(storage.db)
+    with open(name, "r") as file:
+        assert file.read().strip() == "{}"
+    close(storage)
+    again = db.JournalStorage(name)
+    assert contents(again.open()) == {code(each): each for each in added[1:]}
+    close(again)
+
+
+def test_journal_replay_after_interrupted_compaction(tmp_path, reports):
+    """Records rotated out for a compaction that never finished still count"""
+    name = str(tmp_path / "reports.json")
+    storage = db.JournalStorage(name, compact_threshold=10 ** 6)
+    storage.open()
+    added = reports(6)
+    fill(storage, added[:3])
+    storage.journal.close()
+    os.replace(f"{name}.journal", f"{name}.journal.compacting")
+    storage.journal = open(f"{name}.journal", "a")
+    fill(storage, added[3:], [code(added[0])])
+    close(storage)
+    again = db.JournalStorage(name)
+    assert contents(again.open()) == {code(each): each for each in added[1:]}
+    close(again)
+
+
+@pytest.mark.parametrize("rotated", [False, True])
+def test_journal_resumes_from_checkpoint(tmp_path, monkeypatch, reports, rotated):
+    """Opening again loads the checkpoint and what was journaled after it,
+    without reading the snapshot or writing anything out first"""
+    name = str(tmp_path / "reports.json")
+    storage = db.JournalStorage(name, compact_threshold=10 ** 6)
+    storage.open()
+    added = reports(20)
+    fill(storage, added[:10])
+    storage.checkpoint(views())
+    if rotated:
+        # a compaction started after the checkpoint and never finished
+        storage.journal.close()
+        os.replace(f"{name}.journal", f"{name}.journal.compacting")
+        storage.journal = db.open_journal(f"{name}.journal")
+    fill(storage, added[10:], [code(added[0])])
+    expected = contents(storage.db)
+    close(storage)
+    with open(name, "r") as file:
+        before = file.read()
+
+    ready = threading.Event()
+    write = db.snapshot
+
+    def snapshot(*args, **kwargs):
+        ready.wait()
+        write(*args, **kwargs)
+
+    monkeypatch.setattr(db.json, "load", None)
+    monkeypatch.setattr(db, "snapshot", snapshot)
+    again = db.JournalStorage(name, compact_threshold=10 ** 6)
+    assert contents(again.open()) == expected
+    # what counts towards the next compaction is what's in the live journal
+    assert again.journaled == (11 if rotated else 21)
+    with open(name, "r") as file:
+        assert file.read() == before
+    monkeypatch.undo()
+    ready.set()
+    again.settle()
+    with open(name, "r") as file:
+        if rotated:
+            # the rotated records are folded in while the DB gets on with it
+            assert json.load(file) == expected
+            assert not os.path.exists(f"{name}.journal.compacting")
+        else:
+            assert file.read() == before
+    close(again)
+
+
+def test_journal_checkpoint_outdated(tmp_path, reports):
+    """A checkpoint taken against a journal that has been folded away since
+    isn't used"""
+    name = str(tmp_path / "reports.json")
+    storage = db.JournalStorage(name)
+    storage.open()
+    added = reports(10)
+    fill(storage, added[:5])
+    storage.checkpoint(views())
+    fill(storage, added[5:])
+    storage.commit()
+    close(storage)
+    again = db.JournalStorage(name)
+    assert contents(again.open()) == {code(each): each for each in added}
+    assert not again.restore_views(views())
+    close(again)
+
+
+def test_torn_journal_record(tmp_path, reports):
+    """What was half written when we crashed is dropped, and doesn't get in
+    the way of what comes after"""
+    name = str(tmp_path / "reports.json")
+    storage = db.JournalStorage(name)
+    storage.open()
+    added = reports(3)
+    fill(storage, added[:2])
+    storage.journal.write('{"ADD": {"Installation Report Code": "torn')
+    close(storage)
+    again = db.JournalStorage(name)
+    again.open()
+    fill(again, added[2:])
+    close(again)
+    last = db.JournalStorage(name)
+    assert contents(last.open()) == {code(each): each for each in added}
+    close(last)
+
+
+def test_torn_segment_write(tmp_path, reports):
+    """A record cut short by a crash is cut off, and everything before it
+    is still there"""
+    path = str(tmp_path / "store")
+    store = segments.SegmentStore(path)
+    added = reports(5)
+    for each in added:
+        store[code(each)] = each
+    store.sync()
+    last = store.segment_path(store.segments[-1])
+    size = os.path.getsize(last)
+    store.close()
+    with open(last, "ab") as file:
+        file.write(segments.HEADER.pack(segments.ADD, 24, 1000) + b"0" * 24 + b"{\"cut")
+    store = segments.SegmentStore(path)
+    assert os.path.getsize(last) == size
+    assert contents(store) == {code(each): each for each in added}
+    # and it can be written to again
+    extra = reports(1, start=5)[0]
+    store[code(extra)] = extra
+    store.sync()
+    store.close()
+    store = segments.SegmentStore(path)
+    assert len(store) == 6
+    assert store[code(extra)] == extra
+    store.close()
+
+
+def test_segments_roll_over_and_compact(tmp_path, reports):
+    """Reports spread over several segments survive compaction"""
+    path = str(tmp_path / "store")
+    store = segments.SegmentStore(path, segment_size=2000)
+    added = reports(30)
+    for each in added:
+        store[code(each)] = each
+    for each in added[:20]:
+        del store[code(each)]
+    assert len(store.segments) > 1
+    store.compact()
+    assert store.dead_bytes == 0
+    assert contents(store) == {code(each): each for each in added[20:]}
+    store.close()
+
+
+class Crash(Exception):
+    """Stands in for the process dying"""
+
+
+@pytest.mark.parametrize("crash_at", range(4))
+def test_interrupted_compaction(tmp_path, monkeypatch, reports, crash_at):
+    """However far a compaction got before a crash, the next open finds every
+    report and nothing left over"""
+    path = str(tmp_path / "reports.json.segments")
+    store = segments.SegmentStore(path, segment_size=2000)
+    added = reports(30)
+    for each in added:
+        store[code(each)] = each
+    for each in added[:20]:
+        del store[code(each)]
+    store.sync()
+    expected = {code(each): each for each in added[20:]}
+    steps = []
+
+    def step(real):
+        def crashing(*args):
+            steps.append(args)
+            if len(steps) > crash_at:
+                raise Crash()
+            return real(*args)
+        return crashing
+
+    # the three renames swapping the segments over, then removing the old ones
+    monkeypatch.setattr(segments.os, "rename", step(os.rename))
+    monkeypatch.setattr(segments.shutil, "rmtree", step(segments.shutil.rmtree))
+    with pytest.raises(Crash):
+        store.compact()
+    monkeypatch.undo()
+    storage = db.SegmentStorage(str(tmp_path / "reports.json"))
+    assert contents(storage.open()) == expected
+    close(storage)
+    assert sorted(os.listdir(tmp_path)) == ["reports.json.segments"]
+
+
+def test_compaction_rolled_back(tmp_path, reports):
+    """Old segments moved aside with no complete new ones to replace them are
+    put back"""
+    path = str(tmp_path / "store")
+    store = segments.SegmentStore(path)
+    for each in reports(5):
+        store[code(each)] = each
+    store.close()
+    os.rename(path, path + ".old")
+    os.makedirs(path + ".compacting")
+    store = segments.SegmentStore(path)
+    assert contents(store) == {code(each): each for each in reports(5)}
+    store.close()
+    assert os.listdir(tmp_path) == ["store"]
+
+
+@pytest.mark.parametrize("kind", ["journal", "segments"])
+def test_checkpoint_restore_matches_rebuild(tmp_path, reports, kind):
+    """Views picked up from a checkpoint and caught up with what was written
+    after it are the same as views built from scratch"""
+    name = str(tmp_path / "reports.json")
+    storage = db.STORAGE[kind](name)
+    storage.open()
+    added = reports(30)
+    fill(storage, added)
+    saved = views()
+    for each in saved:
+        each.rebuild(storage.db)
+    storage.checkpoint(saved)
+    # written after the checkpoint, so only the segments have it
+    changed = [dict(each, MODE="changed", **{"CUSTOM MESSAGE": "new words"})
+               for each in added[:5]]
+    fill(storage, reports(10, start=30) + changed, [code(each) for each in added[5:10]])
+    close(storage)
+    again = db.STORAGE[kind](name)
+    data = again.open()
+    restored = views()
+    assert again.restore_views(restored)
+    rebuilt = views()
+    for each in rebuilt:
+        each.rebuild(data)
+    for old, new in zip(restored, rebuilt):
+        assert old.state() == new.state()
+    close(again)
+
+
+def test_checkpoint_ignored_when_segments_changed(tmp_path, reports):
+    """A checkpoint for segments that have since been cut short isn't used"""
+    name = str(tmp_path / "reports.json")
+    storage = db.SegmentStorage(name)
+    storage.open()
+    fill(storage, reports(10))
+    saved = views()
+    for each in saved:
+        each.rebuild(storage.db)
+    storage.checkpoint(saved)
+    last = storage.db.segment_path(storage.db.segments[-1])
+    close(storage)
+    os.truncate(last, os.path.getsize(last) // 2)
+    again = db.SegmentStorage(name)
+    again.open()
+    assert not again.restore_views(views())
+    close(again)
+
+
+def test_unfinished_storage():
+    """A storage engine missing any of what the DB needs can't be made"""
+    class Unfinished(db.Storage):
+        def open(self):
+            return {}
+
+    with pytest.raises(TypeError):
+        Unfinished("reports.json")
+
+
+@pytest.mark.parametrize("kind", ["segments", "sqlite"])
+def test_migration(tmp_path, reports, kind):
+    """Engines with files of their own take the reports over from the JSON
+    database the first time, and only the first time"""
+    name = str(tmp_path / "reports.json")
+    old = {code(each): each for each in reports(10)}
+    db.commit(old, name)
+    storage = db.STORAGE[kind](name)
+    assert contents(storage.open()) == old
+    close(storage)
+    assert not os.path.exists(name)
+    assert os.path.isfile(f"{name}.migrated")
+    # a JSON database turning up again later isn't imported over what we have
+    db.commit({code(each): each for each in reports(5, start=10)}, name)
+    storage = db.STORAGE[kind](name)
+    assert contents(storage.open()) == old
+    close(storage)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  verdicts_test.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for the filter's cache of verdicts and accepted reports"""
+from verdicts import VerdictCache, digest
+
+
+def test_verdicts():
+    """Verdicts are remembered by hash"""
+    cache = VerdictCache(10)
+    key = digest(b"some upload")
+    assert cache.verdict(key) is None
+    cache.remember(key, "clean")
+    assert cache.verdict(key) == "clean"
+    assert cache.verdict(digest(b"something else")) is None
+
+
+def test_least_recently_used():
+    """Once full, whatever was used longest ago goes first"""
+    cache = VerdictCache(3)
+    for each in "abc":
+        cache.remember(each, each.upper())
+    cache.verdict("a")
+    cache.remember("d", "D")
+    assert cache.verdict("b") is None
+    assert [cache.verdict(each) for each in "acd"] == ["A", "C", "D"]
+    for each in "wxyz":
+        cache.accept(each)
+    assert not cache.accepted("w")
+    assert all(cache.accepted(each) for each in "xyz")
+
+
+def test_accept():
+    """A report can only be accepted once, and asking doesn't accept it"""
+    cache = VerdictCache(10)
+    assert not cache.accepted("report")
+    assert not cache.accepted("report")
+    assert cache.accept("report")
+    assert cache.accepted("report")
+    assert not cache.accept("report")
+
+
+def test_signatures():
+    """New virus signatures throw out the verdicts, but not the reports"""
+    cache = VerdictCache(10)
+    cache.check_signatures("ClamAV 1/100")
+    cache.remember("file", "infected")
+    cache.accept("report")
+    cache.check_signatures("ClamAV 1/100")
+    assert cache.verdict("file") == "infected"
+    cache.check_signatures("ClamAV 1/101")
+    assert cache.verdict("file") is None
+    assert cache.accepted("report")
+
+
+def test_disabled():
+    """With no room, nothing is kept"""
+    cache = VerdictCache(0)
+    cache.remember("file", "clean")
+    assert cache.verdict("file") is None
+    assert cache.accept("report")
+    assert cache.accept("report")
+
+
+def test_save_and_load(tmp_path):
+    """The cache picks up where it left off, signatures and all"""
+    path = str(tmp_path / "verdicts.json")
+    cache = VerdictCache(10, path)
+    cache.check_signatures("ClamAV 1/100")
+    cache.remember("file", "clean")
+    cache.accept("report")
+    cache.save()
+    cache = VerdictCache(10, path)
+    assert cache.verdict("file") == "clean"
+    assert cache.accepted("report")
+    cache.check_signatures("ClamAV 1/101")
+    assert cache.verdict("file") is None
+    # loading into a smaller cache keeps what was used last
+    cache.remember("other", "clean")
+    cache.remember("another", "infected")
+    cache.save()
+    cache = VerdictCache(1, path)
+    assert cache.verdict("another") == "infected"
+    assert cache.verdict("other") is None
+
+
+def test_unreadable(tmp_path):
+    """A cache file we can't make sense of is started over"""
+    path = tmp_path / "verdicts.json"
+    path.write_text("{not json")
+    cache = VerdictCache(10, str(path))
+    assert cache.verdict("file") is None
+    cache.remember("file", "clean")
+    cache.save()
+    assert VerdictCache(10, str(path)).verdict("file") == "clean"
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  watcher_test.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Tests for watcher.py"""
+import os
+import time
+from multiprocessing import Pipe
+import pytest
+import watcher
+
+
+def touch(path, name, text="{}"):
+    """Write `text' to `name' in `path' and close it"""
+    with open(os.path.join(path, name), "w") as file:
+        file.write(text)
+
+
+@pytest.fixture
+def watching(tmp_path):
+    """A watcher on `tmp_path' using inotify, skipping if it can't"""
+    output = watcher.DirectoryWatcher(str(tmp_path), 0.05)
+    if output.fileno() is None:
+        pytest.skip("inotify isn't available here")
+    yield output
+    output.close()
+
+
+def test_initial(tmp_path):
+    """What is already there comes first"""
+    touch(tmp_path, "a")
+    touch(tmp_path, "b")
+    assert sorted(watcher.DirectoryWatcher(str(tmp_path), 0.05, False).initial()) == ["a", "b"]
+
+
+def test_inotify_written(tmp_path, watching):
+    """A file shows up once it is closed, not while it is still being written"""
+    assert watching.initial() == []
+    file = open(tmp_path / "report", "w")
+    file.write("{")
+    file.flush()
+    assert watching.changes(0.1) == []
+    file.write("}")
+    file.close()
+    assert watching.changes(1) == ["report"]
+    assert watching.changes(0.05) == []
+
+
+def test_inotify_moved_in(tmp_path, watching):
+    """A file renamed into the directory shows up under its new name"""
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    watching.changes(0.05)
+    touch(outside, "report")
+    assert watching.changes(0.1) == []
+    os.replace(outside / "report", tmp_path / "report")
+    assert watching.changes(1) == ["report"]
+
+
+def test_overflow(tmp_path):
+    """If inotify loses track, everything in the directory is looked at"""
+    touch(tmp_path, "a")
+    touch(tmp_path, "b")
+    read, write = os.pipe()
+    os.set_blocking(read, False)
+    output = watcher.DirectoryWatcher(str(tmp_path), 0.05, False)
+    output.fd = read
+    os.write(write, watcher.EVENT_HEADER.pack(-1, watcher.IN_Q_OVERFLOW, 0, 0))
+    try:
+        assert sorted(output.changes(1)) == ["a", "b"]
+    finally:
+        output.close()
+        os.close(write)
+
+
+def test_polling(tmp_path):
+    """Without inotify, the directory is listed again every `freq' seconds"""
+    output = watcher.DirectoryWatcher(str(tmp_path), 0.2, False)
+    assert output.fileno() is None
+    output.initial()
+    touch(tmp_path, "report")
+    started = time.monotonic()
+    assert output.changes(0.05) == []
+    assert output.changes() == ["report"]
+    assert time.monotonic() - started >= 0.2
+
+
+def test_polling_woken(tmp_path):
+    """Waiting for changes stops early if something else needs us"""
+    output = watcher.DirectoryWatcher(str(tmp_path), 10, False)
+    output.initial()
+    ours, theirs = Pipe()
+    theirs.send("wake up")
+    started = time.monotonic()
+    assert output.changes(5, also=[ours]) == []
+    assert time.monotonic() - started < 5
+
+
+def test_no_inotify(tmp_path, monkeypatch):
+    """If inotify can't be set up we poll instead"""
+    monkeypatch.setattr(watcher, "inotify_init", lambda path: None)
+    output = watcher.DirectoryWatcher(str(tmp_path), 0.05)
+    assert output.fileno() is None
+    touch(tmp_path, "report")
+    assert output.changes(1) == ["report"]
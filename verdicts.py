@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  verdicts.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Remember what the filter decided about each file it has seen, by the hash
+of its contents, so uploads that are tried again don't cost another virus
+scan and decrypt"""
+from __future__ import print_function
+import sys
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=sys.stderr, **kwargs)
+
+
+if sys.version_info[0] == 2:
+    eprint("Please run with Python 3 as Python 2 is End-of-Life.")
+    exit(2)
+
+
+def digest(data):
+    """What `data' is filed under"""
+    return hashlib.sha256(data).hexdigest()
+
+
+class VerdictCache:
+    """Size bounded LRU caches of file hash -> verdict, and of the hashes of
+    the decrypted reports we have already accepted
+
+    Verdicts depend on the virus signatures they were reached with, so they
+    are all thrown out when clamd's signature version changes. Accepted
+    reports are kept regardless, since they are in the database either
+    way. If `path' is given, the cache is kept there between runs."""
+    def __init__(self, size, path=None):
+        self.size = size
+        self.path = path
+        self.signatures = None
+        self.files = OrderedDict()
+        self.reports = OrderedDict()
+        self.lock = threading.Lock()
+        self.changed = False
+        if path:
+            self.load()
+
+    def load(self):
+        """Pick up where we left off, if we can"""
+        try:
+            with open(self.path, "r") as file:
+                data = json.load(file)
+            self.signatures = data["signatures"]
+            self.files = OrderedDict(data["files"])
+            self.reports = OrderedDict.fromkeys(data["reports"])
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError) as err:
+            eprint(f"Verdict cache {self.path} is unreadable ({err}). Starting over...")
+        self.trim()
+
+    def save(self):
+        """Write the cache out if it changed, without ever leaving half of it
+        on disk"""
+        if not self.path or not self.changed:
+            return
+        with self.lock:
+            data = {"signatures": self.signatures, "files": list(self.files.items()),
+                    "reports": list(self.reports)}
+            self.changed = False
+        with open(f"{self.path}.tmp", "w") as file:
+            json.dump(data, file)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def trim(self):
+        """Push out the least recently used entries until we fit"""
+        for each in (self.files, self.reports):
+            while len(each) > self.size:
+                each.popitem(last=False)
+
+    def check_signatures(self, version):
+        """Forget every verdict if `version' isn't what they were reached with"""
+        with self.lock:
+            if version == self.signatures:
+                return
+            if self.signatures is not None and len(self.files) > 0:
+                print(f"Virus signatures changed ({version}). Dropping {len(self.files)} "
+                      "cached verdicts...")
+            self.files.clear()
+            self.signatures = version
+            self.changed = True
+
+    def verdict(self, key):
+        """What we decided about the file with hash `key' last time, or None"""
+        with self.lock:
+            try:
+                self.files.move_to_end(key)
+            except KeyError:
+                return None
+            return self.files[key]
+
+    def remember(self, key, verdict):
+        """Note we decided `verdict' about the file with hash `key'"""
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.files[key] = verdict
+            self.files.move_to_end(key)
+            self.trim()
+            self.changed = True
+
+    def accepted(self, key):
+        """Whether the report with hash `key' has been accepted already"""
+        with self.lock:
+            if key not in self.reports:
+                return False
+            self.reports.move_to_end(key)
+            return True
+
+    def accept(self, key):
+        """Note the report with hash `key' was accepted. Returns False if it
+        already had been."""
+        if self.size <= 0:
+            return True
+        with self.lock:
+            if key in self.reports:
+                self.reports.move_to_end(key)
+                return False
+            self.reports[key] = None
+            self.trim()
+            self.changed = True
+            return True
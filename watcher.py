@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  watcher.py
+#
+#  Copyright 2023 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Find out when new files show up in a directory, using inotify where we can
+and falling back to polling where we can't"""
+from __future__ import print_function
+import sys
+import os
+import time
+import struct
+import ctypes
+import ctypes.util
+from multiprocessing.connection import wait
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=sys.stderr, **kwargs)
+
+
+if sys.version_info[0] == 2:
+    eprint("Please run with Python 3 as Python 2 is End-of-Life.")
+    exit(2)
+
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def inotify_init(path):
+    """Set up an inotify watch on `path'. Returns the inotify fd, or None if
+    inotify isn't available here."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+        eprint(f"Could not watch {path}: {os.strerror(ctypes.get_errno())}")
+        os.close(fd)
+        return None
+    return fd
+
+
+class DirectoryWatcher:
+    """Report files that have been written to, or moved into, a directory
+
+    Call `initial' once to get what is already there, then `changes' to
+    wait for anything new. Without inotify, `changes' re-lists the whole
+    directory every `freq' seconds instead."""
+    def __init__(self, path, freq, use_inotify=True):
+        self.path = path
+        self.freq = freq
+        self.fd = None
+        self.scanned = time.monotonic()
+        if use_inotify:
+            self.fd = inotify_init(path)
+            if self.fd is None:
+                eprint(f"inotify unavailable. Polling {path} every {freq} seconds instead.")
+
+    def fileno(self):
+        """inotify file descriptor, so callers can wait on it themselves"""
+        return self.fd
+
+    def initial(self):
+        """Everything already in the directory"""
+        self.scanned = time.monotonic()
+        return os.listdir(self.path)
+
+    def changes(self, timeout=None, also=()):
+        """Wait up to `timeout' seconds (forever if None) for new files and
+        return their names
+
+        Returns early, possibly with no names, if any of the connections in
+        `also' become readable."""
+        if self.fd is None:
+            due = self.scanned + self.freq - time.monotonic()
+            if timeout is None or timeout > due:
+                timeout = max(due, 0)
+            if len(also) > 0:
+                wait(also, timeout)
+            else:
+                time.sleep(timeout)
+            if time.monotonic() < self.scanned + self.freq:
+                return []
+            return self.initial()
+        if self.fd in wait([self.fd, *also], timeout):
+            return self.read_events()
+        return []
+
+    def read_events(self):
+        """Drain pending inotify events, returning the file names they name"""
+        names = {}
+        while True:
+            try:
+                buffer = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return list(names)
+            offset = 0
+            while offset < len(buffer):
+                _, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+                offset += EVENT_HEADER.size
+                name = buffer[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    # lost track of what changed, so look at everything
+                    eprint(f"inotify queue overflowed on {self.path}. Re-scanning...")
+                    names.update(dict.fromkeys(os.listdir(self.path)))
+                elif len(name) > 0:
+                    names[os.fsdecode(name)] = None
+
+    def close(self):
+        """Stop watching"""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None